@@ -2,47 +2,199 @@ import logging
 import aiohttp
 import json
 import asyncio
-from typing import List, Optional
+import time
+from typing import List, Optional, Tuple
 from config import config
+from ai_queue import AIPriority, request_queue
+from ai_hedging import hedge_controller
+from http_pool import get_http_session
+from ai_resilience import AIProviderError, CircuitOpenError, call_with_retry, get_default_retry_policy
+from ai_router import AIBackend, get_router
+from ai_usage import AICallStats, current_call, get_current_call, usage_tracker
+from token_budget import estimate_tokens
 
 logger = logging.getLogger(__name__)
 
+# Модели Yandex GPT, которые можно использовать взаимозаменяемо
+YANDEX_MODELS = ["yandexgpt-lite", "yandexgpt"]
+
+# Начало ответов локальной заглушки: такие ответы не кэшируются
+LOCAL_FALLBACK_PREFIX = "🤖 Локальный fallback"
+
+
+def is_local_fallback(answer: Optional[str]) -> bool:
+    return bool(answer) and answer.startswith(LOCAL_FALLBACK_PREFIX)
+
 class AIClient:
     """Универсальный клиент для работы с AI провайдерами"""
     
     def __init__(self):
         self.provider = config.AI_PROVIDER
+        self.retry_policy = get_default_retry_policy()
         logger.info(f"Инициализирован AI клиент с провайдером: {self.provider}")
     
-    async def chat_completion(self, messages: List[dict], max_tokens: int = None, temperature: float = None) -> Optional[str]:
-        """Основной метод для получения ответов от AI"""
+    async def chat_completion(self, messages: List[dict], max_tokens: int = None, temperature: float = None,
+                              priority: AIPriority = AIPriority.INTERACTIVE,
+                              chat_id: Optional[int] = None,
+                              command: Optional[str] = None) -> Optional[str]:
+        """Основной метод для получения ответов от AI
+
+        Запрос проходит через общую приоритетную очередь: команды пользователей
+        обслуживаются раньше фоновых и массовых задач, а чаты внутри одного
+        класса приоритета - по очереди.
+
+        Временные ошибки (429, 5xx, таймауты, сеть) повторяются с экспоненциальной
+        задержкой и джиттером. Маршрутизатор выбирает бэкенд по задержке, ошибкам,
+        стоимости и команде и при сбое переключается на следующий. Если все
+        бэкенды недоступны, сразу возвращается локальный fallback.
+
+        Каждая попытка бэкенда учитывается в usage_tracker: токены, задержка, повторы.
+        Маршрутизатору передается только время ответа самого провайдера, без
+        ожидания в очереди и пауз между повторами.
+        """
+        router = get_router()
+        backends = router.route(command)
+        logger.info(f"🔧 AI клиент: запрос ({command or 'без команды'}), сообщений: {len(messages)}, "
+                    f"приоритет: {AIPriority(priority).name}, бэкенды: {[backend.name for backend in backends]}")
+
+        call = AICallStats(command, chat_id)
+        context_token = current_call.set(call)
         try:
-            logger.info(f"🔧 AI клиент: запрос к {self.provider}, сообщений: {len(messages)}")
-            
-            if self.provider == "yandex":
-                return await self._yandex_chat(messages, max_tokens, temperature)
-            elif self.provider == "openai":
-                return await self._openai_chat(messages, max_tokens, temperature)
-            else:
-                logger.warning("🔧 AI клиент: использование локального fallback")
-                return await self._local_fallback(messages)
-                
-        except Exception as e:
-            logger.error(f"❌ Ошибка AI клиента ({self.provider}): {e}")
-            return None
+            had_error = False
+            for backend in backends:
+                if backend.provider == "local":
+                    break
+
+                call.provider, call.model = backend.provider, backend.model
+                call.attempts = 0
+                call.set_usage(0, 0)
+                service_time = [0.0]
+
+                async def timed_dispatch():
+                    dispatch_started = time.monotonic()
+                    result = await self._dispatch(backend, messages, max_tokens, temperature)
+                    service_time[0] = time.monotonic() - dispatch_started
+                    return result
+
+                async def attempt():
+                    call.attempts += 1
+                    return await request_queue.run(timed_dispatch, priority=priority, chat_id=chat_id)
+
+                started = time.monotonic()
+                try:
+                    answer = await call_with_retry(attempt, policy=self.retry_policy, breaker=backend.breaker)
+                    router.record_success(backend, service_time[0])
+                    usage_tracker.record(call, time.monotonic() - started)
+                    return answer
+                except CircuitOpenError as e:
+                    logger.warning(f"⚡ AI клиент: {e}")
+                except Exception as e:
+                    had_error = True
+                    router.record_failure(backend)
+                    usage_tracker.record(call, time.monotonic() - started, success=False)
+                    logger.error(f"❌ Ошибка AI бэкенда {backend.name}: {e}")
+
+            if had_error:
+                return None
+
+            logger.warning("⚡ AI клиент: нет доступных бэкендов, используем локальный fallback")
+            call.provider, call.model = "local", ""
+            usage_tracker.record(call, 0.0)
+            return await self._local_fallback(messages)
+        finally:
+            current_call.reset(context_token)
+
+    def _record_usage(self, model: str, usage: Optional[dict], prompt_key: str, completion_key: str,
+                      messages: List[dict], answer: Optional[str]):
+        """Токены ответа провайдера в статистику текущего вызова (или локальная оценка)"""
+        call = get_current_call()
+        if call is None:
+            return
+        call.model = model
+        if usage:
+            call.set_usage(usage.get(prompt_key), usage.get(completion_key))
+        else:
+            call.set_usage(
+                sum(estimate_tokens(msg.get("content") or msg.get("text") or "") for msg in messages),
+                estimate_tokens(answer or "")
+            )
+
+    async def _dispatch(self, backend: AIBackend, messages: List[dict], max_tokens: int = None,
+                        temperature: float = None) -> Optional[str]:
+        """Вызов провайдера выбранного бэкенда"""
+        if backend.provider == "yandex":
+            if config.AI_HEDGING_ENABLED:
+                return await self._yandex_hedged_chat(messages, max_tokens, temperature, model=backend.model)
+            return await self._yandex_chat(messages, max_tokens, temperature, model=backend.model)
+        elif backend.provider == "openai":
+            return await self._openai_chat(messages, max_tokens, temperature,
+                                           model=backend.model, base_url=backend.base_url)
+        else:
+            logger.warning("🔧 AI клиент: использование локального fallback")
+            return await self._local_fallback(messages)
 
-    async def _yandex_chat(self, messages: List[dict], max_tokens: int = None, temperature: float = None) -> str:
+    async def _yandex_hedged_chat(self, messages: List[dict], max_tokens: int = None,
+                                  temperature: float = None, model: Optional[str] = None) -> str:
+        """Запрос к Yandex GPT с дублированием для борьбы с хвостовыми задержками
+
+        Если основная модель не ответила за перцентиль своих недавних задержек,
+        тот же запрос отправляется второй модели. Берется первый успешный ответ,
+        второй запрос отменяется. Доля дублей ограничена бюджетом.
+
+        Для отмененного запроса в задержки модели записывается время до
+        отмены: настоящая задержка не меньше, и без таких замеров перцентиль
+        считался бы только по быстрым ответам.
+        """
+        primary_model = model or getattr(config, 'YANDEX_MODEL', 'yandexgpt')
+        secondary_model = config.AI_HEDGE_MODEL or next(
+            (model for model in YANDEX_MODELS if model != primary_model), primary_model
+        )
+
+        hedge_controller.on_primary_request()
+        primary = asyncio.create_task(self._yandex_chat(messages, max_tokens, temperature, model=primary_model))
+        tasks = {primary: (primary_model, time.monotonic())}
+
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=hedge_controller.get_delay(primary_model))
+            if not done and hedge_controller.try_acquire_hedge():
+                logger.info(f"🔀 Yandex GPT: {primary_model} отвечает долго, дублируем запрос в {secondary_model}")
+                hedge = asyncio.create_task(self._yandex_chat(messages, max_tokens, temperature, model=secondary_model))
+                tasks[hedge] = (secondary_model, time.monotonic())
+
+            last_error = None
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None and task.result():
+                        if task is not primary:
+                            hedge_controller.on_hedge_won()
+                        return task.result()
+                    last_error = task.exception() or last_error
+
+            if last_error:
+                raise last_error
+            return primary.result()
+        finally:
+            for task, (task_model, started) in tasks.items():
+                if not task.done():
+                    task.cancel()
+                    hedge_controller.record_latency(task_model, time.monotonic() - started)
+
+    async def _yandex_chat(self, messages: List[dict], max_tokens: int = None, temperature: float = None,
+                           model: Optional[str] = None) -> str:
         """Yandex GPT API - реализация с обработкой system messages и fallback'ами"""
         logger.info(f"🔧 Yandex GPT: начало обработки запроса")
+        model = model or getattr(config, 'YANDEX_MODEL', 'yandexgpt')
         
         # Проверяем конфигурацию
         if not getattr(config, "YANDEX_API_KEY", None):
             logger.error("❌ Yandex GPT: отсутствует API_KEY в конфиге")
-            raise Exception("YANDEX_API_KEY не настроен")
+            raise AIProviderError("YANDEX_API_KEY не настроен", retryable=False)
         
         if not getattr(config, "YANDEX_FOLDER_ID", None):
             logger.error("❌ Yandex GPT: отсутствует FOLDER_ID в конфиге")
-            raise Exception("YANDEX_FOLDER_ID не настроен")
+            raise AIProviderError("YANDEX_FOLDER_ID не настроен", retryable=False)
         
         headers = {
             "Authorization": f"Api-Key {config.YANDEX_API_KEY}",
@@ -71,7 +223,7 @@ class AIClient:
                 yandex_messages.append({"role": "user", "text": system_content})
         
         data = {
-            "modelUri": f"gpt://{config.YANDEX_FOLDER_ID}/{getattr(config, 'YANDEX_MODEL', 'yandexgpt')}",  # Используем yandexgpt по умолчанию
+            "modelUri": f"gpt://{config.YANDEX_FOLDER_ID}/{model}",
             "completionOptions": {
                 "stream": False,
                 "temperature": temperature or getattr(config, "AI_TEMPERATURE", 0.7),
@@ -83,27 +235,33 @@ class AIClient:
         logger.debug(f"🔧 Yandex GPT запрос: {json.dumps(data, ensure_ascii=False)}")
         
         try:
-            async with aiohttp.ClientSession() as session:
-                logger.info(f"🔧 Yandex GPT: отправка запроса на {getattr(config, 'YANDEX_URL', 'YANDEX_URL_NOT_SET')}")
-                timeout = aiohttp.ClientTimeout(total=30)
-                async with session.post(getattr(config, "YANDEX_URL"), headers=headers, json=data, timeout=timeout) as response:
-                    logger.info(f"🔧 Yandex GPT: статус ответа {response.status}")
+            session = get_http_session()
+            logger.info(f"🔧 Yandex GPT: отправка запроса на {getattr(config, 'YANDEX_URL', 'YANDEX_URL_NOT_SET')}")
+            timeout = aiohttp.ClientTimeout(total=config.AI_REQUEST_TIMEOUT, connect=config.AI_CONNECT_TIMEOUT)
+            started = time.monotonic()
+            async with session.post(getattr(config, "YANDEX_URL"), headers=headers, json=data, timeout=timeout) as response:
+                logger.info(f"🔧 Yandex GPT: статус ответа {response.status}")
+                
+                if response.status == 200:
+                    result = await response.json()
+                    answer = result['result']['alternatives'][0]['message']['text']
+                    hedge_controller.record_latency(model, time.monotonic() - started)
+                    self._record_usage(model, result['result'].get('usage'), 'inputTextTokens',
+                                       'completionTokens', messages, answer)
+                    logger.info(f"✅ Yandex GPT ({model}): успешный ответ: {answer[:100]}...")
+                    return answer
+                else:
+                    error_text = await response.text()
+                    logger.error(f"❌ Yandex GPT API ошибка: {response.status} - {error_text}")
                     
-                    if response.status == 200:
-                        result = await response.json()
-                        answer = result['result']['alternatives'][0]['message']['text']
-                        logger.info(f"✅ Yandex GPT: успешный ответ: {answer[:100]}...")
-                        return answer
-                    else:
-                        error_text = await response.text()
-                        logger.error(f"❌ Yandex GPT API ошибка: {response.status} - {error_text}")
-                        
-                        if response.status == 500:
-                            # Попробуем упрощённый запрос
-                            return await self._retry_with_simple_prompt(messages)
-                        
-                        raise Exception(f"Yandex GPT API error: {response.status} - {error_text}")
+                    # Повтор (с полным контекстом) решает call_with_retry по статусу
+                    raise AIProviderError(
+                        f"Yandex GPT API error: {response.status} - {error_text}",
+                        status=response.status
+                    )
                         
+        except AIProviderError:
+            raise
         except aiohttp.ClientError as e:
             logger.error(f"❌ Yandex GPT: ошибка сети: {e}")
             raise
@@ -116,7 +274,7 @@ class AIClient:
 
     async def _try_different_model(self, message: str) -> str:
         """Пробуем разные модели (вспомогательный метод)"""
-        models_to_try = ["yandexgpt-lite", "yandexgpt"]
+        models_to_try = YANDEX_MODELS
         
         for model in models_to_try:
             logger.info(f"🔄 Пробуем модель: {model}")
@@ -137,20 +295,20 @@ class AIClient:
             }
             
             try:
-                async with aiohttp.ClientSession() as session:
-                    timeout = aiohttp.ClientTimeout(total=30)
-                    async with session.post(
-                        getattr(config, "YANDEX_URL"), headers=headers, json=data, timeout=timeout
-                    ) as response:
-                        
-                        if response.status == 200:
-                            result = await response.json()
-                            answer = result['result']['alternatives'][0]['message']['text']
-                            logger.info(f"✅ Модель {model} РАБОТАЕТ! Ответ: {answer}")
-                            return answer
-                        else:
-                            logger.warning(f"❌ Модель {model} тоже не работает: {response.status}")
-                            continue
+                session = get_http_session()
+                timeout = aiohttp.ClientTimeout(total=config.AI_REQUEST_TIMEOUT, connect=config.AI_CONNECT_TIMEOUT)
+                async with session.post(
+                    getattr(config, "YANDEX_URL"), headers=headers, json=data, timeout=timeout
+                ) as response:
+                    
+                    if response.status == 200:
+                        result = await response.json()
+                        answer = result['result']['alternatives'][0]['message']['text']
+                        logger.info(f"✅ Модель {model} РАБОТАЕТ! Ответ: {answer}")
+                        return answer
+                    else:
+                        logger.warning(f"❌ Модель {model} тоже не работает: {response.status}")
+                        continue
                             
             except Exception as e:
                 logger.warning(f"❌ Модель {model} ошибка: {e}")
@@ -159,56 +317,90 @@ class AIClient:
         # Если все модели не работают
         raise Exception("Все модели Yandex GPT возвращают ошибку")
 
-    async def _retry_with_simple_prompt(self, messages: List[dict]) -> str:
-        """Альтернативный метод для обхода 500 ошибки"""
-        logger.info("🔄 Yandex GPT: пробуем упрощенный запрос...")
-        
-        # Находим последнее пользовательское сообщение
-        last_user_message = ""
-        for msg in reversed(messages):
-            role = msg.get("role") or "user"
-            if role == "user":
-                last_user_message = msg.get("content") or msg.get("text") or ""
-                break
-        
-        if not last_user_message:
-            last_user_message = "Привет"
-        
-        simple_messages = [{"role": "user", "text": last_user_message}]
-        
-        headers = {
-            "Authorization": f"Api-Key {config.YANDEX_API_KEY}",
-            "Content-Type": "application/json"
-        }
-        
+    async def _openai_chat(self, messages: List[dict], max_tokens: int = None, temperature: float = None,
+                           model: Optional[str] = None, base_url: Optional[str] = None) -> Optional[str]:
+        """OpenAI-совместимый Chat Completions API (OpenAI, llama.cpp server, vLLM и т.п.)
+
+        Адрес задается OPENAI_BASE_URL, поэтому тот же код работает с локальным
+        сервером без сети. При OPENAI_STREAM ответ читается потоком (SSE), и
+        таймаут считается между чанками, а не на весь ответ.
+        """
+        model = model or config.OPENAI_CHAT_MODEL
+        url = f"{(base_url or config.OPENAI_BASE_URL).rstrip('/')}/chat/completions"
+        logger.info(f"🔧 OpenAI: запрос к {url}, модель {model}")
+
+        headers = {"Content-Type": "application/json"}
+        if config.OPENAI_API_KEY:
+            headers["Authorization"] = f"Bearer {config.OPENAI_API_KEY}"
+
         data = {
-            "modelUri": f"gpt://{config.YANDEX_FOLDER_ID}/{getattr(config, 'YANDEX_MODEL', 'yandexgpt')}",  # Используем yandexgpt по умолчанию
-            "completionOptions": {
-                "stream": False,
-                "temperature": 0.7,
-                "maxTokens": 200
-            },
-            "messages": simple_messages
+            "model": model,
+            "messages": [
+                {"role": msg.get("role") or "user", "content": msg.get("content") or msg.get("text") or ""}
+                for msg in messages
+            ],
+            "temperature": temperature or getattr(config, "AI_TEMPERATURE", 0.7),
+            "max_tokens": max_tokens or getattr(config, "AI_MAX_TOKENS", 800),
+            "stream": config.OPENAI_STREAM
         }
-        
+        if config.OPENAI_STREAM:
+            # Последний чанк потока содержит usage
+            data["stream_options"] = {"include_usage": True}
+
+        session = get_http_session()
+        if config.OPENAI_STREAM:
+            timeout = aiohttp.ClientTimeout(
+                total=None, connect=config.AI_CONNECT_TIMEOUT, sock_read=config.AI_REQUEST_TIMEOUT
+            )
+        else:
+            timeout = aiohttp.ClientTimeout(total=config.AI_REQUEST_TIMEOUT, connect=config.AI_CONNECT_TIMEOUT)
+
         try:
-            async with aiohttp.ClientSession() as session:
-                timeout = aiohttp.ClientTimeout(total=30)
-                async with session.post(getattr(config, "YANDEX_URL"), headers=headers, json=data, timeout=timeout) as response:
-                    if response.status == 200:
-                        result = await response.json()
-                        return result['result']['alternatives'][0]['message']['text']
-                    else:
-                        raise Exception(f"Retry failed: {response.status}")
-        except Exception as e:
-            logger.error(f"❌ Yandex GPT retry failed: {e}")
+            async with session.post(url, headers=headers, json=data, timeout=timeout) as response:
+                if response.status != 200:
+                    error_text = await response.text()
+                    logger.error(f"❌ OpenAI API ошибка: {response.status} - {error_text}")
+                    raise AIProviderError(f"OpenAI API error: {response.status} - {error_text}", status=response.status)
+
+                if config.OPENAI_STREAM:
+                    answer, usage = await self._read_openai_stream(response)
+                else:
+                    result = await response.json()
+                    answer = result['choices'][0]['message']['content']
+                    usage = result.get('usage')
+
+            self._record_usage(model, usage, 'prompt_tokens', 'completion_tokens', messages, answer)
+
+            logger.info(f"✅ OpenAI: успешный ответ: {(answer or '')[:100]}...")
+            return answer
+
+        except AIProviderError:
+            raise
+        except aiohttp.ClientError as e:
+            logger.error(f"❌ OpenAI: ошибка сети: {e}")
+            raise
+        except asyncio.TimeoutError:
+            logger.error("❌ OpenAI: таймаут запроса")
             raise
 
-    async def _openai_chat(self, messages: List[dict], max_tokens: int = None, temperature: float = None) -> Optional[str]:
-        """OpenAI GPT (резервный вариант) — заглушка"""
-        logger.info("🔧 OpenAI: вызывается заглушка (не реализовано)")
-        # Реализация для OpenAI может быть добавлена здесь при необходимости.
-        return None
+    async def _read_openai_stream(self, response: aiohttp.ClientResponse) -> Tuple[str, Optional[dict]]:
+        """Сборка ответа и usage из потока server-sent events"""
+        parts = []
+        usage = None
+        async for raw_line in response.content:
+            line = raw_line.decode("utf-8").strip()
+            if not line.startswith("data:"):
+                continue
+            payload = line[len("data:"):].strip()
+            if payload == "[DONE]":
+                break
+            chunk = json.loads(payload)
+            usage = chunk.get("usage") or usage
+            for choice in chunk.get("choices", []):
+                delta = choice.get("delta") or {}
+                if delta.get("content"):
+                    parts.append(delta["content"])
+        return "".join(parts), usage
 
     async def _local_fallback(self, messages: List[dict]) -> str:
         """Локальная заглушка когда API недоступны"""
@@ -220,5 +412,5 @@ class AIClient:
                 last = msg.get("content") or msg.get("text") or ""
                 break
         if not last:
-            return "🤖 Локальный fallback: нет входных сообщений."
-        return f"🤖 Локальный fallback ответ на: '{last[:200]}'"
\ No newline at end of file
+            return f"{LOCAL_FALLBACK_PREFIX}: нет входных сообщений."
+        return f"{LOCAL_FALLBACK_PREFIX} ответ на: '{last[:200]}'"
\ No newline at end of file
@@ -0,0 +1,88 @@
+import logging
+from collections import deque
+from typing import Deque, Dict
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+
+class HedgeController:
+    """Решает, когда отправлять дублирующий (hedged) запрос
+
+    Порог ожидания - заданный перцентиль недавних задержек основной модели.
+    Бюджет ограничивает долю дублирующих запросов: каждый основной запрос
+    добавляет budget_ratio "жетона", каждый дубль тратит один жетон.
+    """
+
+    def __init__(self, percentile: float = 0.95, budget_ratio: float = 0.1,
+                 default_delay: float = 3.0, min_delay: float = 0.5,
+                 window: int = 200, min_samples: int = 20, max_tokens: float = 10.0):
+        self.percentile = percentile
+        self.budget_ratio = budget_ratio
+        self.default_delay = default_delay
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.max_tokens = max_tokens
+        self._latencies: Dict[str, Deque[float]] = {}
+        self._window = window
+        self._tokens = 0.0
+        self.primary_requests = 0
+        self.hedges_sent = 0
+        self.hedges_won = 0
+
+    def record_latency(self, model: str, latency: float):
+        """Учет задержки ответа модели (для отмененного запроса - времени до отмены)"""
+        self._latencies.setdefault(model, deque(maxlen=self._window)).append(latency)
+
+    def get_delay(self, model: str) -> float:
+        """Сколько ждать основную модель перед отправкой дубля"""
+        samples = self._latencies.get(model)
+        if not samples or len(samples) < self.min_samples:
+            return self.default_delay
+        ordered = sorted(samples)
+        index = min(len(ordered) - 1, int(self.percentile * len(ordered)))
+        return max(self.min_delay, ordered[index])
+
+    def on_primary_request(self):
+        self.primary_requests += 1
+        self._tokens = min(self.max_tokens, self._tokens + self.budget_ratio)
+
+    def try_acquire_hedge(self) -> bool:
+        """Списать жетон на дублирующий запрос, если бюджет позволяет"""
+        if self._tokens >= 1.0:
+            self._tokens -= 1.0
+            self.hedges_sent += 1
+            return True
+        return False
+
+    def on_hedge_won(self):
+        self.hedges_won += 1
+
+    def get_stats(self) -> Dict:
+        return {
+            'primary_requests': self.primary_requests,
+            'hedges_sent': self.hedges_sent,
+            'hedges_won': self.hedges_won,
+            'budget_tokens': round(self._tokens, 2),
+            'delays': {model: round(self.get_delay(model), 3) for model in self._latencies},
+        }
+
+    def format_stats(self) -> str:
+        """Статистика дублирования в читаемом формате"""
+        stats = self.get_stats()
+        delays = ", ".join(f"{model}: {delay:.2f}с" for model, delay in stats['delays'].items()) or "нет данных"
+        return (
+            "🔀 **Дублирование запросов:**\n"
+            f"• Запросов: {stats['primary_requests']}, дублей: {stats['hedges_sent']}, "
+            f"дубль ответил первым: {stats['hedges_won']}\n"
+            f"• Порог ожидания: {delays}"
+        )
+
+
+# Общий контроллер для всех экземпляров AIClient
+hedge_controller = HedgeController(
+    percentile=config.AI_HEDGE_PERCENTILE,
+    budget_ratio=config.AI_HEDGE_BUDGET_RATIO,
+    default_delay=config.AI_HEDGE_DEFAULT_DELAY
+)
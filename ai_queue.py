@@ -0,0 +1,186 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict, deque
+from enum import IntEnum
+from typing import Awaitable, Callable, Deque, Dict, Optional, TypeVar
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+
+class AIPriority(IntEnum):
+    """Классы приоритета запросов к AI (меньше значение - выше приоритет)"""
+    INTERACTIVE = 0  # команды пользователей: /ask, /gpt, /summary ...
+    BACKGROUND = 1   # ежедневные суммаризации, фоновые дайджесты
+    BULK = 2         # массовая постобработка (OCR, предрасчеты)
+
+
+class _Waiter:
+    """Запрос, ожидающий свободный слот"""
+
+    __slots__ = ("future", "chat_key", "priority", "enqueued_at")
+
+    def __init__(self, future: asyncio.Future, chat_key, priority: AIPriority):
+        self.future = future
+        self.chat_key = chat_key
+        self.priority = priority
+        self.enqueued_at = time.monotonic()
+
+
+class AIRequestQueue:
+    """Приоритетная очередь перед AI провайдером
+
+    Ограничивает число одновременных запросов к провайдеру. Свободный слот
+    получает запрос с самым высоким приоритетом, а внутри одного класса
+    приоритета чаты обслуживаются по кругу (round-robin), поэтому один
+    активный чат не может занять очередь целиком.
+    """
+
+    def __init__(self, max_concurrent: int = 4, wait_samples: int = 500):
+        self.max_concurrent = max(1, max_concurrent)
+        self._active = 0
+        # priority -> chat_key -> очередь ожидающих
+        self._queues: Dict[AIPriority, "OrderedDict[object, Deque[_Waiter]]"] = {
+            priority: OrderedDict() for priority in AIPriority
+        }
+        self._wait_samples: Dict[AIPriority, Deque[float]] = {
+            priority: deque(maxlen=wait_samples) for priority in AIPriority
+        }
+        self._served: Dict[AIPriority, int] = {priority: 0 for priority in AIPriority}
+        self._max_wait: Dict[AIPriority, float] = {priority: 0.0 for priority in AIPriority}
+
+    async def run(self, func: Callable[[], Awaitable[T]],
+                  priority: AIPriority = AIPriority.INTERACTIVE,
+                  chat_id: Optional[int] = None) -> T:
+        """Выполнить корутину, когда до нее дойдет очередь"""
+        await self.acquire(priority, chat_id)
+        try:
+            return await func()
+        finally:
+            self.release()
+
+    async def acquire(self, priority: AIPriority = AIPriority.INTERACTIVE,
+                      chat_id: Optional[int] = None):
+        """Занять слот (с ожиданием в очереди, если все слоты заняты)"""
+        priority = AIPriority(priority)
+        chat_key = chat_id if chat_id is not None else "global"
+
+        if self._active < self.max_concurrent and not self._has_waiters():
+            self._active += 1
+            self._record_wait(priority, 0.0)
+            return
+
+        waiter = _Waiter(asyncio.get_running_loop().create_future(), chat_key, priority)
+        self._queues[priority].setdefault(chat_key, deque()).append(waiter)
+
+        try:
+            await waiter.future
+        except asyncio.CancelledError:
+            if waiter.future.done() and not waiter.future.cancelled():
+                # Слот уже был выдан, но запрос отменили - возвращаем слот
+                self.release()
+            else:
+                self._remove_waiter(waiter)
+            raise
+
+        self._record_wait(priority, time.monotonic() - waiter.enqueued_at)
+
+    def release(self):
+        """Освободить слот и передать его следующему запросу"""
+        self._active = max(0, self._active - 1)
+        self._dispatch()
+
+    def _dispatch(self):
+        """Выдача свободных слотов ожидающим запросам"""
+        while self._active < self.max_concurrent:
+            waiter = self._pop_next_waiter()
+            if waiter is None:
+                return
+            if waiter.future.done():
+                continue
+            self._active += 1
+            waiter.future.set_result(True)
+
+    def _pop_next_waiter(self) -> Optional[_Waiter]:
+        """Следующий запрос: высший приоритет, внутри класса - по кругу между чатами"""
+        for priority in AIPriority:
+            chats = self._queues[priority]
+            while chats:
+                chat_key, waiters = chats.popitem(last=False)
+                if not waiters:
+                    continue
+                waiter = waiters.popleft()
+                if waiters:
+                    # Чат уходит в конец круга
+                    chats[chat_key] = waiters
+                return waiter
+        return None
+
+    def _remove_waiter(self, waiter: _Waiter):
+        """Удаление отмененного запроса из очереди"""
+        chats = self._queues[waiter.priority]
+        waiters = chats.get(waiter.chat_key)
+        if not waiters:
+            return
+        try:
+            waiters.remove(waiter)
+        except ValueError:
+            pass
+        if not waiters:
+            chats.pop(waiter.chat_key, None)
+
+    def _has_waiters(self) -> bool:
+        return any(chats for chats in self._queues.values())
+
+    def _record_wait(self, priority: AIPriority, wait: float):
+        self._wait_samples[priority].append(wait)
+        self._served[priority] += 1
+        self._max_wait[priority] = max(self._max_wait[priority], wait)
+        if wait > 5:
+            logger.warning(f"⏳ AI очередь: запрос {priority.name} ждал {wait:.1f}с")
+
+    def get_metrics(self) -> Dict:
+        """Метрики очереди: глубина и время ожидания по классам приоритета"""
+        classes = {}
+        for priority in AIPriority:
+            chats = self._queues[priority]
+            samples = sorted(self._wait_samples[priority])
+            classes[priority.name.lower()] = {
+                'depth': sum(len(waiters) for waiters in chats.values()),
+                'waiting_chats': len(chats),
+                'served': self._served[priority],
+                'avg_wait': sum(samples) / len(samples) if samples else 0.0,
+                'p95_wait': samples[int(0.95 * (len(samples) - 1))] if samples else 0.0,
+                'max_wait': self._max_wait[priority],
+            }
+
+        return {
+            'active': self._active,
+            'max_concurrent': self.max_concurrent,
+            'depth': sum(item['depth'] for item in classes.values()),
+            'classes': classes,
+        }
+
+    def format_metrics(self) -> str:
+        """Метрики очереди в читаемом формате"""
+        metrics = self.get_metrics()
+        lines = [
+            "📥 **Очередь AI запросов:**\n",
+            f"• Активных запросов: {metrics['active']}/{metrics['max_concurrent']}",
+            f"• В очереди: {metrics['depth']}",
+        ]
+        for name, item in metrics['classes'].items():
+            lines.append(
+                f"• {name}: ждут {item['depth']} (чатов: {item['waiting_chats']}), "
+                f"обслужено {item['served']}, ожидание avg {item['avg_wait']:.2f}с / "
+                f"p95 {item['p95_wait']:.2f}с / max {item['max_wait']:.2f}с"
+            )
+        return "\n".join(lines)
+
+
+# Общая очередь для всех экземпляров AIClient
+request_queue = AIRequestQueue(max_concurrent=config.AI_MAX_CONCURRENT_REQUESTS)
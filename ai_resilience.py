@@ -0,0 +1,205 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Awaitable, Callable, Dict, Optional, TypeVar
+
+import aiohttp
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# HTTP статусы, при которых повтор запроса имеет смысл
+RETRYABLE_STATUSES = {408, 409, 425, 429, 500, 502, 503, 504}
+# Ключ или права доступа: провайдер не обслужит ни один запрос, пока это не исправят
+AUTH_STATUSES = {401, 403}
+
+
+class AIProviderError(Exception):
+    """Ошибка ответа AI провайдера"""
+
+    def __init__(self, message: str, status: Optional[int] = None, retryable: Optional[bool] = None):
+        super().__init__(message)
+        self.status = status
+        self.retryable = retryable if retryable is not None else status in RETRYABLE_STATUSES
+
+
+class CircuitOpenError(Exception):
+    """Провайдер временно отключен автоматическим выключателем"""
+
+
+def is_retryable_error(error: Exception) -> bool:
+    """Классификация ошибки: можно ли повторить запрос"""
+    if isinstance(error, AIProviderError):
+        return error.retryable
+    if isinstance(error, asyncio.TimeoutError):
+        return True
+    if isinstance(error, aiohttp.ClientResponseError):
+        return error.status in RETRYABLE_STATUSES
+    if isinstance(error, aiohttp.ClientError):
+        # Ошибки соединения, разрыв, DNS и т.п.
+        return True
+    return False
+
+
+def is_client_error(error: Exception) -> bool:
+    """Ошибка конкретного запроса (HTTP 4xx): провайдер отвечает и исправен"""
+    if isinstance(error, AIProviderError) and error.status is not None:
+        status = error.status
+    elif isinstance(error, aiohttp.ClientResponseError):
+        status = error.status
+    else:
+        return False
+    return 400 <= status < 500 and status not in AUTH_STATUSES and status not in RETRYABLE_STATUSES
+
+
+class RetryPolicy:
+    """Политика повторов: экспоненциальная задержка с полным джиттером"""
+
+    def __init__(self, max_attempts: int = 3, base_delay: float = 0.5, max_delay: float = 8.0):
+        self.max_attempts = max(1, max_attempts)
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def get_delay(self, attempt: int) -> float:
+        """Задержка перед повтором номер attempt (начиная с 1)"""
+        ceiling = min(self.max_delay, self.base_delay * (2 ** (attempt - 1)))
+        return random.uniform(0, ceiling)
+
+
+class CircuitBreaker:
+    """Автоматический выключатель для провайдера
+
+    closed    - запросы идут как обычно, считаем подряд идущие ошибки;
+    open      - провайдер считается недоступным, запросы сразу отклоняются;
+    half_open - после паузы пропускаем пробные запросы: успех закрывает
+                выключатель, ошибка снова открывает его.
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name: str, failure_threshold: int = 5,
+                 recovery_timeout: float = 30.0, half_open_max_calls: int = 1):
+        self.name = name
+        self.failure_threshold = max(1, failure_threshold)
+        self.recovery_timeout = recovery_timeout
+        self.half_open_max_calls = max(1, half_open_max_calls)
+        self._state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._half_open_calls = 0
+
+    @property
+    def state(self) -> str:
+        if self._state == self.OPEN and time.monotonic() - self._opened_at >= self.recovery_timeout:
+            self._state = self.HALF_OPEN
+            self._half_open_calls = 0
+            logger.info(f"🟡 Circuit breaker {self.name}: half-open, пробуем провайдер")
+        return self._state
+
+    def allow_request(self) -> bool:
+        """Можно ли отправить запрос провайдеру"""
+        state = self.state
+        if state == self.CLOSED:
+            return True
+        if state == self.HALF_OPEN and self._half_open_calls < self.half_open_max_calls:
+            self._half_open_calls += 1
+            return True
+        return False
+
+    def release_probe(self):
+        """Вернуть место пробного запроса, завершившегося без результата (отмена)"""
+        if self._state == self.HALF_OPEN and self._half_open_calls > 0:
+            self._half_open_calls -= 1
+
+    def record_success(self):
+        if self._state != self.CLOSED:
+            logger.info(f"🟢 Circuit breaker {self.name}: провайдер снова доступен")
+        self._state = self.CLOSED
+        self._failures = 0
+        self._half_open_calls = 0
+
+    def record_failure(self):
+        self._failures += 1
+        if self._state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+            if self._state != self.OPEN:
+                logger.warning(
+                    f"🔴 Circuit breaker {self.name}: открыт после {self._failures} ошибок "
+                    f"на {self.recovery_timeout:.0f}с"
+                )
+            self._state = self.OPEN
+            self._opened_at = time.monotonic()
+            self._half_open_calls = 0
+
+    def get_status(self) -> Dict:
+        return {
+            'name': self.name,
+            'state': self.state,
+            'failures': self._failures,
+        }
+
+
+async def call_with_retry(func: Callable[[], Awaitable[T]], policy: RetryPolicy,
+                          breaker: Optional[CircuitBreaker] = None) -> T:
+    """Вызов с повторами для временных ошибок и учетом выключателя"""
+    attempt = 0
+    while True:
+        attempt += 1
+        probe = bool(breaker) and breaker.state == CircuitBreaker.HALF_OPEN
+        if breaker and not breaker.allow_request():
+            raise CircuitOpenError(f"Провайдер {breaker.name} временно недоступен")
+
+        try:
+            result = await func()
+        except asyncio.CancelledError:
+            # Отмененный пробный запрос ничего не говорит о провайдере,
+            # но место пробы нужно освободить, иначе выключатель застрянет в half-open
+            if probe:
+                breaker.release_probe()
+            raise
+        except Exception as e:
+            retryable = is_retryable_error(e)
+            if breaker:
+                # Ошибки запроса (400, 404 ...) означают, что провайдер отвечает;
+                # отсутствующий ключ или каталог, 401/403 и прочие сбои - отказ провайдера
+                if is_client_error(e):
+                    breaker.record_success()
+                else:
+                    breaker.record_failure()
+            if not retryable or attempt >= policy.max_attempts:
+                raise
+            delay = policy.get_delay(attempt)
+            logger.warning(f"🔄 Попытка {attempt}/{policy.max_attempts} не удалась ({e}), повтор через {delay:.2f}с")
+            await asyncio.sleep(delay)
+            continue
+
+        if breaker:
+            breaker.record_success()
+        return result
+
+
+_breakers: Dict[str, CircuitBreaker] = {}
+
+
+def get_circuit_breaker(name: str) -> CircuitBreaker:
+    """Общий выключатель для провайдера (один на процесс)"""
+    if name not in _breakers:
+        _breakers[name] = CircuitBreaker(
+            name,
+            failure_threshold=config.AI_CIRCUIT_FAILURE_THRESHOLD,
+            recovery_timeout=config.AI_CIRCUIT_RECOVERY_TIMEOUT
+        )
+    return _breakers[name]
+
+
+def get_default_retry_policy() -> RetryPolicy:
+    return RetryPolicy(
+        max_attempts=config.AI_RETRY_MAX_ATTEMPTS,
+        base_delay=config.AI_RETRY_BASE_DELAY,
+        max_delay=config.AI_RETRY_MAX_DELAY
+    )
@@ -0,0 +1,161 @@
+import json
+import logging
+import time
+from typing import Dict, List, Optional
+
+from config import config
+from ai_resilience import CircuitBreaker, get_circuit_breaker
+
+logger = logging.getLogger(__name__)
+
+
+class AIBackend:
+    """Один AI бэкенд: провайдер + модель + живая статистика"""
+
+    def __init__(self, name: str, provider: str, model: str = "", base_url: str = "",
+                 tier: str = "fast", cost: float = 0.0):
+        self.name = name
+        self.provider = provider  # yandex, openai, local
+        self.model = model
+        self.base_url = base_url
+        self.tier = tier  # fast, strong
+        self.cost = cost  # условная стоимость 1000 токенов
+        self.ewma_latency: Optional[float] = None
+        self.ewma_error_rate = 0.0
+        self._error_updated_at = time.monotonic()
+        self.requests = 0
+        self.failures = 0
+
+    @property
+    def error_rate(self) -> float:
+        """Доля ошибок, затухающая со временем, чтобы бэкенд после сбоя снова получал запросы"""
+        elapsed = time.monotonic() - self._error_updated_at
+        return self.ewma_error_rate * 0.5 ** (elapsed / config.AI_ROUTER_ERROR_HALF_LIFE)
+
+    @property
+    def breaker(self) -> CircuitBreaker:
+        return get_circuit_breaker(self.name)
+
+    def record_success(self, latency: float, alpha: float):
+        self.requests += 1
+        if self.ewma_latency is None:
+            self.ewma_latency = latency
+        else:
+            self.ewma_latency = alpha * latency + (1 - alpha) * self.ewma_latency
+        self.ewma_error_rate = (1 - alpha) * self.error_rate
+        self._error_updated_at = time.monotonic()
+
+    def record_failure(self, alpha: float):
+        self.requests += 1
+        self.failures += 1
+        self.ewma_error_rate = alpha + (1 - alpha) * self.error_rate
+        self._error_updated_at = time.monotonic()
+
+    def get_status(self) -> Dict:
+        return {
+            'name': self.name,
+            'tier': self.tier,
+            'state': self.breaker.state,
+            'latency': self.ewma_latency,
+            'error_rate': self.error_rate,
+            'requests': self.requests,
+        }
+
+
+class AIRouter:
+    """Маршрутизация запросов между несколькими AI бэкендами
+
+    Для каждого запроса бэкенды ранжируются по оценке: сглаженная (EWMA)
+    задержка, доля ошибок, стоимость и соответствие уровня модели команде
+    (быстрые дешевые модели для /brief, сильные - для /opinion). Бэкенды с
+    открытым выключателем пропускаются, при ошибке запрос уходит следующему.
+    """
+
+    def __init__(self, backends: List[AIBackend]):
+        self.backends = backends
+        self.alpha = config.AI_ROUTER_EWMA_ALPHA
+
+    def route(self, command: Optional[str] = None) -> List[AIBackend]:
+        """Бэкенды в порядке предпочтения для команды"""
+        wanted_tier = config.AI_COMMAND_TIERS.get(command or "", "fast")
+        available = [backend for backend in self.backends if backend.breaker.state != CircuitBreaker.OPEN]
+        return sorted(available, key=lambda backend: self._score(backend, wanted_tier))
+
+    def _score(self, backend: AIBackend, wanted_tier: str) -> float:
+        """Чем меньше, тем лучше"""
+        if backend.provider == "local":
+            # Локальная заглушка - только последний вариант
+            return float("inf")
+        latency = backend.ewma_latency if backend.ewma_latency is not None else config.AI_ROUTER_DEFAULT_LATENCY
+        score = (
+            latency
+            + backend.error_rate * config.AI_ROUTER_ERROR_PENALTY
+            + backend.cost * config.AI_ROUTER_COST_WEIGHT
+        )
+        if backend.tier != wanted_tier:
+            score += config.AI_ROUTER_TIER_PENALTY
+        return score
+
+    def record_success(self, backend: AIBackend, latency: float):
+        backend.record_success(latency, self.alpha)
+
+    def record_failure(self, backend: AIBackend):
+        backend.record_failure(self.alpha)
+
+    def format_status(self) -> str:
+        """Состояние бэкендов в читаемом формате"""
+        icons = {CircuitBreaker.CLOSED: "🟢", CircuitBreaker.HALF_OPEN: "🟡", CircuitBreaker.OPEN: "🔴"}
+        lines = ["🧭 **AI бэкенды:**"]
+        for backend in self.backends:
+            status = backend.get_status()
+            latency = f"{status['latency']:.2f}с" if status['latency'] is not None else "—"
+            lines.append(
+                f"• {icons[status['state']]} {status['name']} ({status['tier']}): "
+                f"задержка {latency}, ошибки {status['error_rate']:.0%}, запросов {status['requests']}"
+            )
+        return "\n".join(lines)
+
+
+def build_backends() -> List[AIBackend]:
+    """Список бэкендов из AI_BACKENDS (JSON) или из настроек провайдеров"""
+    if config.AI_BACKENDS:
+        try:
+            return [AIBackend(**item) for item in json.loads(config.AI_BACKENDS)]
+        except (ValueError, TypeError) as e:
+            logger.error(f"❌ Некорректный AI_BACKENDS, используем настройки по умолчанию: {e}")
+
+    backends = []
+    if config.YANDEX_API_KEY and config.YANDEX_FOLDER_ID:
+        backends.append(AIBackend("yandex:yandexgpt-lite", "yandex", "yandexgpt-lite", tier="fast", cost=0.2))
+        backends.append(AIBackend("yandex:yandexgpt", "yandex", "yandexgpt", tier="strong", cost=1.2))
+    if config.OPENAI_API_KEY or "api.openai.com" not in config.OPENAI_BASE_URL:
+        backends.append(AIBackend(
+            f"openai:{config.OPENAI_CHAT_MODEL}", "openai", config.OPENAI_CHAT_MODEL,
+            base_url=config.OPENAI_BASE_URL, tier="strong", cost=1.0
+        ))
+    backends.append(AIBackend("local", "local", tier="fast"))
+    return backends
+
+
+def get_default_backend() -> AIBackend:
+    """Единственный бэкенд по AI_PROVIDER (когда маршрутизация выключена)"""
+    if config.AI_PROVIDER == "yandex":
+        return AIBackend("yandex", "yandex", getattr(config, 'YANDEX_MODEL', 'yandexgpt'))
+    if config.AI_PROVIDER == "openai":
+        return AIBackend("openai", "openai", config.OPENAI_CHAT_MODEL, base_url=config.OPENAI_BASE_URL)
+    return AIBackend("local", "local")
+
+
+_router: Optional[AIRouter] = None
+
+
+def get_router() -> AIRouter:
+    """Общий маршрутизатор для всех экземпляров AIClient"""
+    global _router
+    if _router is None:
+        if config.AI_ROUTING_ENABLED:
+            _router = AIRouter(build_backends())
+        else:
+            _router = AIRouter([get_default_backend()])
+        logger.info(f"🧭 AI маршрутизатор: {', '.join(backend.name for backend in _router.backends)}")
+    return _router
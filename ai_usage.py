@@ -0,0 +1,141 @@
+import contextvars
+import logging
+import time
+from collections import deque
+from datetime import datetime
+from typing import Deque, Dict, List, Optional, Tuple
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+
+class AICallStats:
+    """Данные одного вызова AI, которые заполняются по мере его выполнения"""
+
+    def __init__(self, command: Optional[str] = None, chat_id: Optional[int] = None):
+        self.command = command or ""
+        self.chat_id = chat_id
+        self.provider = ""
+        self.model = ""
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.attempts = 0
+        self.cache_hit = False
+
+    def set_usage(self, prompt_tokens, completion_tokens):
+        # Yandex возвращает количество токенов строками
+        self.prompt_tokens = int(prompt_tokens or 0)
+        self.completion_tokens = int(completion_tokens or 0)
+
+
+# Статистика текущего вызова: провайдеры заполняют ее без изменения сигнатур
+current_call: contextvars.ContextVar[Optional[AICallStats]] = contextvars.ContextVar("current_ai_call", default=None)
+
+
+def get_current_call() -> Optional[AICallStats]:
+    return current_call.get()
+
+
+class _Aggregate:
+    """Накопленная статистика по команде или модели"""
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.cache_hits = 0
+        self.retries = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.latencies: Deque[float] = deque(maxlen=500)
+
+    def add(self, stats: AICallStats, latency: float, success: bool):
+        self.calls += 1
+        self.errors += 0 if success else 1
+        self.cache_hits += 1 if stats.cache_hit else 0
+        self.retries += max(0, stats.attempts - 1)
+        self.prompt_tokens += stats.prompt_tokens
+        self.completion_tokens += stats.completion_tokens
+        self.latencies.append(latency)
+
+    def percentile(self, q: float) -> float:
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class UsageTracker:
+    """Учет использования и задержек AI вызовов
+
+    Каждый вызов дает одну запись (провайдер, модель, токены, задержка,
+    попадание в кэш, повторы). Записи агрегируются в памяти и пачками
+    сохраняются в таблицу ai_usage.
+    """
+
+    def __init__(self):
+        self.db = None
+        self.by_command: Dict[str, _Aggregate] = {}
+        self.by_model: Dict[str, _Aggregate] = {}
+        self._pending: List[Tuple] = []
+        self._last_flush = time.monotonic()
+
+    def attach(self, db):
+        self.db = db
+
+    def record(self, stats: AICallStats, latency: float, success: bool = True):
+        """Учет завершенного вызова"""
+        try:
+            model_key = f"{stats.provider}:{stats.model}" if stats.model else stats.provider or "unknown"
+            self.by_command.setdefault(stats.command or "other", _Aggregate()).add(stats, latency, success)
+            self.by_model.setdefault(model_key, _Aggregate()).add(stats, latency, success)
+
+            self._pending.append((
+                datetime.now().isoformat(sep=' ', timespec='seconds'),
+                stats.chat_id, stats.command, stats.provider, stats.model,
+                stats.prompt_tokens, stats.completion_tokens, int(latency * 1000),
+                stats.cache_hit, max(0, stats.attempts - 1), success
+            ))
+            if (len(self._pending) >= config.AI_USAGE_FLUSH_SIZE
+                    or time.monotonic() - self._last_flush >= config.AI_USAGE_FLUSH_INTERVAL):
+                self.flush()
+        except Exception as e:
+            # Учет не должен ломать ответ пользователю
+            logger.error(f"Error recording AI usage: {e}")
+
+    def record_cache_hit(self, command: str, chat_id: Optional[int] = None):
+        """Учет ответа из кэша вместо вызова AI"""
+        stats = AICallStats(command, chat_id)
+        stats.provider = "cache"
+        stats.cache_hit = True
+        self.record(stats, 0.0)
+
+    def flush(self):
+        """Сохранение накопленных записей в базу"""
+        self._last_flush = time.monotonic()
+        if not self.db or not self._pending:
+            return
+        rows, self._pending = self._pending, []
+        if not self.db.save_ai_usage(rows):
+            # Не теряем записи при временной ошибке, но и не копим бесконечно
+            self._pending = rows[-config.AI_USAGE_MAX_PENDING:] + self._pending
+
+    def format_stats(self) -> str:
+        """Статистика с момента запуска в читаемом формате"""
+        if not self.by_command:
+            return "📈 **AI вызовы с запуска:** пока нет"
+
+        lines = ["📈 **AI вызовы с запуска:**"]
+        for title, groups in (("По командам", self.by_command), ("По моделям", self.by_model)):
+            lines.append(f"\n{title}:")
+            for name, agg in sorted(groups.items(), key=lambda item: -item[1].calls):
+                lines.append(
+                    f"• {name}: {agg.calls} вызовов, токены {agg.prompt_tokens}+{agg.completion_tokens}, "
+                    f"p50 {agg.percentile(0.5):.2f}с, p95 {agg.percentile(0.95):.2f}с, "
+                    f"ошибок {agg.errors}, повторов {agg.retries}, кэш {agg.cache_hits}"
+                )
+        return "\n".join(lines)
+
+
+# Общий учет для всех экземпляров AIClient
+usage_tracker = UsageTracker()
@@ -0,0 +1,236 @@
+import logging
+import re
+import time
+import zlib
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+from config import config
+from token_budget import tokenize
+from topics import STOP_WORDS, stem
+
+logger = logging.getLogger(__name__)
+
+SCOPE_GPT = "gpt"  # общий для всех чатов
+SCOPE_ASK = "ask"  # отдельно для каждого чата
+
+# Слова с цифрами или латиницей (python, 2024, iphone) должны совпадать точно
+EXACT_TERM_RE = re.compile(r"[0-9a-z]")
+
+# Служебные слова, которые меняют смысл вопроса ("с духовкой" и "без духовки",
+# "когда" и "почему"): для похожего вопроса они тоже должны совпадать
+MEANINGFUL_STOP_WORDS = {
+    "без", "нет", "not", "для", "над", "под", "перед", "после", "через", "при", "про",
+    "где", "зачем", "когда", "кто", "почему", "чем", "что",
+}
+
+
+def normalize_question(text: str) -> str:
+    """Ключ точного совпадения: слова в нижнем регистре без пунктуации"""
+    return " ".join(tokenize(text.replace("ё", "е").replace("Ё", "Е")))
+
+
+def _content_words(normalized: str) -> List[str]:
+    return [word for word in normalized.split() if word not in STOP_WORDS]
+
+
+def embed_question(normalized: str) -> np.ndarray:
+    """Локальный вектор вопроса: основы значимых слов и их символьные триграммы
+
+    Признаки хэшируются в ANSWER_CACHE_VECTOR_DIM измерений (feature hashing),
+    вектор нормируется, поэтому близость - скалярное произведение.
+    """
+    vector = np.zeros(config.ANSWER_CACHE_VECTOR_DIM, dtype=np.float32)
+    for word in _content_words(normalized):
+        features = [(f"w:{stem(word)}", 1.0)]
+        padded = f" {word} "
+        features.extend((f"t:{padded[i:i + 3]}", 0.3) for i in range(len(padded) - 2))
+        for feature, weight in features:
+            bucket = zlib.crc32(feature.encode("utf-8"))
+            sign = 1.0 if bucket & 0x80000000 else -1.0
+            vector[bucket % config.ANSWER_CACHE_VECTOR_DIM] += sign * weight
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm > 0 else vector
+
+
+def _exact_terms(normalized: str) -> Set[str]:
+    return {word for word in normalized.split() if EXACT_TERM_RE.search(word)}
+
+
+def _key_terms(normalized: str) -> Set[str]:
+    """Основы значимых слов и меняющие смысл служебные слова вопроса"""
+    words = normalized.split()
+    terms = {stem(word) for word in _content_words(normalized)}
+    terms.update(word for word in words if word in MEANINGFUL_STOP_WORDS)
+    return terms
+
+
+class CachedAnswer:
+    """Сохраненный ответ и данные для проверки его актуальности"""
+
+    def __init__(self, question: str, normalized: str, answer: str, meta: Optional[Dict] = None):
+        self.question = question
+        self.normalized = normalized
+        self.answer = answer
+        self.meta = meta or {}
+        self.created_at = time.monotonic()
+        self.hits = 0
+        self.similarity = 1.0
+
+
+class _ScopeIndex:
+    """Ответы одной области: точный словарь и матрица векторов для похожих вопросов"""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.entries: "OrderedDict[str, CachedAnswer]" = OrderedDict()
+        self.vectors: Dict[str, np.ndarray] = {}
+        self._matrix: Optional[np.ndarray] = None
+        self._keys: List[str] = []
+
+    def _invalidate_matrix(self):
+        self._matrix = None
+
+    def get(self, normalized: str) -> Optional[CachedAnswer]:
+        return self.entries.get(normalized)
+
+    def touch(self, normalized: str):
+        """Продвижение в LRU - только для принятого попадания"""
+        if normalized in self.entries:
+            self.entries.move_to_end(normalized)
+
+    def nearest(self, vector: np.ndarray) -> Tuple[Optional[CachedAnswer], float]:
+        if not self.entries or not vector.any():
+            return None, 0.0
+        if self._matrix is None:
+            self._keys = list(self.entries)
+            self._matrix = np.stack([self.vectors[key] for key in self._keys])
+        similarities = self._matrix @ vector
+        best = int(np.argmax(similarities))
+        return self.entries[self._keys[best]], float(similarities[best])
+
+    def put(self, entry: CachedAnswer, vector: np.ndarray):
+        self.entries[entry.normalized] = entry
+        self.entries.move_to_end(entry.normalized)
+        self.vectors[entry.normalized] = vector
+        while len(self.entries) > self.capacity:
+            evicted, _ = self.entries.popitem(last=False)
+            self.vectors.pop(evicted, None)
+        self._invalidate_matrix()
+
+    def remove(self, normalized: str):
+        if self.entries.pop(normalized, None) is not None:
+            self.vectors.pop(normalized, None)
+            self._invalidate_matrix()
+
+
+class AnswerCache:
+    """Кэш ответов /gpt и /ask с поиском перефразированных вопросов
+
+    Сначала ищется точное совпадение нормализованного текста вопроса, затем
+    самый близкий сохраненный вопрос по локальному вектору. Похожий вопрос
+    принимается при близости не ниже порога области, совпадении всех слов
+    с цифрами и латиницей ("python" и "java" - разные вопросы) и совпадении
+    основ значимых слов: вектор почти не различает вопросы, отличающиеся
+    одним словом ("разница" и "сходство"), поэтому совпасть могут только
+    перефразировки с другим порядком слов, формами слов и служебными словами.
+
+    /gpt - одна общая область на все чаты. /ask - своя область у каждого
+    чата; проверку, что с момента ответа в чате не появилось относящихся к
+    вопросу сообщений, выполняет обработчик по meta записи.
+    """
+
+    def __init__(self):
+        self._scopes: "OrderedDict[Tuple[str, Optional[int]], _ScopeIndex]" = OrderedDict()
+        self.exact_hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self.stale = 0
+
+    def _settings(self, scope: str) -> Tuple[float, int, int]:
+        """Порог близости, срок жизни и емкость области"""
+        if scope == SCOPE_GPT:
+            return config.ANSWER_CACHE_GPT_SIMILARITY, config.ANSWER_CACHE_GPT_TTL, config.ANSWER_CACHE_GPT_SIZE
+        return config.ANSWER_CACHE_ASK_SIMILARITY, config.ANSWER_CACHE_ASK_TTL, config.ANSWER_CACHE_ASK_SIZE
+
+    def _index(self, scope: str, chat_id: Optional[int], create: bool = False) -> Optional[_ScopeIndex]:
+        key = (scope, None if scope == SCOPE_GPT else chat_id)
+        index = self._scopes.get(key)
+        if index is None and create:
+            index = _ScopeIndex(self._settings(scope)[2])
+            self._scopes[key] = index
+            # Вытесняем области давно не спрашивавших чатов
+            while len(self._scopes) > config.ANSWER_CACHE_MAX_CHATS + 1:
+                oldest = next(iter(key for key in self._scopes if key[0] != SCOPE_GPT))
+                del self._scopes[oldest]
+        if index is not None:
+            self._scopes.move_to_end(key)
+        return index
+
+    def lookup(self, scope: str, question: str, chat_id: Optional[int] = None) -> Optional[CachedAnswer]:
+        """Сохраненный ответ на тот же или перефразированный вопрос"""
+        if not config.ANSWER_CACHE_ENABLED:
+            return None
+        index = self._index(scope, chat_id)
+        normalized = normalize_question(question)
+        if index is None or not normalized:
+            self.misses += 1
+            return None
+
+        threshold, ttl, _ = self._settings(scope)
+        entry = index.get(normalized)
+        similarity = 1.0
+        if entry is None:
+            entry, similarity = index.nearest(embed_question(normalized))
+            if entry is not None and (similarity < threshold
+                                      or _exact_terms(entry.normalized) != _exact_terms(normalized)
+                                      or _key_terms(entry.normalized) != _key_terms(normalized)):
+                entry = None
+
+        if entry is None:
+            self.misses += 1
+            return None
+        if time.monotonic() - entry.created_at > ttl:
+            index.remove(entry.normalized)
+            self.misses += 1
+            return None
+
+        index.touch(entry.normalized)
+        entry.hits += 1
+        entry.similarity = similarity
+        if similarity < 1.0:
+            self.similar_hits += 1
+            logger.info(f"💾 Кэш ответов {scope}: похожий вопрос ({similarity:.2f}) «{entry.question[:60]}»")
+        else:
+            self.exact_hits += 1
+        return entry
+
+    def store(self, scope: str, question: str, answer: str, chat_id: Optional[int] = None,
+              meta: Optional[Dict] = None):
+        if not config.ANSWER_CACHE_ENABLED:
+            return
+        normalized = normalize_question(question)
+        if not normalized:
+            return
+        index = self._index(scope, chat_id, create=True)
+        index.put(CachedAnswer(question, normalized, answer, meta), embed_question(normalized))
+
+    def discard(self, scope: str, entry: CachedAnswer, chat_id: Optional[int] = None):
+        """Удаление устаревшего ответа (например, в чате появились новые сообщения по теме)"""
+        self.stale += 1
+        index = self._index(scope, chat_id)
+        if index is not None:
+            index.remove(entry.normalized)
+
+    def format_stats(self) -> str:
+        entries = sum(len(index.entries) for index in self._scopes.values())
+        return (
+            f"💾 **Кэш ответов /gpt и /ask:** точных {self.exact_hits}, похожих {self.similar_hits}, "
+            f"промахов {self.misses}, устаревших {self.stale}, записей {entries}"
+        )
+
+
+# Общий кэш ответов для всех обработчиков
+answer_cache = AnswerCache()
@@ -8,11 +8,6 @@ import asyncio
 import tempfile
 import subprocess
 
-# Импорты для обработки медиа
-import speech_recognition as sr
-import easyocr
-from pydub import AudioSegment
-
 from telegram import Update
 from telegram.ext import (
     Application,
@@ -28,6 +23,16 @@ from handlers.questions import QuestionsHandler
 from handlers.analysis import AnalysisHandler
 from handlers.utils import UtilsHandler
 from database import DatabaseManager
+from http_pool import close_http_session
+from quota import quota_manager
+from scheduler import TaskScheduler
+from ai_usage import usage_tracker
+from brief_cache import brief_cache
+from user_profiles import profile_store
+from chat_analytics import chat_analytics
+from threads import thread_index
+from topic_segmenter import topic_segmenter
+from media_pool import MediaJobTimeout, MediaQueueFull, media_pool
 
 # Настройка логирования
 logging.basicConfig(
@@ -43,100 +48,6 @@ logger = logging.getLogger(__name__)
 # Загрузка переменных окружения
 load_dotenv()
 
-# Инициализация EasyOCR для русского и английского языков
-try:
-    reader = easyocr.Reader(['ru', 'en'])
-    logger.info("EasyOCR успешно инициализирован")
-except Exception as e:
-    logger.error(f"Ошибка инициализации EasyOCR: {e}")
-    reader = None
-
-class MediaProcessor:
-    """Класс для обработки медиа-контента (голосовые, изображения)"""
-    
-    @staticmethod
-    def extract_text_from_image(image_path: str) -> str:
-        try:
-            text = pytesseract.image_to_string(Image.open(image_path), lang='rus+eng')
-            if not text.strip():
-                return "Текст на изображении не обнаружен"
-            return text
-        except Exception as e:
-            return f"Ошибка при распознавании текста: {e}"
-            # Объединяем все распознанные тексты
-            text = '\n'.join([result[1] for result in results])
-            logger.info(f"Распознанный текст: {text[:100]}...")
-            
-            return text
-            
-        except Exception as e:
-            logger.error(f"Ошибка при распознавании текста: {e}")
-            return f"Ошибка при распознавании текста: {str(e)}"
-    
-    @staticmethod
-    def convert_audio_ogg_to_wav(ogg_path: str, wav_path: str) -> bool:
-        """Конвертирует OGG в WAV используя pydub"""
-        try:
-            audio = AudioSegment.from_ogg(ogg_path)
-            audio.export(wav_path, format="wav")
-            return True
-        except Exception as e:
-            logger.error(f"Ошибка конвертации аудио через pydub: {e}")
-            return MediaProcessor.convert_audio_ffmpeg(ogg_path, wav_path)
-    
-    @staticmethod
-    def convert_audio_ffmpeg(ogg_path: str, wav_path: str) -> bool:
-        """Альтернативный способ конвертации через ffmpeg"""
-        try:
-            ffmpeg_paths = [
-                'ffmpeg', 'ffmpeg.exe', './ffmpeg', 
-                './ffmpeg.exe', 'C:\\ffmpeg\\bin\\ffmpeg.exe'
-            ]
-            
-            for ffmpeg_path in ffmpeg_paths:
-                try:
-                    result = subprocess.run(
-                        [ffmpeg_path, '-y', '-i', ogg_path, wav_path], 
-                        stdout=subprocess.DEVNULL, 
-                        stderr=subprocess.PIPE,
-                        timeout=30
-                    )
-                    if result.returncode == 0:
-                        logger.info(f"Аудио сконвертировано с помощью: {ffmpeg_path}")
-                        return True
-                except (subprocess.TimeoutExpired, FileNotFoundError, Exception):
-                    continue
-                    
-            logger.error("Не удалось найти рабочий ffmpeg")
-            return False
-            
-        except Exception as e:
-            logger.error(f"Ошибка конвертации через ffmpeg: {e}")
-            return False
-    
-    @staticmethod
-    def transcribe_audio(audio_path: str) -> str:
-        """Транскрибирует аудио в текст"""
-        try:
-            r = sr.Recognizer()
-            with sr.AudioFile(audio_path) as source:
-                r.adjust_for_ambient_noise(source, duration=0.5)
-                audio = r.record(source)
-            
-            text = r.recognize_google(audio, language="ru-RU")
-            logger.info(f"Распознанная речь: {text}")
-            return text
-            
-        except sr.UnknownValueError:
-            logger.error("Не удалось распознать речь")
-            return "Не удалось распознать речь. Попробуйте говорить четче и громче."
-        except sr.RequestError as e:
-            logger.error(f"Ошибка сервиса распознавания речи: {e}")
-            return "Ошибка сервиса распознавания речи. Проверьте подключение к интернету."
-        except Exception as e:
-            logger.error(f"Ошибка транскрибации аудио: {e}")
-            return f"Ошибка обработки аудио: {str(e)}"
-
 class YandexGPT:
     def __init__(self, api_key: str, folder_id: str):
         self.api_key = api_key
@@ -196,9 +107,18 @@ class EnhancedAIAssistant:
             raise
         
         # Инициализация компонентов
-        self.application = Application.builder().token(config.TELEGRAM_TOKEN).build()
+        self.application = (
+            Application.builder()
+            .token(config.TELEGRAM_TOKEN)
+            .post_init(self.on_startup)
+            .post_shutdown(self.on_shutdown)
+            .build()
+        )
         self.db = DatabaseManager()
-        self.media_processor = MediaProcessor()
+        self.task_scheduler = None
+        self.warmup_task = None
+        quota_manager.attach(self.db)
+        usage_tracker.attach(self.db)
         self.yandex_gpt = YandexGPT(
             api_key=config.YANDEX_API_KEY,
             folder_id=config.YANDEX_FOLDER_ID
@@ -209,6 +129,11 @@ class EnhancedAIAssistant:
         self.questions_handler = QuestionsHandler(self.db)
         self.analysis_handler = AnalysisHandler(self.db)
         self.utils_handler = UtilsHandler(self.db)
+        brief_cache.attach(self.db, self.summary_handler)
+        profile_store.attach(self.db)
+        chat_analytics.attach(self.db)
+        thread_index.attach(self.db)
+        topic_segmenter.attach(self.db)
         
         self.setup_handlers()
         self.setup_error_handler()
@@ -229,11 +154,13 @@ class EnhancedAIAssistant:
         
         # Анализ участников
         self.application.add_handler(CommandHandler("opinion", self.handle_opinion))
+        self.application.add_handler(CommandHandler("stats", self.handle_stats))
         
         # Настройки
         self.application.add_handler(CommandHandler("settings_summary_time", self.handle_settings_summary_time))
         self.application.add_handler(CommandHandler("settings_daily_summary", self.handle_settings_daily_summary))
         self.application.add_handler(CommandHandler("settings_pin", self.handle_settings_pin))
+        self.application.add_handler(CommandHandler("settings_brief", self.handle_settings_brief))
         self.application.add_handler(CommandHandler("set_personality", self.handle_set_personality))
         self.application.add_handler(CommandHandler("clear_personality", self.handle_clear_personality))
         
@@ -242,6 +169,10 @@ class EnhancedAIAssistant:
         self.application.add_handler(CommandHandler("help", self.handle_help))
         self.application.add_handler(CommandHandler("start", self.handle_start))
         self.application.add_handler(CommandHandler("about", self.handle_about))
+        self.application.add_handler(CommandHandler("ai_status", self.handle_ai_status))
+        self.application.add_handler(CommandHandler("quota", self.handle_quota))
+        self.application.add_handler(CommandHandler("quota_set", self.handle_quota_set))
+        self.application.add_handler(CommandHandler("ai_usage", self.handle_ai_usage))
         
         # Обработка текстовых сообщений
         self.application.add_handler(
@@ -314,14 +245,13 @@ class EnhancedAIAssistant:
                 
                 logger.info(f"OGG файл сохранен: {ogg_path}")
                 
-                # Конвертируем в WAV
+                # Конвертируем в WAV и транскрибируем в пуле обработки медиа
                 wav_path = ogg_path.replace('.ogg', '.wav')
-                if not self.media_processor.convert_audio_ogg_to_wav(ogg_path, wav_path):
+                if not await media_pool.convert_audio(ogg_path, wav_path):
                     await update.message.reply_text("❌ Ошибка конвертации аудио формата")
                     return
                 
-                # Транскрибируем аудио
-                transcribed_text = self.media_processor.transcribe_audio(wav_path)
+                transcribed_text = await media_pool.transcribe(wav_path)
                 
                 if transcribed_text and "Не удалось распознать речь" not in transcribed_text and "Ошибка" not in transcribed_text:
                     # Сохраняем распознанный текст в базу
@@ -330,6 +260,9 @@ class EnhancedAIAssistant:
                     )
                     
                     if success:
+                        self.db.save_extracted_text(update.message.message_id, chat.id, transcribed_text, 'voice')
+                        brief_cache.schedule_precompute(chat.id, transcribed_text)
+                        
                         # Отправляем распознанный текст пользователю
                         await update.message.reply_text(
                             f"🎤 Распознанная речь:\n\n{transcribed_text}",
@@ -347,6 +280,17 @@ class EnhancedAIAssistant:
                         "❌ Не удалось распознать речь. Попробуйте говорить четче.",
                         reply_to_message_id=update.message.message_id
                     )
+            
+            except MediaQueueFull:
+                await update.message.reply_text(
+                    "⏳ Сейчас обрабатывается слишком много голосовых. Попробуйте через пару минут.",
+                    reply_to_message_id=update.message.message_id
+                )
+            except MediaJobTimeout:
+                await update.message.reply_text(
+                    "⏱️ Распознавание речи заняло слишком много времени. Попробуйте сообщение покороче.",
+                    reply_to_message_id=update.message.message_id
+                )
                     
             finally:
                 # Очистка временных файлов
@@ -389,8 +333,8 @@ class EnhancedAIAssistant:
                 
                 logger.info(f"Изображение сохранено: {image_path}")
                 
-                # Извлекаем текст с изображения
-                extracted_text = self.media_processor.extract_text_from_image(image_path)
+                # Извлекаем текст с изображения в отдельном процессе
+                extracted_text = await media_pool.extract_text(image_path)
                 
                 if extracted_text and "не обнаружен" not in extracted_text and "Ошибка" not in extracted_text:
                     # Сохраняем извлеченный текст в базу
@@ -399,6 +343,9 @@ class EnhancedAIAssistant:
                     )
                     
                     if success:
+                        self.db.save_extracted_text(update.message.message_id, chat.id, extracted_text, 'image')
+                        brief_cache.schedule_precompute(chat.id, extracted_text)
+                        
                         # Обрезаем длинный текст для отображения
                         display_text = extracted_text[:2000] + "..." if len(extracted_text) > 2000 else extracted_text
                         
@@ -419,6 +366,17 @@ class EnhancedAIAssistant:
                         "❌ Не удалось распознать текст на изображении. Попробуйте отправить более четкое изображение.",
                         reply_to_message_id=update.message.message_id
                     )
+            
+            except MediaQueueFull:
+                await update.message.reply_text(
+                    "⏳ Сейчас обрабатывается слишком много изображений. Попробуйте через пару минут.",
+                    reply_to_message_id=update.message.message_id
+                )
+            except MediaJobTimeout:
+                await update.message.reply_text(
+                    "⏱️ Распознавание текста заняло слишком много времени.",
+                    reply_to_message_id=update.message.message_id
+                )
                     
             finally:
                 # Очистка временного файла
@@ -498,23 +456,30 @@ class EnhancedAIAssistant:
 
 **📊 Суммаризация и анализ:**
 • /summary [n] - Суммаризация последних n сообщений (включая медиа-контент)
-• /themes [n] - Тезисный анализ основных тем
+• /themes [n] [fast] - Тезисный анализ основных тем (fast - мгновенно, без AI)
 • /comment - Комментарий к текущей теме обсуждения
 • /brief - Краткое изложение длинного сообщения
 
 **❓ Работа с вопросами:**
 • /ask [вопрос] - Ответ на вопрос на основе истории чата
+• Ответьте на ответ /ask, чтобы задать уточняющий вопрос
 • /yagpt [вопрос] - Ответ через Яндекс GPT
 
 **👥 Анализ участников:**
 • /opinion [@username] - Характеристика пользователя по его сообщениям
+• /stats [дней] - Статистика чата: активность, скорость ответов, кто кому отвечает, словарь
 
 **⚙️ Настройки:**
 • /settings_daily_summary - Включить/выключить ежедневную суммаризацию
 • /settings_summary_time - Настроить время ежедневной суммаризации
 • /settings_pin - Включить/выключить закрепление суммаризации
+• /settings_brief - Заранее готовить /brief для длинных сообщений
 • /set_personality [описание] - Установить личность бота
 • /clear_personality - Очистить личность бота
+• /ai_status - Состояние очереди AI запросов
+• /quota - Использование квот AI запросов
+• /ai_usage [дни] - Токены, задержки и ошибки AI по командам и моделям
+• /quota_set [chat|user|global] [запросы] [токены] - Изменить лимиты (админы)
 
 **ℹ️ Примечания:**
 - Голосовые сообщения автоматически распознаются и сохраняются
@@ -584,6 +549,9 @@ class EnhancedAIAssistant:
             await update.message.reply_text("❌ Сообщение слишком длинное. Максимум 4000 символов.")
             return
         
+        if not await quota_manager.enforce(update, "yagpt"):
+            return
+        
         await update.message.chat.send_action(action="typing")
         
         try:
@@ -601,6 +569,10 @@ class EnhancedAIAssistant:
         """Обработка команды /opinion"""
         await self.analysis_handler.handle_opinion(update, context)
 
+    async def handle_stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработка команды /stats"""
+        await self.analysis_handler.handle_stats(update, context)
+
     async def handle_settings_summary_time(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка команды /settings_summary_time"""
         await self.utils_handler.handle_settings_summary_time(update, context)
@@ -613,6 +585,10 @@ class EnhancedAIAssistant:
         """Обработка команды /settings_pin"""
         await self.utils_handler.handle_settings_pin(update, context)
 
+    async def handle_settings_brief(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработка команды /settings_brief"""
+        await self.utils_handler.handle_settings_brief(update, context)
+
     async def handle_set_personality(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка команды /set_personality"""
         await self.utils_handler.handle_set_personality(update, context)
@@ -621,9 +597,27 @@ class EnhancedAIAssistant:
         """Обработка команды /clear_personality"""
         await self.utils_handler.handle_clear_personality(update, context)
 
+    async def handle_ai_status(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработка команды /ai_status"""
+        await self.utils_handler.handle_ai_status(update, context)
+
+    async def handle_quota(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработка команды /quota"""
+        await self.utils_handler.handle_quota(update, context)
+
+    async def handle_quota_set(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработка команды /quota_set"""
+        await self.utils_handler.handle_quota_set(update, context)
+
+    async def handle_ai_usage(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработка команды /ai_usage"""
+        await self.utils_handler.handle_ai_usage(update, context)
+
     async def handle_text_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка текстовых сообщений для сохранения в историю"""
         await self.utils_handler.save_text_message(update, context)
+        # Ответ на сообщение бота с результатом /ask - уточняющий вопрос
+        await self.questions_handler.handle_ask_reply(update, context)
    
 
     async def error_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -637,6 +631,25 @@ class EnhancedAIAssistant:
         except Exception as e:
             logger.error(f"Error in error handler: {e}")
     
+    async def on_startup(self, application: Application):
+        """Запуск фоновых задач после инициализации бота"""
+        self.task_scheduler = TaskScheduler(self.db, application)
+        self.task_scheduler.start()
+        if config.MEDIA_WARMUP_ENABLED:
+            # Движки грузятся в фоне, пока бот уже принимает сообщения
+            self.warmup_task = asyncio.create_task(media_pool.warm_up())
+
+    async def on_shutdown(self, application: Application):
+        """Освобождение ресурсов при остановке бота"""
+        if self.task_scheduler:
+            self.task_scheduler.shutdown()
+        if self.warmup_task:
+            self.warmup_task.cancel()
+        media_pool.shutdown()
+        quota_manager.persist()
+        usage_tracker.flush()
+        await close_http_session()
+
     def run(self):
         """Запуск бота"""
         logger.info("Запуск Enhanced AI Assistant Bot с медиа-функциями...")
@@ -0,0 +1,94 @@
+import logging
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+
+class AskSession:
+    """Состояние разговора /ask: найденные сообщения и краткая история вопросов
+
+    Хранятся только id сообщений контекста с их оценками и укороченные пары
+    "вопрос - ответ", поэтому память на сессию ограничена
+    ASK_SESSION_MAX_MESSAGES и ASK_SESSION_SUMMARY_CHARS.
+    """
+
+    def __init__(self, chat_id: int):
+        self.chat_id = chat_id
+        self.scores: Dict[int, float] = {}
+        self.turns: List[Tuple[str, str]] = []
+        self.last_used = time.monotonic()
+
+    def add_context(self, messages: List[Dict]):
+        for msg in messages:
+            message_id = msg.get('id')
+            if message_id is not None:
+                self.scores[message_id] = max(self.scores.get(message_id, 0.0), msg.get('score', 0.0))
+        if len(self.scores) > config.ASK_SESSION_MAX_MESSAGES:
+            # Оставляем самые релевантные сообщения, при равенстве - свежие
+            best = sorted(self.scores.items(), key=lambda item: (item[1], item[0]), reverse=True)
+            self.scores = dict(best[:config.ASK_SESSION_MAX_MESSAGES])
+
+    def add_turn(self, question: str, answer: str):
+        limit = config.ASK_SESSION_ANSWER_CHARS
+        if len(answer) > limit:
+            answer = answer[:limit - 3] + "..."
+        self.turns.append((question[:limit], answer))
+        while len(self.turns) > 1 and len(self.summary) > config.ASK_SESSION_SUMMARY_CHARS:
+            self.turns.pop(0)
+
+    @property
+    def summary(self) -> str:
+        """Предыдущие вопросы и ответы для промпта"""
+        return "\n".join(f"Вопрос: {question}\nОтвет: {answer}" for question, answer in self.turns)
+
+
+class AskSessionStore:
+    """Сессии /ask по цепочке ответов
+
+    Ключ - (чат, id ответа бота). Ответ на сообщение бота продолжает сессию,
+    новый ответ бота привязывается к той же сессии. Ключи вытесняются по
+    LRU (не больше ASK_SESSION_MAX_ENTRIES), сессии без обращений дольше
+    ASK_SESSION_IDLE_MINUTES считаются завершенными.
+    """
+
+    def __init__(self):
+        self._sessions: "OrderedDict[Tuple[int, int], AskSession]" = OrderedDict()
+        self.follow_ups = 0
+
+    def get(self, chat_id: int, message_id: int) -> Optional[AskSession]:
+        if not config.ASK_SESSIONS_ENABLED:
+            return None
+        key = (chat_id, message_id)
+        session = self._sessions.get(key)
+        if session is None:
+            return None
+        if time.monotonic() - session.last_used > config.ASK_SESSION_IDLE_MINUTES * 60:
+            del self._sessions[key]
+            return None
+        self._sessions.move_to_end(key)
+        session.last_used = time.monotonic()
+        self.follow_ups += 1
+        return session
+
+    def bind(self, session: AskSession, message_id: int):
+        """Привязка ответа бота к сессии"""
+        if not config.ASK_SESSIONS_ENABLED:
+            return
+        session.last_used = time.monotonic()
+        key = (session.chat_id, message_id)
+        self._sessions[key] = session
+        self._sessions.move_to_end(key)
+        while len(self._sessions) > config.ASK_SESSION_MAX_ENTRIES:
+            self._sessions.popitem(last=False)
+
+    def format_stats(self) -> str:
+        sessions = len({id(session) for session in self._sessions.values()})
+        return f"💬 **Сессии /ask:** активных {sessions}, уточняющих вопросов {self.follow_ups}"
+
+
+# Общее хранилище сессий /ask
+ask_sessions = AskSessionStore()
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""
+Профиль времени импорта бота (python -X importtime)
+
+Импортирует модуль (по умолчанию app) в чистом процессе несколько раз,
+печатает лучшее общее время и самые медленные модули по накопленному
+времени. Код возврата 1, если импорт дольше --budget-ms или если при
+старте загружаются тяжелые движки обработки медиа (они должны
+загружаться при первом голосовом или изображении).
+
+Пример:
+    python benchmarks/import_time_benchmark.py --runs 5 --budget-ms 3000
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+from typing import Dict, Tuple
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Модули, которым не место в импорте при старте
+HEAVY_MODULES = [
+    "easyocr", "torch", "torchvision", "torchaudio",
+    "speech_recognition", "pydub", "pytesseract", "PIL",
+]
+
+
+def profile_import(module: str) -> Tuple[int, Dict[str, int]]:
+    """Общее время импорта (мкс) и накопленное время каждого модуля"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(result.stderr.strip().splitlines()[-1])
+
+    cumulative: Dict[str, int] = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, micros, name = line[len("import time:"):].split("|")
+        cumulative[name.strip()] = int(micros)
+    return cumulative.get(module, 0), cumulative
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Профиль времени импорта бота")
+    parser.add_argument("--module", default="app", help="импортируемый модуль")
+    parser.add_argument("--runs", type=int, default=3, help="число запусков, берется лучший")
+    parser.add_argument("--budget-ms", type=float, default=3000.0, help="допустимое время импорта")
+    parser.add_argument("--top", type=int, default=15, help="сколько самых медленных модулей показать")
+    args = parser.parse_args()
+
+    best_total, best_modules = None, {}
+    for _ in range(args.runs):
+        try:
+            total, modules = profile_import(args.module)
+        except RuntimeError as e:
+            print(f"❌ Не удалось импортировать {args.module}: {e}")
+            return 2
+        if best_total is None or total < best_total:
+            best_total, best_modules = total, modules
+
+    print(f"Импорт {args.module}: {best_total / 1000:.0f}мс (лучший из {args.runs}), модулей {len(best_modules)}")
+    print("\nСамые медленные (накопленное время):")
+    slowest = sorted(best_modules.items(), key=lambda item: item[1], reverse=True)
+    for name, micros in slowest[:args.top]:
+        print(f"  {micros / 1000:8.1f}мс  {name}")
+
+    failed = False
+    loaded_heavy = sorted({
+        name for name in best_modules
+        if any(name == heavy or name.startswith(heavy + ".") for heavy in HEAVY_MODULES)
+    })
+    if loaded_heavy:
+        print(f"\n❌ При старте загружаются тяжелые модули: {', '.join(loaded_heavy[:10])}")
+        failed = True
+    if best_total / 1000 > args.budget_ms:
+        print(f"\n❌ Импорт дольше бюджета {args.budget_ms:.0f}мс")
+        failed = True
+    if not failed:
+        print(f"\n✅ Импорт укладывается в {args.budget_ms:.0f}мс, движки медиа не загружаются")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
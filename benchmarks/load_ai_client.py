@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+"""
+Нагрузочный драйвер для AIClient без сети
+
+Поднимает мок-сервер Yandex GPT в том же процессе (или использует --url),
+выполняет N вызовов AIClient.chat_completion с заданной параллельностью и
+печатает пропускную способность, p50/p95/p99 задержки и долю ошибок, а
+также метрики очереди и состояние бэкендов. Код возврата 1, если доля
+ошибок выше --max-error-rate или p99 выше --max-p99 (для CI).
+
+Пример:
+    python benchmarks/load_ai_client.py --requests 500 --concurrency 50 --error-500 0.05
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+from typing import List
+
+# Добавляем путь к корневой директории проекта
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from mock_yandex_server import YANDEX_PATH, add_settings_arguments, settings_from_args, start_mock_server
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(p * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+async def run_load(args) -> int:
+    runner = None
+    url = args.url
+    if not url:
+        runner, base_url = await start_mock_server(settings_from_args(args))
+        url = f"{base_url}{YANDEX_PATH}"
+
+    # Настраиваем клиент на мок до первого использования AI модулей
+    from config import config
+    config.AI_PROVIDER = "yandex"
+    config.YANDEX_URL = url
+    config.YANDEX_API_KEY = config.YANDEX_API_KEY or "mock-key"
+    config.YANDEX_FOLDER_ID = config.YANDEX_FOLDER_ID or "mock-folder"
+    config.AI_MAX_CONCURRENT_REQUESTS = args.max_concurrent
+    config.AI_REQUEST_TIMEOUT = args.request_timeout
+
+    from ai_client import AIClient
+    from ai_queue import request_queue
+    from ai_router import get_router
+    from ai_usage import usage_tracker
+    from http_pool import close_http_session
+
+    request_queue.max_concurrent = args.max_concurrent
+    client = AIClient()
+    semaphore = asyncio.Semaphore(args.concurrency)
+    latencies: List[float] = []
+    results = {'ok': 0, 'failed': 0, 'fallback': 0}
+
+    async def one_call(i: int):
+        async with semaphore:
+            started = time.monotonic()
+            answer = await client.chat_completion(
+                [{"role": "system", "content": "Ты - тестовый ассистент."},
+                 {"role": "user", "content": f"Запрос номер {i}: " + "текст " * args.prompt_words}],
+                max_tokens=100,
+                chat_id=i % args.chats
+            )
+            latencies.append(time.monotonic() - started)
+            if answer is None:
+                results['failed'] += 1
+            elif answer.startswith("🤖 Локальный fallback"):
+                results['fallback'] += 1
+            else:
+                results['ok'] += 1
+
+    started = time.monotonic()
+    await asyncio.gather(*(one_call(i) for i in range(args.requests)))
+    elapsed = time.monotonic() - started
+
+    await close_http_session()
+    if runner:
+        await runner.cleanup()
+
+    error_rate = (results['failed'] + results['fallback']) / max(1, args.requests)
+    p99 = percentile(latencies, 0.99)
+
+    print("=" * 50)
+    print(f"Запросов: {args.requests}, параллельно: {args.concurrency}, слотов AI: {args.max_concurrent}")
+    print(f"Время: {elapsed:.2f}с, пропускная способность: {args.requests / elapsed:.1f} запр/с")
+    print(f"Задержка p50: {percentile(latencies, 0.5):.3f}с, p95: {percentile(latencies, 0.95):.3f}с, p99: {p99:.3f}с")
+    print(f"Успешно: {results['ok']}, ошибок: {results['failed']}, fallback: {results['fallback']}, "
+          f"доля ошибок: {error_rate:.1%}")
+    print(request_queue.format_metrics())
+    print(get_router().format_status())
+    print(usage_tracker.format_stats())
+
+    if error_rate > args.max_error_rate:
+        print(f"❌ Доля ошибок {error_rate:.1%} выше допустимой {args.max_error_rate:.1%}")
+        return 1
+    if args.max_p99 and p99 > args.max_p99:
+        print(f"❌ p99 {p99:.3f}с выше допустимого {args.max_p99:.3f}с")
+        return 1
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест AIClient")
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--concurrency", type=int, default=50, help="одновременных вызовов chat_completion")
+    parser.add_argument("--max-concurrent", type=int, default=8, help="слотов очереди AI (AI_MAX_CONCURRENT_REQUESTS)")
+    parser.add_argument("--chats", type=int, default=10, help="число разных чатов")
+    parser.add_argument("--prompt-words", type=int, default=50)
+    parser.add_argument("--request-timeout", type=float, default=5.0)
+    parser.add_argument("--url", default="", help="внешний адрес API вместо встроенного мока")
+    parser.add_argument("--max-error-rate", type=float, default=1.0)
+    parser.add_argument("--max-p99", type=float, default=0.0)
+    add_settings_arguments(parser)
+    args = parser.parse_args()
+    sys.exit(asyncio.run(run_load(args)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Микробенчмарк проверок вопросов и ответов AI (PhraseMatcher)
+
+Сравнивает общий PhraseMatcher с прежними последовательными проверками
+`any(phrase in text ...)` на синтетических вопросах и ответах разной длины,
+убеждается, что результаты совпадают, и печатает время одной проверки.
+Код возврата 1, если результаты расходятся.
+
+Пример:
+    python benchmarks/matcher_benchmark.py --texts 2000
+"""
+
+import argparse
+import os
+import random
+import re
+import sys
+import time
+
+# Добавляем путь к корневой директории проекта
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+WORDS = (
+    "пользователь пишет коротко часто задает вопросы использует эмодзи отвечает быстро обсуждает релиз "
+    "сборку сервер бюджет встречу python docker список совет почему разница определение как или vs "
+    "плохой минус недостаток не упоминается не удалось найти привет help функции"
+).split()
+
+# Прежние реализации: последовательные проходы по спискам фраз
+LEGACY_TYPES = [
+    ("how_to", ['как', 'how to', 'инструкция', 'руководство']),
+    ("definition", ['что такое', 'что значит', 'определение', 'definition']),
+    ("explanation", ['почему', 'why', 'причина', 'cause']),
+    ("comparison", ['сравни', 'difference', 'разница', 'vs', 'или']),
+    ("list", ['список', 'list', 'перечень', 'примеры']),
+]
+LEGACY_EVASIVE = [
+    "не могу найти", "не упоминается", "не достаточно информации", "информации нет",
+    "не говорится", "не обсуждалось", "в предоставленных сообщениях нет", "не удалось найти"
+]
+LEGACY_NEGATIVE = [
+    "плохой", "негативный", "слабый", "неудачный",
+    "проблема с", "недостаток", "минус", "отрицательный"
+]
+
+
+def legacy_classify(question: str) -> str:
+    question_lower = question.lower()
+    for question_type, words in LEGACY_TYPES:
+        if any(word in question_lower for word in words):
+            return question_type
+    if re.search(r'\d+', question) and any(word in question_lower for word in ['совет', 'tip', 'recommend']):
+        return "numbered_advice"
+    return "general"
+
+
+def legacy_contains(text: str, phrases) -> bool:
+    text_lower = text.lower()
+    return any(phrase in text_lower for phrase in phrases)
+
+
+def legacy_checks(text: str):
+    # Как в обработчиках: каждая проверка сама приводит текст к нижнему регистру
+    return legacy_contains(text, LEGACY_EVASIVE), legacy_contains(text, LEGACY_NEGATIVE)
+
+
+def make_texts(count: int, seed: int, min_words: int, max_words: int):
+    rng = random.Random(seed)
+    texts = []
+    for _ in range(count):
+        length = rng.randint(min_words, max_words)
+        words = [rng.choice(WORDS) if rng.random() < 0.05 else "текст" + str(rng.randrange(100))
+                 for _ in range(length)]
+        texts.append(" ".join(words).capitalize())
+    return texts
+
+
+def timed(function, texts, repeat: int) -> float:
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for text in texts:
+            function(text)
+    return (time.perf_counter() - started) / (repeat * len(texts)) * 1e6
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Скорость словарных проверок вопросов и ответов")
+    parser.add_argument("--texts", type=int, default=2000, help="текстов в наборе")
+    parser.add_argument("--repeat", type=int, default=5, help="повторов набора")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    from handlers.analysis import NEGATIVE_TONE
+    from handlers.questions import EVASIVE_PHRASES, QuestionsHandler
+
+    classify = QuestionsHandler._classify_question
+
+    def matcher_checks(text: str):
+        return EVASIVE_PHRASES.matches(text), NEGATIVE_TONE.matches(text)
+
+    # Тип определяется для вопросов, ответы AI проверяются на уклончивость и тон
+    questions = make_texts(args.texts, args.seed, 3, 20)
+    answers = make_texts(args.texts, args.seed + 1, 50, 400)
+    mismatches = sum(1 for text in questions if legacy_classify(text) != classify(None, text))
+    mismatches += sum(1 for text in answers if legacy_checks(text) != matcher_checks(text))
+
+    for title, legacy, matcher, texts in (
+        ("Тип вопроса", legacy_classify, lambda text: classify(None, text), questions),
+        ("Проверки ответа", legacy_checks, matcher_checks, answers),
+    ):
+        legacy_us = timed(legacy, texts, args.repeat)
+        matcher_us = timed(matcher, texts, args.repeat)
+        print(f"⏱️ {title}: последовательно {legacy_us:.1f}мкс, PhraseMatcher {matcher_us:.1f}мкс "
+              f"({legacy_us / matcher_us:.1f}x)")
+    if mismatches:
+        print(f"❌ Результаты расходятся на {mismatches} текстах")
+        return 1
+    print("✅ Результаты совпадают")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""
+Локальный заменитель Yandex GPT API для нагрузочных и регрессионных тестов
+
+Поддерживает настраиваемое распределение задержек, инъекцию ошибок
+(429/500/таймауты) и потоковые ответы. Дополнительно отвечает на
+OpenAI-совместимый /v1/chat/completions (SSE), чтобы проверять оба бэкенда.
+
+Запуск:
+    python benchmarks/mock_yandex_server.py --port 8090 --latency lognormal --median 0.4
+    YANDEX_URL=http://127.0.0.1:8090/foundationModels/v1/completion python app.py
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import random
+from typing import Dict
+
+from aiohttp import web
+
+YANDEX_PATH = "/foundationModels/v1/completion"
+OPENAI_PATH = "/v1/chat/completions"
+
+
+class MockSettings:
+    """Параметры поведения мок-сервера"""
+
+    def __init__(self, latency: str = "fixed", median: float = 0.2, sigma: float = 0.5,
+                 low: float = 0.05, high: float = 0.5, error_429: float = 0.0,
+                 error_500: float = 0.0, timeout_rate: float = 0.0, timeout_seconds: float = 120.0,
+                 seed: int = None):
+        self.latency = latency
+        self.median = median
+        self.sigma = sigma
+        self.low = low
+        self.high = high
+        self.error_429 = error_429
+        self.error_500 = error_500
+        self.timeout_rate = timeout_rate
+        self.timeout_seconds = timeout_seconds
+        self.random = random.Random(seed)
+        self.stats: Dict[str, int] = {'requests': 0, '429': 0, '500': 0, 'timeouts': 0, 'ok': 0}
+
+    def sample_latency(self) -> float:
+        """Задержка ответа по выбранному распределению"""
+        if self.latency == "uniform":
+            return self.random.uniform(self.low, self.high)
+        if self.latency == "lognormal":
+            # Медиана lognormal = exp(mu)
+            return self.random.lognormvariate(math.log(self.median), self.sigma)
+        if self.latency == "pareto":
+            # Тяжелый хвост: большинство ответов около median, редкие - в разы дольше
+            return self.median * self.random.paretovariate(1.0 / max(self.sigma, 0.01))
+        return self.median
+
+    def sample_outcome(self) -> str:
+        """Исход запроса: ok, 429, 500 или timeout"""
+        roll = self.random.random()
+        for outcome, rate in (("429", self.error_429), ("500", self.error_500), ("timeouts", self.timeout_rate)):
+            if roll < rate:
+                return outcome
+            roll -= rate
+        return "ok"
+
+
+def _last_user_text(messages, key: str) -> str:
+    for msg in reversed(messages or []):
+        if msg.get("role", "user") == "user":
+            return msg.get(key) or ""
+    return ""
+
+
+def _answer_for(prompt: str) -> str:
+    return f"Мок-ответ на запрос длиной {len(prompt)} символов."
+
+
+async def _apply_behavior(settings: MockSettings):
+    """Задержка и инъекция ошибок; возвращает ответ с ошибкой или None"""
+    settings.stats['requests'] += 1
+    outcome = settings.sample_outcome()
+    settings.stats[outcome] += 1
+
+    if outcome == "timeouts":
+        await asyncio.sleep(settings.timeout_seconds)
+        return web.json_response({"error": "timeout"}, status=504)
+
+    await asyncio.sleep(settings.sample_latency())
+
+    if outcome == "429":
+        return web.json_response({"error": {"message": "Too many requests"}}, status=429)
+    if outcome == "500":
+        return web.json_response({"error": {"message": "Internal error"}}, status=500)
+    return None
+
+
+async def handle_yandex(request: web.Request) -> web.StreamResponse:
+    settings: MockSettings = request.app['settings']
+    body = await request.json()
+    error_response = await _apply_behavior(settings)
+    if error_response is not None:
+        return error_response
+
+    prompt = _last_user_text(body.get("messages"), "text")
+    answer = _answer_for(prompt)
+    usage = {
+        "inputTextTokens": str(max(1, len(prompt) // 4)),
+        "completionTokens": str(max(1, len(answer) // 4)),
+        "totalTokens": str(max(1, len(prompt) // 4) + max(1, len(answer) // 4)),
+    }
+
+    if not body.get("completionOptions", {}).get("stream"):
+        return web.json_response({
+            "result": {
+                "alternatives": [{"message": {"role": "assistant", "text": answer}, "status": "ALTERNATIVE_STATUS_FINAL"}],
+                "usage": usage,
+                "modelVersion": "mock"
+            }
+        })
+
+    # Потоковый режим Yandex: JSON-объекты по строкам с накопленным текстом
+    response = web.StreamResponse(headers={"Content-Type": "application/json"})
+    await response.prepare(request)
+    words = answer.split(" ")
+    for i in range(1, len(words) + 1):
+        status = "ALTERNATIVE_STATUS_FINAL" if i == len(words) else "ALTERNATIVE_STATUS_PARTIAL"
+        chunk = {"result": {
+            "alternatives": [{"message": {"role": "assistant", "text": " ".join(words[:i])}, "status": status}],
+            "usage": usage,
+            "modelVersion": "mock"
+        }}
+        await response.write((json.dumps(chunk, ensure_ascii=False) + "\n").encode("utf-8"))
+    await response.write_eof()
+    return response
+
+
+async def handle_openai(request: web.Request) -> web.StreamResponse:
+    settings: MockSettings = request.app['settings']
+    body = await request.json()
+    error_response = await _apply_behavior(settings)
+    if error_response is not None:
+        return error_response
+
+    prompt = _last_user_text(body.get("messages"), "content")
+    answer = _answer_for(prompt)
+    usage = {
+        "prompt_tokens": max(1, len(prompt) // 4),
+        "completion_tokens": max(1, len(answer) // 4),
+        "total_tokens": max(1, len(prompt) // 4) + max(1, len(answer) // 4),
+    }
+
+    if not body.get("stream"):
+        return web.json_response({
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+            "usage": usage
+        })
+
+    response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+    await response.prepare(request)
+    for word in answer.split(" "):
+        chunk = {"choices": [{"index": 0, "delta": {"content": word + " "}}]}
+        await response.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+    await response.write(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n".encode("utf-8"))
+    await response.write(b"data: [DONE]\n\n")
+    await response.write_eof()
+    return response
+
+
+async def handle_stats(request: web.Request) -> web.Response:
+    return web.json_response(request.app['settings'].stats)
+
+
+def create_app(settings: MockSettings = None) -> web.Application:
+    """Приложение мок-сервера (можно запускать внутри тестов и нагрузочного драйвера)"""
+    app = web.Application()
+    app['settings'] = settings or MockSettings()
+    app.router.add_post(YANDEX_PATH, handle_yandex)
+    app.router.add_post(OPENAI_PATH, handle_openai)
+    app.router.add_get("/stats", handle_stats)
+    return app
+
+
+async def start_mock_server(settings: MockSettings, host: str = "127.0.0.1", port: int = 0):
+    """Запуск сервера в текущем event loop; возвращает (runner, base_url)"""
+    runner = web.AppRunner(create_app(settings))
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    actual_port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://{host}:{actual_port}"
+
+
+def add_settings_arguments(parser: argparse.ArgumentParser):
+    """Общие аргументы поведения мок-сервера"""
+    parser.add_argument("--latency", choices=["fixed", "uniform", "lognormal", "pareto"], default="lognormal")
+    parser.add_argument("--median", type=float, default=0.2, help="медиана/фиксированная задержка, сек")
+    parser.add_argument("--sigma", type=float, default=0.5, help="разброс lognormal / хвост pareto")
+    parser.add_argument("--low", type=float, default=0.05, help="минимум для uniform")
+    parser.add_argument("--high", type=float, default=0.5, help="максимум для uniform")
+    parser.add_argument("--error-429", type=float, default=0.0, help="доля ответов 429")
+    parser.add_argument("--error-500", type=float, default=0.0, help="доля ответов 500")
+    parser.add_argument("--timeout-rate", type=float, default=0.0, help="доля зависающих запросов")
+    parser.add_argument("--timeout-seconds", type=float, default=120.0)
+    parser.add_argument("--seed", type=int, default=None)
+
+
+def settings_from_args(args: argparse.Namespace) -> MockSettings:
+    return MockSettings(
+        latency=args.latency, median=args.median, sigma=args.sigma, low=args.low, high=args.high,
+        error_429=args.error_429, error_500=args.error_500, timeout_rate=args.timeout_rate,
+        timeout_seconds=args.timeout_seconds, seed=args.seed
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Мок-сервер Yandex GPT API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    add_settings_arguments(parser)
+    args = parser.parse_args()
+
+    print(f"🧪 Мок Yandex GPT: http://{args.host}:{args.port}{YANDEX_PATH}")
+    print(f"🧪 Мок OpenAI:     http://{args.host}:{args.port}{OPENAI_PATH}")
+    web.run_app(create_app(settings_from_args(args)), host=args.host, port=args.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
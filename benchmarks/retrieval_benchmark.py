@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Замер задержки поиска контекста /ask (ChatRetriever) на большой истории
+
+Создает временную базу с синтетическими сообщениями нескольких чатов,
+затем выполняет поиск по набору вопросов и печатает p50/p95/max задержки.
+Код возврата 1, если p95 выше --max-ms (для CI).
+
+Пример:
+    python benchmarks/retrieval_benchmark.py --messages 1000000 --chats 20
+"""
+
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+# Добавляем путь к корневой директории проекта
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from load_ai_client import percentile
+
+WORDS = (
+    "релиз сборка сервер база миграция отпуск встреча бюджет договор клиент оплата баг тест дизайн макет "
+    "отчет квартал план задача дедлайн офис обед кофе поезд билет погода футбол матч кино книга музыка "
+    "ноутбук телефон пароль доступ сеть роутер лицензия счет налог премия отзыв"
+).split()
+USERS = ["alex", "maria", "ivan", "olga", "petr", "anna", "sergey", "dmitry"]
+QUESTIONS = [
+    "что решили по релизу сборки?",
+    "кто отвечал за миграцию базы?",
+    "когда встреча с клиентом по договору?",
+    "что ivan писал про бюджет на квартал?",
+    "где взять пароль от роутера?",
+    "какой дедлайн у задачи по дизайну макета?",
+]
+
+
+def fill_database(db_path: str, messages: int, chats: int, seed: int):
+    rng = random.Random(seed)
+    start = datetime.now() - timedelta(days=365)
+    step = timedelta(days=365) / messages
+    conn = sqlite3.connect(db_path)
+    batch = []
+    for i in range(messages):
+        text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 15)))
+        timestamp = (start + step * i).isoformat(sep=' ', timespec='seconds')
+        batch.append((-1000 - rng.randrange(chats), rng.randrange(1000), rng.choice(USERS), text, timestamp))
+        if len(batch) >= 50000:
+            conn.executemany(
+                "INSERT INTO messages (chat_id, user_id, user_name, message_text, timestamp) VALUES (?, ?, ?, ?, ?)",
+                batch
+            )
+            batch = []
+    if batch:
+        conn.executemany(
+            "INSERT INTO messages (chat_id, user_id, user_name, message_text, timestamp) VALUES (?, ?, ?, ?, ?)",
+            batch
+        )
+    conn.commit()
+    conn.close()
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description="Задержка поиска контекста /ask")
+    parser.add_argument("--messages", type=int, default=200000, help="сообщений в базе")
+    parser.add_argument("--chats", type=int, default=10, help="чатов в базе")
+    parser.add_argument("--queries", type=int, default=200, help="поисковых запросов")
+    parser.add_argument("--max-ms", type=float, default=50.0, help="допустимый p95, мс")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    from database import DatabaseManager
+    from retrieval import ChatRetriever
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, "bench.db")
+        db = DatabaseManager(db_path)
+        if not db.fts_enabled:
+            print("❌ SQLite собран без FTS5")
+            return 1
+
+        started = time.perf_counter()
+        fill_database(db_path, args.messages, args.chats, args.seed)
+        print(f"📥 {args.messages} сообщений в {args.chats} чатах за {time.perf_counter() - started:.1f}с")
+
+        retriever = ChatRetriever(db)
+        rng = random.Random(args.seed)
+        latencies = []
+        context_sizes = []
+        for _ in range(args.queries):
+            result = retriever.retrieve(-1000 - rng.randrange(args.chats), rng.choice(QUESTIONS))
+            latencies.append(result.elapsed_ms)
+            context_sizes.append(len(result.messages))
+
+    p95 = percentile(latencies, 0.95)
+    print(f"⏱️ Поиск: p50 {percentile(latencies, 0.5):.1f}мс, p95 {p95:.1f}мс, max {max(latencies):.1f}мс")
+    print(f"📄 Сообщений в контексте: в среднем {sum(context_sizes) / len(context_sizes):.0f}")
+    return 1 if p95 > args.max_ms else 0
+
+
+if __name__ == "__main__":
+    import logging
+    logging.basicConfig(level=logging.WARNING)
+    sys.exit(main())
@@ -0,0 +1,165 @@
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Dict, Optional, Set, Tuple
+
+from config import config
+from ai_queue import AIPriority
+from ai_client import is_local_fallback
+from ai_usage import usage_tracker
+
+logger = logging.getLogger(__name__)
+
+# Меняется вместе с промптом /brief, чтобы старые изложения не выдавались за новые
+BRIEF_PROMPT_VERSION = "1"
+
+
+def content_key(text: str) -> str:
+    """Ключ кэша: хэш текста без учета пробелов и переносов строк"""
+    normalized = " ".join(text.split())
+    return hashlib.sha256(f"{BRIEF_PROMPT_VERSION}:{normalized}".encode("utf-8")).hexdigest()
+
+
+class BriefCache:
+    """Кэш кратких изложений /brief по хэшу содержимого
+
+    Одно и то же объявление часто пересылают в несколько чатов и сокращают
+    много раз, поэтому изложение хранится по хэшу текста, а не по сообщению.
+    Горячие записи лежат в LRU в памяти, остальные - в таблице brief_cache,
+    где вытесняются самые давно использованные и устаревшие.
+
+    В чатах, включивших /settings_brief, длинные сообщения (и текст,
+    извлеченный из медиа) сокращаются заранее в фоне с низким приоритетом,
+    и /brief отвечает сразу.
+    """
+
+    def __init__(self):
+        self.db = None
+        self.summary_handler = None
+        self._memory: "OrderedDict[str, str]" = OrderedDict()
+        self._inflight: Dict[str, Tuple[asyncio.Task, AIPriority]] = {}
+        self._background: Set[asyncio.Task] = set()
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._saves = 0
+        self.hits = 0
+        self.misses = 0
+        self.precomputed = 0
+
+    def attach(self, db, summary_handler):
+        self.db = db
+        self.summary_handler = summary_handler
+
+    def get(self, text: str) -> Optional[str]:
+        """Готовое изложение текста или None"""
+        key = content_key(text)
+        brief = self._memory.get(key)
+        if brief is not None:
+            self._memory.move_to_end(key)
+            return brief
+        if self.db:
+            brief = self.db.get_cached_brief(key)
+            if brief is not None:
+                self._remember(key, brief)
+        return brief
+
+    def lookup(self, text: str, chat_id: Optional[int] = None) -> Optional[str]:
+        """Как get, но попадание учитывается в статистике AI вызовов /brief"""
+        brief = self.get(text)
+        if brief is not None:
+            self.hits += 1
+            usage_tracker.record_cache_hit("brief", chat_id)
+        return brief
+
+    async def get_or_create(self, text: str, chat_id: Optional[int] = None,
+                            priority: AIPriority = AIPriority.INTERACTIVE) -> Tuple[str, bool]:
+        """Изложение из кэша или новое; второй элемент - было ли попадание в кэш"""
+        brief = self.lookup(text, chat_id)
+        if brief is not None:
+            return brief, True
+
+        self.misses += 1
+        key = content_key(text)
+        inflight = self._inflight.get(key)
+        # Ждем уже идущий расчет, только если он не ниже по приоритету
+        if inflight and inflight[1] <= priority:
+            return await asyncio.shield(inflight[0]), False
+        return await asyncio.shield(self._start(key, text, chat_id, priority)), False
+
+    def _start(self, key: str, text: str, chat_id: Optional[int], priority: AIPriority) -> asyncio.Task:
+        task = asyncio.get_running_loop().create_task(self._create(key, text, chat_id, priority))
+        self._inflight[key] = (task, priority)
+        task.add_done_callback(lambda _: self._forget_inflight(key, task))
+        return task
+
+    def _forget_inflight(self, key: str, task: asyncio.Task):
+        if key in self._inflight and self._inflight[key][0] is task:
+            del self._inflight[key]
+
+    async def _create(self, key: str, text: str, chat_id: Optional[int], priority: AIPriority) -> str:
+        brief = await self.summary_handler._create_brief_summary(text, chat_id=chat_id, priority=priority)
+        if brief and not brief.startswith("❌") and not is_local_fallback(brief):
+            self._store(key, brief, len(text))
+        return brief
+
+    def _remember(self, key: str, brief: str):
+        self._memory[key] = brief
+        self._memory.move_to_end(key)
+        while len(self._memory) > config.BRIEF_CACHE_MEMORY_SIZE:
+            self._memory.popitem(last=False)
+
+    def _store(self, key: str, brief: str, source_length: int):
+        self._remember(key, brief)
+        if not self.db:
+            return
+        self.db.save_cached_brief(key, brief, source_length)
+        self._saves += 1
+        if self._saves % config.BRIEF_CACHE_PRUNE_EVERY == 0:
+            removed = self.db.prune_brief_cache(config.BRIEF_CACHE_MAX_ROWS, config.BRIEF_CACHE_TTL_DAYS)
+            if removed:
+                logger.info(f"📝 Кэш /brief: вытеснено {removed} изложений")
+
+    def schedule_precompute(self, chat_id: int, text: Optional[str]):
+        """Фоновое сокращение длинного сообщения в чате, включившем предрасчет"""
+        try:
+            if not text or len(text) < config.BRIEF_MIN_LENGTH or not self.db or not self.summary_handler:
+                return
+            key = content_key(text)
+            if key in self._memory or key in self._inflight:
+                return
+            if len(self._background) >= config.BRIEF_PRECOMPUTE_MAX_PENDING:
+                logger.debug(f"Brief precompute queue is full, skipping message in chat {chat_id}")
+                return
+            if not self.db.get_chat_settings(chat_id).get('brief_precompute', False):
+                return
+            if self.get(text) is not None:
+                return
+
+            task = asyncio.get_running_loop().create_task(self._precompute(key, text, chat_id))
+            self._background.add(task)
+            task.add_done_callback(self._background.discard)
+        except Exception as e:
+            logger.error(f"Error scheduling brief precompute for chat {chat_id}: {e}")
+
+    async def _precompute(self, key: str, text: str, chat_id: int):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(config.BRIEF_PRECOMPUTE_CONCURRENCY)
+        async with self._semaphore:
+            if key in self._memory or key in self._inflight:
+                return
+            try:
+                brief = await self._start(key, text, chat_id, AIPriority.BULK)
+                if brief and not brief.startswith("❌"):
+                    self.precomputed += 1
+            except Exception as e:
+                logger.error(f"Error precomputing brief for chat {chat_id}: {e}")
+
+    def format_stats(self) -> str:
+        return (
+            f"📝 **Кэш /brief:** попаданий {self.hits}, промахов {self.misses}, "
+            f"подготовлено заранее {self.precomputed}, в памяти {len(self._memory)}"
+        )
+
+
+# Общий кэш: заполняется обработчиком /brief и при сохранении длинных сообщений
+brief_cache = BriefCache()
@@ -0,0 +1,283 @@
+import logging
+import math
+import time
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from config import config
+from token_budget import tokenize
+
+logger = logging.getLogger(__name__)
+
+HEAT_LEVELS = " ▁▂▃▄▅▆▇█"
+WEEKDAYS = ["пн", "вт", "ср", "чт", "пт", "сб", "вс"]
+
+
+def _to_seconds(timestamps: List) -> np.ndarray:
+    """Время сообщений (UTC из SQLite) в секундах от начала эпохи"""
+    values = [str(value or '1970-01-01 00:00:00')[:19].replace(' ', 'T') for value in timestamps]
+    return np.array(values, dtype='datetime64[s]').astype(np.int64)
+
+
+def _epoch(moment: datetime) -> int:
+    return int((moment - datetime(1970, 1, 1)).total_seconds())
+
+
+class ChatArrays:
+    """Сообщения одного чата в массивах NumPy для быстрых расчетов
+
+    На сообщение: id, номер автора, тип и время. На слово: хэш, автор и время,
+    чтобы словарь считался за любой период без обхода текстов.
+    """
+
+    def __init__(self):
+        self.last_id = 0
+        self.users: List[str] = []
+        self._user_index: Dict[str, int] = {}
+        self.types: List[str] = []
+        self.ids = np.empty(0, dtype=np.int64)
+        self.user = np.empty(0, dtype=np.int32)
+        self.kind = np.empty(0, dtype=np.int16)
+        self.time = np.empty(0, dtype=np.int64)
+        self.word_hash = np.empty(0, dtype=np.uint32)
+        self.word_user = np.empty(0, dtype=np.int32)
+        self.word_time = np.empty(0, dtype=np.int64)
+
+    def _index(self, name: str) -> int:
+        if name not in self._user_index:
+            self._user_index[name] = len(self.users)
+            self.users.append(name)
+        return self._user_index[name]
+
+    def _type_index(self, message_type: str) -> int:
+        if message_type not in self.types:
+            self.types.append(message_type)
+        return self.types.index(message_type)
+
+    def append(self, messages: List[Dict]):
+        if not messages:
+            return
+        user = np.array([self._index(msg.get('user') or '?') for msg in messages], dtype=np.int32)
+        kind = np.array([self._type_index(msg.get('type') or 'text') for msg in messages], dtype=np.int16)
+        times = _to_seconds([msg.get('timestamp') for msg in messages])
+        hashes = [
+            [zlib.crc32(word.encode('utf-8')) for word in tokenize(msg.get('text') or '') if not word.isdigit()]
+            for msg in messages
+        ]
+        counts = np.array([len(words) for words in hashes])
+
+        self.ids = np.concatenate([self.ids, [msg['id'] for msg in messages]])
+        self.user = np.concatenate([self.user, user])
+        self.kind = np.concatenate([self.kind, kind])
+        self.time = np.concatenate([self.time, times])
+        self.word_hash = np.concatenate([
+            self.word_hash, np.fromiter((h for words in hashes for h in words), dtype=np.uint32, count=int(counts.sum()))
+        ])
+        self.word_user = np.concatenate([self.word_user, np.repeat(user, counts)])
+        self.word_time = np.concatenate([self.word_time, np.repeat(times, counts)])
+        self.last_id = int(self.ids[-1])
+
+    def trim(self, min_time: int):
+        """Удаление сообщений старше min_time и сверх STATS_MAX_MESSAGES"""
+        keep_from = int(np.searchsorted(self.time, min_time)) if self.time.size else 0
+        keep_from = max(keep_from, self.ids.size - config.STATS_MAX_MESSAGES)
+        if keep_from <= 0:
+            return
+        if keep_from >= self.ids.size:
+            # Все сообщения вне окна (чат давно молчит): массивы пустые, last_id остается
+            self.ids, self.user, self.kind, self.time = self.ids[:0], self.user[:0], self.kind[:0], self.time[:0]
+            self.word_hash, self.word_user, self.word_time = self.word_hash[:0], self.word_user[:0], self.word_time[:0]
+            return
+        cutoff_time = self.time[keep_from]
+        self.ids = self.ids[keep_from:]
+        self.user = self.user[keep_from:]
+        self.kind = self.kind[keep_from:]
+        self.time = self.time[keep_from:]
+        words_from = int(np.searchsorted(self.word_time, cutoff_time))
+        self.word_hash = self.word_hash[words_from:]
+        self.word_user = self.word_user[words_from:]
+        self.word_time = self.word_time[words_from:]
+
+
+def activity_heatmap(times: np.ndarray) -> np.ndarray:
+    """Сообщения по дням недели и часам (7 x 24)"""
+    heat = np.zeros((7, 24), dtype=np.int64)
+    days = times // 86400
+    np.add.at(heat, ((days + 3) % 7, (times % 86400) // 3600), 1)  # 1970-01-01 - четверг
+    return heat
+
+
+def turn_taking(user: np.ndarray, times: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Смены говорящего: (кто ответил, кому, через сколько секунд)
+
+    Учитываются соседние сообщения разных авторов с паузой не больше
+    STATS_RESPONSE_MAX_MINUTES, остальное считается началом нового разговора.
+    """
+    gaps = np.diff(times)
+    valid = (user[1:] != user[:-1]) & (gaps >= 0) & (gaps <= config.STATS_RESPONSE_MAX_MINUTES * 60)
+    return user[1:][valid], user[:-1][valid], gaps[valid]
+
+
+def vocabulary(word_user: np.ndarray, word_hash: np.ndarray, user_count: int) -> Tuple[np.ndarray, np.ndarray]:
+    """Всего слов и различных слов у каждого участника"""
+    total = np.bincount(word_user, minlength=user_count)
+    pairs = np.unique((word_user.astype(np.int64) << 32) | word_hash.astype(np.int64))
+    distinct = np.bincount((pairs >> 32).astype(np.int64), minlength=user_count)
+    return total, distinct
+
+
+def _render_heatmap(heat: np.ndarray) -> str:
+    peak = heat.max()
+    if not peak:
+        return ""
+    levels = np.ceil(heat / peak * (len(HEAT_LEVELS) - 1)).astype(int)
+    rows = ["    0     6     12    18   "]
+    for day, row in zip(WEEKDAYS, levels):
+        rows.append(f"{day}  " + "".join(HEAT_LEVELS[level] for level in row))
+    return "\n".join(rows)
+
+
+def _format_minutes(seconds: float) -> str:
+    return f"{seconds:.0f}с" if seconds < 60 else f"{seconds / 60:.1f}мин"
+
+
+class ChatAnalytics:
+    """Локальная статистика чата для /stats без обращений к AI
+
+    Сообщения чата держатся в массивах NumPy (не старше STATS_WINDOW_DAYS и не
+    больше STATS_MAX_MESSAGES) и дополняются только новыми сообщениями.
+    По ним векторно считаются карта активности, скорость ответов, граф
+    смены говорящих и богатство словаря (индекс Хердана log V / log N).
+    Готовый отчет кэшируется, пока в чате нет новых сообщений.
+    """
+
+    def __init__(self):
+        self.db = None
+        self._chats: "OrderedDict[int, ChatArrays]" = OrderedDict()
+        self._reports: Dict[Tuple[int, int], Tuple[int, float, str]] = {}
+
+    def attach(self, db):
+        self.db = db
+
+    def _refresh(self, chat_id: int) -> ChatArrays:
+        arrays = self._chats.get(chat_id)
+        window_start = datetime.utcnow() - timedelta(days=config.STATS_WINDOW_DAYS)
+        if arrays is None:
+            arrays = ChatArrays()
+            arrays.last_id = self.db.get_window_start_id(chat_id, window_start, config.STATS_MAX_MESSAGES)
+            self._chats[chat_id] = arrays
+            while len(self._chats) > config.STATS_MAX_CHATS:
+                evicted, _ = self._chats.popitem(last=False)
+                self._reports = {key: value for key, value in self._reports.items() if key[0] != evicted}
+        self._chats.move_to_end(chat_id)
+
+        while True:
+            messages = self.db.get_messages_after(chat_id, arrays.last_id, config.STATS_BATCH_SIZE)
+            arrays.append(messages)
+            if len(messages) < config.STATS_BATCH_SIZE:
+                break
+        arrays.trim(_epoch(window_start))
+        return arrays
+
+    def report(self, chat_id: int, days: int) -> str:
+        """Текст отчета /stats за последние days дней"""
+        started = time.perf_counter()
+        arrays = self._refresh(chat_id)
+        key = (chat_id, days)
+        cached = self._reports.get(key)
+        if cached and cached[0] == arrays.last_id and time.monotonic() - cached[1] < config.STATS_CACHE_SECONDS:
+            return cached[2]
+
+        text = self._build_report(arrays, days)
+        self._reports[key] = (arrays.last_id, time.monotonic(), text)
+        logger.info(f"📈 Статистика чата {chat_id} за {days} дн.: {(time.perf_counter() - started) * 1000:.0f}мс")
+        return text
+
+    def chat_statistics(self, chat_id: int, days: int = 7) -> Dict:
+        """То же, что DatabaseManager.get_chat_statistics, но по массивам в памяти
+
+        Запросы get_chat_statistics каждый раз просматривают все сообщения
+        периода, здесь достаточно досчитать новые.
+        """
+        arrays = self._refresh(chat_id)
+        return self._statistics(arrays, _epoch(datetime.utcnow() - timedelta(days=days)), days)
+
+    @staticmethod
+    def _statistics(arrays: ChatArrays, since: int, days: int) -> Dict:
+        mask = arrays.time >= since
+        counts = np.bincount(arrays.user[mask], minlength=len(arrays.users))
+        kinds = np.bincount(arrays.kind[mask], minlength=len(arrays.types))
+        top = np.argsort(counts, kind='stable')[::-1][:10]
+        return {
+            'total_messages': int(mask.sum()),
+            'active_users': int(np.count_nonzero(counts)),
+            'top_users': [{'user': arrays.users[index], 'count': int(counts[index])} for index in top if counts[index]],
+            'message_types': {arrays.types[index]: int(count) for index, count in enumerate(kinds) if count},
+            'period_days': days
+        }
+
+    def _build_report(self, arrays: ChatArrays, days: int) -> str:
+        since = _epoch(datetime.utcnow() - timedelta(days=days))
+        mask = arrays.time >= since
+        user, times = arrays.user[mask], arrays.time[mask]
+        user_count = len(arrays.users)
+        base = self._statistics(arrays, since, days)
+
+        lines = [f"📈 **Статистика чата за {days} дн.**", ""]
+        lines.append(f"💬 Сообщений: {base['total_messages']}, участников: {base['active_users']}")
+        if base['top_users']:
+            lines.append("🏆 Самые активные: " + ", ".join(
+                f"{item['user']} ({item['count']})" for item in base['top_users'][:5]
+            ))
+        media = {kind: count for kind, count in base['message_types'].items() if kind != 'text'}
+        if media:
+            lines.append("🎞️ Медиа: " + ", ".join(f"{kind} - {count}" for kind, count in media.items()))
+        if not times.size:
+            return "\n".join(lines)
+
+        heatmap = _render_heatmap(activity_heatmap(times))
+        if heatmap:
+            lines += ["", "🗓️ **Активность по часам (UTC):**", f"```\n{heatmap}\n```"]
+
+        responders, previous, gaps = turn_taking(user, times)
+        if gaps.size:
+            lines += ["", f"⏱️ **Скорость ответа:** медиана {_format_minutes(float(np.median(gaps)))}"]
+            fastest = []
+            for index in np.unique(responders):
+                user_gaps = gaps[responders == index]
+                if user_gaps.size >= config.STATS_MIN_RESPONSES:
+                    fastest.append((float(np.median(user_gaps)), arrays.users[index]))
+            fastest.sort()
+            if fastest:
+                lines.append("⚡ Быстрее всех отвечают: " + ", ".join(
+                    f"{name} ({_format_minutes(seconds)})" for seconds, name in fastest[:5]
+                ))
+
+            graph = np.bincount(responders.astype(np.int64) * user_count + previous, minlength=user_count * user_count)
+            top_pairs = np.argsort(graph)[::-1][:config.STATS_TOP_PAIRS]
+            pairs = [
+                f"{arrays.users[pair // user_count]} → {arrays.users[pair % user_count]} ({graph[pair]})"
+                for pair in top_pairs if graph[pair]
+            ]
+            lines += ["", "🔁 **Кто кому отвечает чаще всего:**"] + [f"• {pair}" for pair in pairs]
+
+        word_mask = arrays.word_time >= since
+        total, distinct = vocabulary(arrays.word_user[word_mask], arrays.word_hash[word_mask], user_count)
+        richness = [
+            (math.log(distinct[index]) / math.log(total[index]), arrays.users[index], int(distinct[index]))
+            for index in range(user_count) if total[index] >= config.STATS_MIN_WORDS and distinct[index] > 1
+        ]
+        richness.sort(reverse=True)
+        if richness:
+            lines += ["", "📚 **Богатство словаря (индекс Хердана):**"]
+            lines += [f"• {name}: {score:.2f} ({words} разных слов)" for score, name, words in richness[:5]]
+
+        return "\n".join(lines)
+
+
+# Общая статистика чатов для /stats
+chat_analytics = ChatAnalytics()
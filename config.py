@@ -1,6 +1,6 @@
 import os
 import logging
-from typing import List, Optional
+from typing import Dict, List, Optional
 from dotenv import load_dotenv
 
 # Загрузка переменных окружения
@@ -28,11 +28,20 @@ class Config:
     YANDEX_API_KEY: str = os.getenv("YANDEX_API_KEY", "")
     YANDEX_FOLDER_ID: str = os.getenv("YANDEX_FOLDER_ID", "")
     YANDEX_MODEL: str = "yandexgpt-lite"  # ИСПРАВЛЕНО: было "yandexgpt-late"
-    YANDEX_URL: str = "https://llm.api.cloud.yandex.net/foundationModels/v1/completion"
+    YANDEX_URL: str = os.getenv("YANDEX_URL", "https://llm.api.cloud.yandex.net/foundationModels/v1/completion")
     
     # OpenAI API Key (резервный вариант)
     OPENAI_API_KEY: str = os.getenv("OPENAI_API_KEY", "")
     
+    # OpenAI-совместимый сервер: OpenAI или локальный (llama.cpp server, vLLM ...),
+    # например http://localhost:8080/v1
+    OPENAI_BASE_URL: str = os.getenv("OPENAI_BASE_URL", "https://api.openai.com/v1")
+    OPENAI_CHAT_MODEL: str = os.getenv("OPENAI_CHAT_MODEL", "gpt-3.5-turbo")
+    OPENAI_STREAM: bool = os.getenv("OPENAI_STREAM", "true").lower() in ("1", "true", "yes")
+    # Сервер для распознавания голоса (Whisper) и изображений: локальные чат-серверы
+    # этих API обычно не поддерживают, поэтому по умолчанию - OpenAI
+    OPENAI_MEDIA_BASE_URL: str = os.getenv("OPENAI_MEDIA_BASE_URL", "https://api.openai.com/v1")
+    
     # Database
     DATABASE_URL: str = os.getenv("DATABASE_URL", "sqlite:///chat_data.db")
     
@@ -55,9 +64,102 @@ class Config:
     # Максимальное количество токенов в ответе
     AI_MAX_TOKENS: int = 1000
     
+    # Размер контекста моделей в токенах (для упаковки истории в промпт)
+    MODEL_CONTEXT_TOKENS: Dict[str, int] = {
+        "yandexgpt-lite": 8000,
+        "yandexgpt": 8000,
+        "gpt-3.5-turbo": 16000,
+        "gpt-4": 8000,
+        "gpt-4-turbo-preview": 128000,
+    }
+    DEFAULT_CONTEXT_TOKENS: int = 8000
+    
+    # Запас токенов под инструкции промпта и системное сообщение
+    PROMPT_OVERHEAD_TOKENS: int = 700
+    
     # Температура для генерации (0-1)
     AI_TEMPERATURE: float = 0.7
     
+    # Максимальное количество одновременных запросов к AI провайдеру
+    AI_MAX_CONCURRENT_REQUESTS: int = int(os.getenv("AI_MAX_CONCURRENT_REQUESTS", "4"))
+    
+    # Таймауты запроса к AI провайдеру (в секундах)
+    AI_REQUEST_TIMEOUT: float = float(os.getenv("AI_REQUEST_TIMEOUT", "30"))
+    AI_CONNECT_TIMEOUT: float = float(os.getenv("AI_CONNECT_TIMEOUT", "5"))
+    
+    # Пул HTTP соединений к AI провайдерам
+    AI_HTTP_POOL_SIZE: int = int(os.getenv("AI_HTTP_POOL_SIZE", "20"))
+    AI_HTTP_KEEPALIVE: float = 60.0
+    
+    # Повторы при временных ошибках (429, 5xx, таймауты)
+    AI_RETRY_MAX_ATTEMPTS: int = int(os.getenv("AI_RETRY_MAX_ATTEMPTS", "3"))
+    AI_RETRY_BASE_DELAY: float = 0.5
+    AI_RETRY_MAX_DELAY: float = 8.0
+    
+    # Автоматический выключатель: сколько ошибок подряд отключают провайдер и на сколько секунд
+    AI_CIRCUIT_FAILURE_THRESHOLD: int = 5
+    AI_CIRCUIT_RECOVERY_TIMEOUT: float = 30.0
+    
+    # Маршрутизация между несколькими AI бэкендами (Yandex, OpenAI-совместимый, локальный)
+    AI_ROUTING_ENABLED: bool = os.getenv("AI_ROUTING_ENABLED", "false").lower() in ("1", "true", "yes")
+    # JSON список бэкендов, например:
+    # [{"name": "llama", "provider": "openai", "model": "qwen", "base_url": "http://localhost:8080/v1", "tier": "fast", "cost": 0}]
+    AI_BACKENDS: str = os.getenv("AI_BACKENDS", "")
+    # Какой уровень модели предпочитает команда: fast - быстрые и дешевые, strong - сильные
+    AI_COMMAND_TIERS: Dict[str, str] = {
+        "brief": "fast",
+        "summary": "fast",
+        "themes": "fast",
+        "ask": "strong",
+        "gpt": "strong",
+        "opinion": "strong",
+        "comment": "strong",
+    }
+    AI_ROUTER_EWMA_ALPHA: float = 0.2  # вес нового замера в сглаженной задержке/доле ошибок
+    AI_ROUTER_DEFAULT_LATENCY: float = 2.0  # задержка бэкенда без статистики (сек)
+    AI_ROUTER_ERROR_PENALTY: float = 10.0  # штраф (сек) за 100% ошибок
+    AI_ROUTER_ERROR_HALF_LIFE: float = 120.0  # период полураспада доли ошибок (сек)
+    AI_ROUTER_COST_WEIGHT: float = 1.0  # штраф (сек) за единицу стоимости
+    AI_ROUTER_TIER_PENALTY: float = 3.0  # штраф (сек) за несовпадение уровня модели
+    
+    # Дублирование (hedging) медленных запросов во вторую модель Yandex GPT
+    AI_HEDGING_ENABLED: bool = os.getenv("AI_HEDGING_ENABLED", "false").lower() in ("1", "true", "yes")
+    AI_HEDGE_MODEL: str = os.getenv("AI_HEDGE_MODEL", "")  # по умолчанию - другая модель из yandexgpt-lite/yandexgpt
+    AI_HEDGE_PERCENTILE: float = 0.95  # порог ожидания основной модели
+    AI_HEDGE_DEFAULT_DELAY: float = 3.0  # порог, пока нет статистики задержек
+    AI_HEDGE_BUDGET_RATIO: float = 0.1  # не более ~10% запросов дублируются
+    
+    # Квоты на AI запросы в скользящем окне (0 - без ограничений)
+    AI_QUOTA_ENABLED: bool = os.getenv("AI_QUOTA_ENABLED", "true").lower() in ("1", "true", "yes")
+    AI_QUOTA_WINDOW_SECONDS: int = 3600  # длина окна
+    AI_QUOTA_BUCKET_SECONDS: int = 60  # шаг учета внутри окна
+    AI_QUOTA_PERSIST_INTERVAL: int = 60  # как часто сохранять счетчики в базу (сек)
+    AI_QUOTA_USER_REQUESTS: int = int(os.getenv("AI_QUOTA_USER_REQUESTS", "30"))
+    AI_QUOTA_USER_TOKENS: int = int(os.getenv("AI_QUOTA_USER_TOKENS", "60000"))
+    AI_QUOTA_CHAT_REQUESTS: int = int(os.getenv("AI_QUOTA_CHAT_REQUESTS", "120"))
+    AI_QUOTA_CHAT_TOKENS: int = int(os.getenv("AI_QUOTA_CHAT_TOKENS", "250000"))
+    AI_QUOTA_GLOBAL_REQUESTS: int = int(os.getenv("AI_QUOTA_GLOBAL_REQUESTS", "1000"))
+    AI_QUOTA_GLOBAL_TOKENS: int = int(os.getenv("AI_QUOTA_GLOBAL_TOKENS", "2000000"))
+    # Оценка токенов (промпт + ответ) на один вызов команды
+    AI_QUOTA_COMMAND_TOKENS: Dict[str, int] = {
+        "summary": 4000,
+        "themes": 3000,
+        "brief": 1500,
+        "ask": 4000,
+        "gpt": 1500,
+        "yagpt": 1500,
+        "opinion": 3500,
+        "comment": 2000,
+    }
+    AI_QUOTA_DEFAULT_TOKENS: int = 2000
+    
+    # Учет использования AI (токены, задержки) в таблице ai_usage
+    AI_USAGE_FLUSH_SIZE: int = 50  # записей в одной пачке
+    AI_USAGE_FLUSH_INTERVAL: int = 60  # максимальная задержка записи (сек)
+    AI_USAGE_MAX_PENDING: int = 1000  # сколько записей держать при ошибках базы
+    # Telegram ID администраторов бота (через запятую) - могут менять глобальные лимиты
+    BOT_ADMIN_IDS: List[int] = [int(x) for x in os.getenv("BOT_ADMIN_IDS", "").split(",") if x.strip()]
+    
     # Модель для распознавания голоса
     WHISPER_MODEL: str = "whisper-1"
     
@@ -69,15 +171,62 @@ class Config:
     # Максимальное количество сообщений для анализа
     MAX_MESSAGES_FOR_ANALYSIS: int = 200
     
+    # Максимальное количество сообщений для /summary (длинные окна - map-reduce)
+    SUMMARY_MAX_MESSAGES: int = 5000
+    
+    # Map-reduce суммаризация длинных окон
+    AI_SUMMARY_CHUNK_TOKENS: int = 2500  # размер фрагмента для map шага
+    AI_SUMMARY_PARTIAL_TOKENS: int = 300  # длина краткого содержания фрагмента
+    AI_SUMMARY_MAP_CONCURRENCY: int = 4  # одновременных map запросов от одной суммаризации
+    AI_SUMMARY_DEADLINE: float = 90.0  # ограничение времени на map/reduce шаги (сек)
+    AI_SEGMENT_SIZE: int = 100  # сообщений в кэшируемом сегменте истории
+    
+    # Фильтр шума перед построением промптов
+    NOISE_FILTER_ENABLED: bool = os.getenv("NOISE_FILTER_ENABLED", "true").lower() in ("1", "true", "yes")
+    NOISE_SIMHASH_DISTANCE: int = 3  # бит различия SimHash для почти-дубликатов (из 64)
+    NOISE_MIN_DUPLICATE_WORDS: int = 5  # короче - не проверяем на дубликаты
+    
+    # Фоновое обновление ежедневных дайджестов
+    SCHEDULER_TICK_SECONDS: int = 30  # период проверки планировщика
+    DAILY_SUMMARY_SEND_WINDOW_MINUTES: int = 10  # сколько минут после summary_time можно отправить
+    AI_DIGEST_EVERY_MESSAGES: int = 200  # обновлять дайджест после стольких новых сообщений
+    AI_DIGEST_QUIET_SECONDS: int = 600  # или когда чат затих на столько секунд
+    AI_DIGEST_LEAD_MINUTES: int = 15  # за сколько минут до summary_time гарантированно обновить
+    AI_DIGEST_MAX_AGE_MINUTES: int = 120  # старше - пересчитать перед отправкой (окно 24ч сдвигается)
+    AI_DIGEST_CONCURRENCY: int = 2  # дайджестов, пересчитываемых одновременно
+    
     # Количество сообщений по умолчанию для команд
     DEFAULT_MESSAGE_LIMIT: int = 50
     
     # Максимальное количество сообщений для анализа тем
     THEMES_MAX_MESSAGES: int = 100
     
+    # Локальное выделение тем для /themes (TF-IDF + k-means на NumPy)
+    THEMES_LOCAL_ONLY: bool = os.getenv("THEMES_LOCAL_ONLY", "false").lower() in ("1", "true", "yes")
+    TOPIC_MAX_CLUSTERS: int = 5
+    TOPIC_MIN_MESSAGES: int = 10  # меньше - темы выделяет AI
+    TOPIC_MIN_CLUSTER_SIZE: int = 2
+    TOPIC_MAX_VOCABULARY: int = 2000
+    TOPIC_MAX_DF: float = 0.5  # слова из более чем половины сообщений не различают темы
+    TOPIC_KEYWORDS: int = 6
+    TOPIC_EXAMPLES: int = 3
+    TOPIC_BATCH_SIZE: int = 256  # размер пакета mini-batch k-means
+    TOPIC_KMEANS_ITERATIONS: int = 20
+    TOPIC_KMEANS_RUNS: int = 3  # запусков с разной инициализацией
+    TOPIC_MERGE_SIMILARITY: float = 0.35  # кластеры с более близкими центрами объединяются
+    TOPIC_RANDOM_SEED: int = 42
+    
     # Минимальная длина текста для команды /brief
     BRIEF_MIN_LENGTH: int = 100
     
+    # Кэш /brief по хэшу текста и фоновый предрасчет (/settings_brief)
+    BRIEF_CACHE_MEMORY_SIZE: int = 256  # изложений в памяти (LRU)
+    BRIEF_CACHE_MAX_ROWS: int = 5000  # изложений в базе
+    BRIEF_CACHE_TTL_DAYS: int = 30  # неиспользуемые дольше - удаляются
+    BRIEF_CACHE_PRUNE_EVERY: int = 50  # очистка базы после каждых N новых изложений
+    BRIEF_PRECOMPUTE_CONCURRENCY: int = 2
+    BRIEF_PRECOMPUTE_MAX_PENDING: int = 20  # больше - новые сообщения не предрасчитываются
+    
     # ===== НАСТРОЙКИ ВОПРОСОВ =====
     
     # Минимальная длина вопроса
@@ -89,6 +238,44 @@ class Config:
     # Максимальное количество сообщений для /ask
     ASK_MAX_MESSAGES: int = 100
     
+    # Поиск контекста /ask по всей истории (BM25 + свежесть + ветка разговора + автор)
+    ASK_RETRIEVAL_ENABLED: bool = os.getenv("ASK_RETRIEVAL_ENABLED", "true").lower() in ("1", "true", "yes")
+    ASK_RETRIEVAL_CANDIDATES: int = 200  # лучших совпадений полнотекстового индекса
+    ASK_RETRIEVAL_SCAN_LIMIT: int = 500  # свежих совпадений, ранжируемых BM25
+    ASK_RECENT_CONTEXT: int = 50  # последних сообщений всегда среди кандидатов
+    ASK_RETRIEVAL_EXPAND: int = 10  # лучших сообщений, дополняемых соседями
+    ASK_NEIGHBOUR_RADIUS: int = 2  # соседей до и после
+    ASK_NEIGHBOUR_DECAY: float = 0.6  # доля оценки, которую наследует сосед
+    ASK_MAX_QUERY_TERMS: int = 12
+    ASK_IDF_CACHE_SECONDS: int = 3600  # частоты слов для BM25 пересчитываются раз в час
+    ASK_IDF_CACHE_SIZE: int = 5000
+    ASK_RECENCY_HALF_LIFE_HOURS: float = 72.0
+    ASK_THREAD_MINUTES: float = 30.0  # масштаб близости по времени к найденным сообщениям
+    ASK_WEIGHT_BM25: float = 1.0
+    ASK_WEIGHT_RECENCY: float = 0.4
+    ASK_WEIGHT_THREAD: float = 0.3
+    ASK_WEIGHT_AUTHOR: float = 0.7
+    
+    # Кэш ответов /gpt (общий) и /ask (по чатам) с поиском перефразированных вопросов
+    ANSWER_CACHE_ENABLED: bool = os.getenv("ANSWER_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+    ANSWER_CACHE_VECTOR_DIM: int = 1024
+    ANSWER_CACHE_GPT_SIMILARITY: float = 0.9  # минимальная близость похожего вопроса
+    ANSWER_CACHE_ASK_SIMILARITY: float = 0.92
+    ANSWER_CACHE_GPT_TTL: int = 7 * 24 * 3600  # секунд
+    ANSWER_CACHE_ASK_TTL: int = 6 * 3600
+    ANSWER_CACHE_GPT_SIZE: int = 2000  # ответов в общей области /gpt
+    ANSWER_CACHE_ASK_SIZE: int = 100  # ответов на чат
+    ANSWER_CACHE_MAX_CHATS: int = 500
+    
+    # Уточняющие вопросы /ask (ответом на сообщение бота)
+    ASK_SESSIONS_ENABLED: bool = os.getenv("ASK_SESSIONS_ENABLED", "true").lower() in ("1", "true", "yes")
+    ASK_SESSION_MAX_ENTRIES: int = 1000  # ответов бота, к которым привязаны сессии
+    ASK_SESSION_IDLE_MINUTES: int = 60
+    ASK_SESSION_MAX_MESSAGES: int = 250  # id сообщений контекста на сессию
+    ASK_SESSION_DELTA_MESSAGES: int = 60  # новых сообщений контекста на уточнение
+    ASK_SESSION_SUMMARY_CHARS: int = 2000  # история вопросов и ответов в промпте
+    ASK_SESSION_ANSWER_CHARS: int = 400  # длина ответа в истории
+    
     # Максимальное количество токенов для /gpt
     GPT_MAX_TOKENS: int = 1200
     
@@ -103,8 +290,48 @@ class Config:
     # Минимальное количество сообщений для /opinion
     OPINION_MIN_MESSAGES: int = 10
     
+    # Профили участников для /opinion (обновляются по мере сохранения сообщений)
+    PROFILES_ENABLED: bool = os.getenv("PROFILES_ENABLED", "true").lower() in ("1", "true", "yes")
+    PROFILE_BATCH_SIZE: int = 5000  # сообщений в одной пачке обновления
+    PROFILE_TERMS_KEEP: int = 300  # слов в счетчике частых слов участника
+    PROFILE_TERMS_SHOWN: int = 8
+    PROFILE_NARRATIVE_REFRESH_MESSAGES: int = 50  # новых сообщений до пересчета AI-описания
+    
+    # Локальная статистика /stats
+    STATS_REPORT_DEFAULT_DAYS: int = 7
+    STATS_WINDOW_DAYS: int = 90  # сообщений старше в памяти не держим
+    STATS_MAX_MESSAGES: int = 100000  # сообщений чата в памяти
+    STATS_MAX_CHATS: int = 20  # чатов со статистикой в памяти
+    STATS_BATCH_SIZE: int = 5000
+    STATS_CACHE_SECONDS: int = 300  # готовый отчет при отсутствии новых сообщений
+    STATS_RESPONSE_MAX_MINUTES: int = 60  # пауза длиннее - новый разговор, а не ответ
+    STATS_MIN_RESPONSES: int = 5  # ответов для оценки скорости участника
+    STATS_MIN_WORDS: int = 100  # слов для оценки словаря участника
+    STATS_TOP_PAIRS: int = 5
+    
     # Количество сообщений для /comment
     COMMENT_MESSAGE_LIMIT: int = 30
+    COMMENT_WINDOW_MESSAGES: int = 60  # окно, из которого выбирается текущее обсуждение
+    COMMENT_THREAD_TAIL: int = 5  # ветки последних сообщений считаются текущими
+    
+    # Определение текущей темы для /comment (потоковая сегментация)
+    TOPIC_SEGMENTATION_ENABLED: bool = os.getenv("TOPIC_SEGMENTATION_ENABLED", "true").lower() in ("1", "true", "yes")
+    TOPIC_BLOCK_SIZE: int = 6  # сообщений в сравниваемых блоках
+    TOPIC_MIN_DEPTH: float = 0.6  # глубина провала связности для границы темы
+    TOPIC_GAP_MINUTES: int = 45  # пауза, после которой начинается новая тема
+    TOPIC_MIN_SEGMENT: int = 6  # сообщений в теме, не меньше
+    TOPIC_BOUNDARY_HISTORY: int = 8
+    TOPIC_WARMUP_HOURS: int = 24
+    TOPIC_WARMUP_MESSAGES: int = 300
+    TOPIC_MAX_CHATS: int = 500
+    TOPIC_SEGMENT_BATCH_SIZE: int = 1000
+    
+    # Индекс веток обсуждения (ответы на сообщения)
+    THREAD_INDEX_DAYS: int = 30
+    THREAD_INDEX_MAX_MESSAGES: int = 50000  # сообщений чата в индексе
+    THREAD_INDEX_MAX_CHATS: int = 100
+    THREAD_INDEX_BATCH_SIZE: int = 5000
+    THREAD_MAX_MESSAGES: int = 50  # сообщений одной ветки в контексте
     
     # Максимальное количество токенов для анализа
     ANALYSIS_MAX_TOKENS: int = 1000
@@ -126,6 +353,19 @@ class Config:
     # Максимальный размер изображения (в байтах)
     MAX_IMAGE_SIZE: int = 20 * 1024 * 1024  # 20MB
     
+    # Пул обработки медиа: OCR в процессах, аудио в потоках
+    MEDIA_OCR_PROCESSES: int = int(os.getenv("MEDIA_OCR_PROCESSES", "1"))
+    MEDIA_IO_THREADS: int = int(os.getenv("MEDIA_IO_THREADS", "4"))
+    MEDIA_QUEUE_SIZE: int = 20  # задач одного вида в очереди и в работе
+    MEDIA_OCR_TIMEOUT: int = 60  # секунд на изображение, включая очередь
+    MEDIA_AUDIO_TIMEOUT: int = 90  # секунд на шаг обработки голосового
+    
+    # Движки OCR и распознавания речи загружаются при первом использовании
+    OCR_ENGINE: str = os.getenv("OCR_ENGINE", "tesseract").lower()  # tesseract или easyocr
+    MEDIA_WARMUP_ENABLED: bool = os.getenv("MEDIA_WARMUP_ENABLED", "false").lower() in ("1", "true", "yes")
+    MEDIA_WARMUP_DELAY_SECONDS: int = 5  # пауза после запуска перед прогревом
+    MEDIA_WARMUP_TIMEOUT: int = 300
+    
     # Интервал очистки временных файлов (в секундах)
     TEMP_FILE_CLEANUP_INTERVAL: int = 3600  # 1 час
     
@@ -231,7 +471,8 @@ class Config:
             if not self.YANDEX_FOLDER_ID:
                 errors.append("YANDEX_FOLDER_ID не установлен")
         elif self.AI_PROVIDER == "openai":
-            if not self.OPENAI_API_KEY:
+            # Локальным OpenAI-совместимым серверам ключ не нужен
+            if not self.OPENAI_API_KEY and "api.openai.com" in self.OPENAI_BASE_URL:
                 errors.append("OPENAI_API_KEY не установлен для OpenAI")
         # Для "local" провайдера не требуется API ключей
         
@@ -278,7 +519,9 @@ class Config:
         if self.AI_PROVIDER == "yandex":
             return "🤖 Yandex GPT (Русский язык)"
         elif self.AI_PROVIDER == "openai":
-            return "🤖 OpenAI GPT"
+            if "api.openai.com" in self.OPENAI_BASE_URL:
+                return "🤖 OpenAI GPT"
+            return f"🤖 OpenAI-совместимый сервер ({self.OPENAI_CHAT_MODEL})"
         else:
             return "🤖 Локальный режим (базовые ответы)"
 
@@ -11,6 +11,7 @@ class DatabaseManager:
     
     def __init__(self, db_path: str = "chat_data.db"):
         self.db_path = db_path
+        self.fts_enabled = False
         self.init_database()
     
     def init_database(self):
@@ -31,7 +32,8 @@ class DatabaseManager:
                     media_file_id TEXT,
                     timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
                     reply_to_message_id INTEGER,
-                    is_forwarded BOOLEAN DEFAULT 0
+                    is_forwarded BOOLEAN DEFAULT 0,
+                    tg_message_id INTEGER
                 )
             ''')
             
@@ -75,6 +77,115 @@ class DatabaseManager:
                 )
             ''')
             
+            # Таблицы для квот на AI запросы
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS ai_quota_limits (
+                    scope TEXT NOT NULL,
+                    scope_id INTEGER NOT NULL,
+                    max_requests INTEGER NOT NULL,
+                    max_tokens INTEGER NOT NULL,
+                    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (scope, scope_id)
+                )
+            ''')
+            
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS ai_quota_usage (
+                    scope TEXT NOT NULL,
+                    scope_id INTEGER NOT NULL,
+                    bucket_start INTEGER NOT NULL,
+                    requests INTEGER NOT NULL,
+                    tokens INTEGER NOT NULL,
+                    PRIMARY KEY (scope, scope_id, bucket_start)
+                )
+            ''')
+            
+            # Таблица учета AI вызовов
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS ai_usage (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    timestamp DATETIME NOT NULL,
+                    chat_id INTEGER,
+                    command TEXT,
+                    provider TEXT,
+                    model TEXT,
+                    prompt_tokens INTEGER DEFAULT 0,
+                    completion_tokens INTEGER DEFAULT 0,
+                    latency_ms INTEGER DEFAULT 0,
+                    cache_hit BOOLEAN DEFAULT 0,
+                    retries INTEGER DEFAULT 0,
+                    success BOOLEAN DEFAULT 1
+                )
+            ''')
+            
+            # Таблица кэша кратких содержаний сегментов истории
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS summary_segments (
+                    chat_id INTEGER NOT NULL,
+                    start_id INTEGER NOT NULL,
+                    end_id INTEGER NOT NULL,
+                    message_count INTEGER NOT NULL,
+                    summary TEXT NOT NULL,
+                    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (chat_id, start_id, end_id)
+                )
+            ''')
+            
+            # Таблица готовых ежедневных дайджестов
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS daily_digests (
+                    chat_id INTEGER PRIMARY KEY,
+                    summary TEXT NOT NULL,
+                    message_count INTEGER NOT NULL,
+                    last_message_id INTEGER NOT NULL,
+                    updated_at DATETIME NOT NULL
+                )
+            ''')
+            
+            # Кэш кратких изложений /brief по хэшу текста
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS brief_cache (
+                    content_hash TEXT PRIMARY KEY,
+                    brief TEXT NOT NULL,
+                    source_length INTEGER NOT NULL,
+                    hits INTEGER DEFAULT 0,
+                    created_at DATETIME NOT NULL,
+                    last_used_at DATETIME NOT NULL
+                )
+            ''')
+            
+            # Профили участников для /opinion (счетчики стиля и AI-описание)
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS user_profiles (
+                    chat_id INTEGER NOT NULL,
+                    user_name TEXT NOT NULL,
+                    counters TEXT NOT NULL,
+                    terms TEXT NOT NULL,
+                    narrative TEXT,
+                    narrative_message_count INTEGER DEFAULT 0,
+                    narrative_key TEXT,
+                    updated_at DATETIME NOT NULL,
+                    PRIMARY KEY (chat_id, user_name)
+                )
+            ''')
+            
+            # До какого сообщения чата учтены профили участников
+            cursor.execute('''
+                CREATE TABLE IF NOT EXISTS user_profile_progress (
+                    chat_id INTEGER PRIMARY KEY,
+                    last_message_id INTEGER NOT NULL
+                )
+            ''')
+            
+            # Колонки, добавленные после создания таблиц
+            cursor.execute('PRAGMA table_info(chat_settings)')
+            if 'brief_precompute' not in {row[1] for row in cursor.fetchall()}:
+                cursor.execute('ALTER TABLE chat_settings ADD COLUMN brief_precompute BOOLEAN DEFAULT 0')
+            
+            cursor.execute('PRAGMA table_info(messages)')
+            if 'tg_message_id' not in {row[1] for row in cursor.fetchall()}:
+                cursor.execute('ALTER TABLE messages ADD COLUMN tg_message_id INTEGER')
+            
             # Индексы для оптимизации запросов
             cursor.execute('''
                 CREATE INDEX IF NOT EXISTS idx_messages_chat_timestamp 
@@ -96,6 +207,28 @@ class DatabaseManager:
                 ON command_stats(timestamp)
             ''')
             
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_ai_usage_timestamp 
+                ON ai_usage(timestamp)
+            ''')
+            
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_brief_cache_last_used 
+                ON brief_cache(last_used_at)
+            ''')
+            
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_extracted_texts_message 
+                ON extracted_texts(chat_id, original_message_id)
+            ''')
+            
+            cursor.execute('''
+                CREATE INDEX IF NOT EXISTS idx_messages_chat_id 
+                ON messages(chat_id, id)
+            ''')
+            
+            self.fts_enabled = self._init_fulltext_index(cursor)
+            
             conn.commit()
             conn.close()
             logger.info("Database initialized successfully")
@@ -104,11 +237,71 @@ class DatabaseManager:
             logger.error(f"Error initializing database: {e}")
             raise
     
+    def _init_fulltext_index(self, cursor) -> bool:
+        """Полнотекстовый индекс сообщений (FTS5) для поиска контекста /ask
+        
+        Индекс без копии текста (content=''), синхронизируется триггерами.
+        Чат хранится отдельным токеном в колонке chat_key, чтобы поиск
+        внутри одного чата шел по индексу. Префиксные индексы 4 и 5 символов
+        позволяют искать по основам слов без перебора словаря. Без FTS5
+        /ask работает по последним сообщениям.
+        """
+        try:
+            cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'messages_fts'")
+            exists = cursor.fetchone() is not None
+            
+            cursor.execute('''
+                CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
+                    message_text, chat_key, content='', prefix='4 5',
+                    tokenize='unicode61 remove_diacritics 2'
+                )
+            ''')
+            
+            chat_key = "'c' || replace(CAST({}.chat_id AS TEXT), '-', 'n')"
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages
+                WHEN new.message_text IS NOT NULL AND new.message_text != ''
+                BEGIN
+                    INSERT INTO messages_fts (rowid, message_text, chat_key)
+                    VALUES (new.id, new.message_text, {chat_key.format('new')});
+                END
+            ''')
+            cursor.execute(f'''
+                CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages
+                WHEN old.message_text IS NOT NULL AND old.message_text != ''
+                BEGIN
+                    INSERT INTO messages_fts (messages_fts, rowid, message_text, chat_key)
+                    VALUES ('delete', old.id, old.message_text, {chat_key.format('old')});
+                END
+            ''')
+            
+            if not exists:
+                # Индексируем уже накопленную историю
+                cursor.execute(f'''
+                    INSERT INTO messages_fts (rowid, message_text, chat_key)
+                    SELECT id, message_text, {chat_key.format('messages')}
+                    FROM messages WHERE message_text IS NOT NULL AND message_text != ''
+                ''')
+                logger.info(f"Full-text index built for {cursor.rowcount} messages")
+            return True
+            
+        except sqlite3.OperationalError as e:
+            logger.warning(f"Full-text search is unavailable, /ask will use recent messages: {e}")
+            return False
+    
+    @staticmethod
+    def fts_chat_key(chat_id: int) -> str:
+        """Токен чата в колонке chat_key полнотекстового индекса"""
+        return "c" + str(chat_id).replace("-", "n")
+    
     def save_message(self, chat_id: int, user_id: int, user_name: str, 
                     message_text: str, message_type: str = 'text', 
                     media_file_id: str = None, reply_to_message_id: int = None,
-                    is_forwarded: bool = False) -> bool:
-        """Сохранение сообщения в базу данных"""
+                    is_forwarded: bool = False, tg_message_id: int = None) -> bool:
+        """Сохранение сообщения в базу данных
+        
+        tg_message_id и reply_to_message_id - id сообщений в Telegram (для веток обсуждения).
+        """
         try:
             conn = sqlite3.connect(self.db_path)
             cursor = conn.cursor()
@@ -116,10 +309,10 @@ class DatabaseManager:
             cursor.execute('''
                 INSERT INTO messages 
                 (chat_id, user_id, user_name, message_text, message_type, 
-                 media_file_id, reply_to_message_id, is_forwarded)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                 media_file_id, reply_to_message_id, is_forwarded, tg_message_id)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
             ''', (chat_id, user_id, user_name, message_text, message_type, 
-                  media_file_id, reply_to_message_id, is_forwarded))
+                  media_file_id, reply_to_message_id, is_forwarded, tg_message_id))
             
             conn.commit()
             conn.close()
@@ -137,10 +330,10 @@ class DatabaseManager:
             cursor = conn.cursor()
             
             cursor.execute('''
-                SELECT user_name, message_text, timestamp, message_type, user_id
+                SELECT user_name, message_text, timestamp, message_type, user_id, id
                 FROM messages 
                 WHERE chat_id = ? 
-                ORDER BY timestamp DESC 
+                ORDER BY timestamp DESC, id DESC 
                 LIMIT ? OFFSET ?
             ''', (chat_id, limit, offset))
             
@@ -151,7 +344,8 @@ class DatabaseManager:
                     'text': row[1],
                     'timestamp': row[2],
                     'type': row[3],
-                    'user_id': row[4]
+                    'user_id': row[4],
+                    'id': row[5]
                 })
             
             conn.close()
@@ -161,6 +355,123 @@ class DatabaseManager:
             logger.error(f"Error getting recent messages: {e}")
             return []
     
+    def search_message_ids(self, chat_id: int, match_query: str, limit: int = 1000) -> List[int]:
+        """Полнотекстовый поиск в чате: id самых свежих совпадений"""
+        if not self.fts_enabled:
+            return []
+        try:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                SELECT rowid FROM messages_fts 
+                WHERE messages_fts MATCH ?
+                ORDER BY rowid DESC 
+                LIMIT ?
+            ''', (f"chat_key:{self.fts_chat_key(chat_id)} AND ({match_query})", limit))
+            
+            ids = [row[0] for row in cursor.fetchall()]
+            
+            conn.close()
+            return ids
+            
+        except Exception as e:
+            logger.error(f"Error searching messages: {e}")
+            return []
+    
+    def count_fulltext_matches(self, match_query: str) -> int:
+        """Число сообщений всех чатов, подходящих под запрос (для IDF)"""
+        if not self.fts_enabled:
+            return 0
+        try:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            cursor.execute('SELECT COUNT(*) FROM messages_fts WHERE messages_fts MATCH ?', (match_query,))
+            count = cursor.fetchone()[0]
+            
+            conn.close()
+            return count
+            
+        except Exception as e:
+            logger.error(f"Error counting full-text matches: {e}")
+            return 0
+    
+    def get_max_message_id(self) -> int:
+        """Наибольший id сообщения (оценка размера истории для IDF)"""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            cursor.execute('SELECT MAX(id) FROM messages')
+            row = cursor.fetchone()
+            
+            conn.close()
+            return row[0] or 0
+            
+        except Exception as e:
+            logger.error(f"Error getting max message id: {e}")
+            return 0
+    
+    def get_messages_by_ids(self, chat_id: int, message_ids: List[int]) -> List[Dict]:
+        """Сообщения чата по списку id (в хронологическом порядке)"""
+        if not message_ids:
+            return []
+        try:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            placeholders = ", ".join("?" for _ in message_ids)
+            cursor.execute(f'''
+                SELECT user_name, message_text, timestamp, message_type, user_id, id
+                FROM messages 
+                WHERE chat_id = ? AND id IN ({placeholders})
+                ORDER BY id
+            ''', (chat_id, *message_ids))
+            
+            messages = [
+                {
+                    'user': row[0],
+                    'text': row[1],
+                    'timestamp': row[2],
+                    'type': row[3],
+                    'user_id': row[4],
+                    'id': row[5]
+                }
+                for row in cursor.fetchall()
+            ]
+            
+            conn.close()
+            return messages
+            
+        except Exception as e:
+            logger.error(f"Error getting messages by ids: {e}")
+            return []
+    
+    def get_neighbour_message_ids(self, chat_id: int, message_ids: List[int], radius: int = 2) -> Dict[int, List[int]]:
+        """id соседних сообщений чата (radius до и после) для каждого сообщения"""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            neighbours = {}
+            for message_id in message_ids:
+                cursor.execute('''
+                    SELECT id FROM messages WHERE chat_id = ? AND id < ? ORDER BY id DESC LIMIT ?
+                ''', (chat_id, message_id, radius))
+                before = [row[0] for row in cursor.fetchall()]
+                cursor.execute('''
+                    SELECT id FROM messages WHERE chat_id = ? AND id > ? ORDER BY id LIMIT ?
+                ''', (chat_id, message_id, radius))
+                neighbours[message_id] = before + [row[0] for row in cursor.fetchall()]
+            
+            conn.close()
+            return neighbours
+            
+        except Exception as e:
+            logger.error(f"Error getting neighbour messages: {e}")
+            return {}
+    
     def get_user_messages(self, chat_id: int, user_name: str, 
                          limit: int = 100) -> List[Dict]:
         """Получение сообщений конкретного пользователя"""
@@ -201,10 +512,10 @@ class DatabaseManager:
             cursor = conn.cursor()
             
             cursor.execute('''
-                SELECT user_name, message_text, timestamp, message_type
+                SELECT user_name, message_text, timestamp, message_type, id
                 FROM messages 
                 WHERE chat_id = ? AND timestamp BETWEEN ? AND ?
-                ORDER BY timestamp ASC
+                ORDER BY timestamp ASC, id ASC
             ''', (chat_id, start_time, end_time))
             
             messages = [
@@ -212,7 +523,8 @@ class DatabaseManager:
                     'user': row[0],
                     'text': row[1],
                     'timestamp': row[2],
-                    'type': row[3]
+                    'type': row[3],
+                    'id': row[4]
                 }
                 for row in cursor.fetchall()
             ]
@@ -309,6 +621,26 @@ class DatabaseManager:
             logger.error(f"Error saving extracted text: {e}")
             return False
     
+    def get_extracted_text(self, chat_id: int, original_message_id: int) -> Optional[str]:
+        """Последний извлеченный из медиа текст для сообщения Telegram"""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                SELECT extracted_text FROM extracted_texts 
+                WHERE chat_id = ? AND original_message_id = ?
+                ORDER BY id DESC LIMIT 1
+            ''', (chat_id, original_message_id))
+            
+            row = cursor.fetchone()
+            conn.close()
+            return row[0] if row else None
+            
+        except Exception as e:
+            logger.error(f"Error getting extracted text: {e}")
+            return None
+    
     def log_command_usage(self, chat_id: int, user_id: int, 
                          command: str, success: bool = True) -> bool:
         """Логирование использования команд"""
@@ -395,6 +727,12 @@ class DatabaseManager:
                 WHERE created_at < ?
             ''', (cutoff_date,))
             
+            # И сводки сегментов, которые больше не попадут в окно
+            cursor.execute('''
+                DELETE FROM summary_segments 
+                WHERE created_at < ?
+            ''', (cutoff_date,))
+            
             conn.commit()
             conn.close()
             
@@ -442,7 +780,7 @@ class DatabaseManager:
             
             cursor.execute('''
                 SELECT daily_summary_enabled, summary_time, pin_summary, 
-                       bot_personality, language, created_at, updated_at
+                       bot_personality, language, created_at, updated_at, brief_precompute
                 FROM chat_settings 
                 WHERE chat_id = ?
             ''', (chat_id,))
@@ -458,7 +796,8 @@ class DatabaseManager:
                     'bot_personality': result[3],
                     'language': result[4],
                     'created_at': result[5],
-                    'updated_at': result[6]
+                    'updated_at': result[6],
+                    'brief_precompute': bool(result[7])
                 }
             else:
                 # Возвращаем настройки по умолчанию
@@ -469,7 +808,8 @@ class DatabaseManager:
                     'bot_personality': None,
                     'language': 'ru',
                     'created_at': None,
-                    'updated_at': None
+                    'updated_at': None,
+                    'brief_precompute': False
                 }
             
         except Exception as e:
@@ -484,7 +824,7 @@ class DatabaseManager:
             
             allowed_fields = {
                 'daily_summary_enabled', 'summary_time', 'pin_summary',
-                'bot_personality', 'language'
+                'bot_personality', 'language', 'brief_precompute'
             }
             
             update_fields = []
@@ -515,6 +855,568 @@ class DatabaseManager:
         except Exception as e:
             logger.error(f"Error updating chat settings: {e}")
             return False
-        
-
-        
\ No newline at end of file
+    
+    # Методы для работы с квотами AI запросов
+    
+    def get_quota_limits(self) -> List[Tuple]:
+        """Индивидуальные лимиты квот: (scope, scope_id, max_requests, max_tokens)"""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                SELECT scope, scope_id, max_requests, max_tokens
+                FROM ai_quota_limits
+            ''')
+            
+            rows = cursor.fetchall()
+            conn.close()
+            return rows
+            
+        except Exception as e:
+            logger.error(f"Error getting quota limits: {e}")
+            return []
+    
+    def set_quota_limit(self, scope: str, scope_id: int, max_requests: int, max_tokens: int) -> bool:
+        """Сохранение индивидуального лимита квоты"""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                INSERT OR REPLACE INTO ai_quota_limits
+                (scope, scope_id, max_requests, max_tokens, updated_at)
+                VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
+            ''', (scope, scope_id, max_requests, max_tokens))
+            
+            conn.commit()
+            conn.close()
+            return True
+            
+        except Exception as e:
+            logger.error(f"Error setting quota limit: {e}")
+            return False
+    
+    def load_quota_usage(self, since: int) -> List[Tuple]:
+        """Сохраненные корзины счетчиков квот начиная с since (unix time)"""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                SELECT scope, scope_id, bucket_start, requests, tokens
+                FROM ai_quota_usage
+                WHERE bucket_start >= ?
+                ORDER BY bucket_start
+            ''', (since,))
+            
+            rows = cursor.fetchall()
+            conn.close()
+            return rows
+            
+        except Exception as e:
+            logger.error(f"Error loading quota usage: {e}")
+            return []
+    
+    def save_quota_usage(self, rows: List[Tuple], cutoff: int) -> bool:
+        """Сохранение корзин счетчиков квот и удаление устаревших (старше cutoff)"""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            cursor.executemany('''
+                INSERT OR REPLACE INTO ai_quota_usage
+                (scope, scope_id, bucket_start, requests, tokens)
+                VALUES (?, ?, ?, ?, ?)
+            ''', rows)
+            cursor.execute('DELETE FROM ai_quota_usage WHERE bucket_start < ?', (cutoff,))
+            
+            conn.commit()
+            conn.close()
+            return True
+            
+        except Exception as e:
+            logger.error(f"Error saving quota usage: {e}")
+            return False
+    
+    # Методы для учета AI вызовов
+    
+    def save_ai_usage(self, rows: List[Tuple]) -> bool:
+        """Пакетное сохранение записей об AI вызовах"""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            cursor.executemany('''
+                INSERT INTO ai_usage 
+                (timestamp, chat_id, command, provider, model, prompt_tokens,
+                 completion_tokens, latency_ms, cache_hit, retries, success)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            ''', rows)
+            
+            conn.commit()
+            conn.close()
+            return True
+            
+        except Exception as e:
+            logger.error(f"Error saving AI usage: {e}")
+            return False
+    
+    def get_ai_usage_report(self, days: int = 7, chat_id: int = None) -> Dict:
+        """Сводка AI вызовов по командам и моделям за период"""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            since = (datetime.now() - timedelta(days=days)).isoformat(sep=' ', timespec='seconds')
+            where = "WHERE timestamp >= ?"
+            params = [since]
+            if chat_id is not None:
+                where += " AND chat_id = ?"
+                params.append(chat_id)
+            
+            report = {}
+            for group, column in (('commands', 'command'), ('models', "provider || ':' || model")):
+                cursor.execute(f'''
+                    SELECT {column}, COUNT(*), SUM(prompt_tokens), SUM(completion_tokens),
+                           AVG(latency_ms), MAX(latency_ms), SUM(cache_hit), SUM(retries),
+                           SUM(CASE WHEN success THEN 0 ELSE 1 END)
+                    FROM ai_usage 
+                    {where}
+                    GROUP BY 1
+                    ORDER BY 2 DESC
+                ''', params)
+                report[group] = [
+                    {
+                        'name': row[0] or 'other',
+                        'calls': row[1],
+                        'prompt_tokens': row[2] or 0,
+                        'completion_tokens': row[3] or 0,
+                        'avg_latency_ms': row[4] or 0,
+                        'max_latency_ms': row[5] or 0,
+                        'cache_hits': row[6] or 0,
+                        'retries': row[7] or 0,
+                        'errors': row[8] or 0
+                    }
+                    for row in cursor.fetchall()
+                ]
+            
+            conn.close()
+            return report
+            
+        except Exception as e:
+            logger.error(f"Error getting AI usage report: {e}")
+            return {}
+    
+    # Методы для кэша сводок сегментов
+    
+    def get_summary_segments(self, chat_id: int, start_id: int, end_id: int) -> List[Dict]:
+        """Сводки сегментов, целиком лежащих в диапазоне сообщений [start_id, end_id]"""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                SELECT start_id, end_id, message_count, summary
+                FROM summary_segments 
+                WHERE chat_id = ? AND start_id >= ? AND end_id <= ?
+                ORDER BY start_id
+            ''', (chat_id, start_id, end_id))
+            
+            segments = [
+                {
+                    'start_id': row[0],
+                    'end_id': row[1],
+                    'message_count': row[2],
+                    'summary': row[3]
+                }
+                for row in cursor.fetchall()
+            ]
+            
+            conn.close()
+            return segments
+            
+        except Exception as e:
+            logger.error(f"Error getting summary segments: {e}")
+            return []
+    
+    def save_summary_segment(self, chat_id: int, start_id: int, end_id: int,
+                             message_count: int, summary: str) -> bool:
+        """Сохранение сводки сегмента"""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                INSERT OR REPLACE INTO summary_segments 
+                (chat_id, start_id, end_id, message_count, summary)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (chat_id, start_id, end_id, message_count, summary))
+            
+            conn.commit()
+            conn.close()
+            return True
+            
+        except Exception as e:
+            logger.error(f"Error saving summary segment: {e}")
+            return False
+    
+    # Методы для профилей участников
+    
+    def get_profile_progress(self, chat_id: int) -> int:
+        """id последнего сообщения чата, учтенного в профилях участников"""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            cursor.execute('SELECT last_message_id FROM user_profile_progress WHERE chat_id = ?', (chat_id,))
+            row = cursor.fetchone()
+            conn.close()
+            return row[0] if row else 0
+            
+        except Exception as e:
+            logger.error(f"Error getting profile progress: {e}")
+            return 0
+    
+    def get_user_profiles(self, chat_id: int, user_names: List[str]) -> Dict[str, Dict]:
+        """Сохраненные профили участников чата по именам"""
+        if not user_names:
+            return {}
+        try:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            placeholders = ", ".join("?" for _ in user_names)
+            cursor.execute(f'''
+                SELECT user_name, counters, terms, narrative, narrative_message_count, narrative_key, updated_at
+                FROM user_profiles 
+                WHERE chat_id = ? AND user_name IN ({placeholders})
+            ''', (chat_id, *user_names))
+            
+            profiles = {
+                row[0]: {
+                    'counters': json.loads(row[1]),
+                    'terms': json.loads(row[2]),
+                    'narrative': row[3],
+                    'narrative_message_count': row[4] or 0,
+                    'narrative_key': row[5],
+                    'updated_at': row[6]
+                }
+                for row in cursor.fetchall()
+            }
+            
+            conn.close()
+            return profiles
+            
+        except Exception as e:
+            logger.error(f"Error getting user profiles: {e}")
+            return {}
+    
+    def save_user_profiles(self, chat_id: int, profiles: Dict[str, Dict], last_message_id: int) -> bool:
+        """Сохранение счетчиков профилей и прогресса чата одной транзакцией"""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            now = datetime.now().isoformat(sep=' ', timespec='seconds')
+            
+            cursor.executemany('''
+                INSERT INTO user_profiles (chat_id, user_name, counters, terms, updated_at)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(chat_id, user_name) DO UPDATE SET
+                    counters = excluded.counters,
+                    terms = excluded.terms,
+                    updated_at = excluded.updated_at
+            ''', [
+                (chat_id, user_name, json.dumps(profile['counters']),
+                 json.dumps(profile['terms'], ensure_ascii=False), now)
+                for user_name, profile in profiles.items()
+            ])
+            cursor.execute('''
+                INSERT OR REPLACE INTO user_profile_progress (chat_id, last_message_id)
+                VALUES (?, ?)
+            ''', (chat_id, last_message_id))
+            
+            conn.commit()
+            conn.close()
+            return True
+            
+        except Exception as e:
+            logger.error(f"Error saving user profiles: {e}")
+            return False
+    
+    def save_profile_narrative(self, chat_id: int, user_name: str, narrative: str,
+                               message_count: int, narrative_key: str) -> bool:
+        """Сохранение AI-описания стиля участника"""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                UPDATE user_profiles 
+                SET narrative = ?, narrative_message_count = ?, narrative_key = ?
+                WHERE chat_id = ? AND user_name = ?
+            ''', (narrative, message_count, narrative_key, chat_id, user_name))
+            
+            conn.commit()
+            conn.close()
+            return True
+            
+        except Exception as e:
+            logger.error(f"Error saving profile narrative: {e}")
+            return False
+    
+    # Методы для ежедневных дайджестов
+    
+    def get_daily_digest(self, chat_id: int) -> Optional[Dict]:
+        """Готовый дайджест чата"""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                SELECT summary, message_count, last_message_id, updated_at
+                FROM daily_digests 
+                WHERE chat_id = ?
+            ''', (chat_id,))
+            
+            row = cursor.fetchone()
+            conn.close()
+            
+            if not row:
+                return None
+            return {
+                'summary': row[0],
+                'message_count': row[1],
+                'last_message_id': row[2],
+                'updated_at': row[3]
+            }
+            
+        except Exception as e:
+            logger.error(f"Error getting daily digest: {e}")
+            return None
+    
+    def save_daily_digest(self, chat_id: int, summary: str, message_count: int,
+                          last_message_id: int) -> bool:
+        """Сохранение дайджеста чата"""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                INSERT OR REPLACE INTO daily_digests 
+                (chat_id, summary, message_count, last_message_id, updated_at)
+                VALUES (?, ?, ?, ?, ?)
+            ''', (chat_id, summary, message_count, last_message_id,
+                  datetime.now().isoformat(sep=' ', timespec='seconds')))
+            
+            conn.commit()
+            conn.close()
+            return True
+            
+        except Exception as e:
+            logger.error(f"Error saving daily digest: {e}")
+            return False
+    
+    def get_last_message_id(self, chat_id: int) -> Optional[int]:
+        """id последнего сохраненного сообщения чата"""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            cursor.execute('SELECT MAX(id) FROM messages WHERE chat_id = ?', (chat_id,))
+            row = cursor.fetchone()
+            conn.close()
+            return row[0] if row else None
+            
+        except Exception as e:
+            logger.error(f"Error getting last message id: {e}")
+            return None
+    
+    def get_messages_after(self, chat_id: int, message_id: int, limit: int = 1000) -> List[Dict]:
+        """Сообщения чата после сообщения с данным id (в порядке сохранения)"""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                SELECT user_name, message_text, timestamp, message_type, user_id, id, reply_to_message_id
+                FROM messages 
+                WHERE chat_id = ? AND id > ?
+                ORDER BY id
+                LIMIT ?
+            ''', (chat_id, message_id, limit))
+            
+            messages = [
+                {
+                    'user': row[0],
+                    'text': row[1],
+                    'timestamp': row[2],
+                    'type': row[3],
+                    'user_id': row[4],
+                    'id': row[5],
+                    'reply_to': row[6]
+                }
+                for row in cursor.fetchall()
+            ]
+            
+            conn.close()
+            return messages
+            
+        except Exception as e:
+            logger.error(f"Error getting messages after id: {e}")
+            return []
+    
+    def get_reply_links_after(self, chat_id: int, message_id: int, limit: int = 5000) -> List[Tuple]:
+        """(id, Telegram id, Telegram id родителя) сообщений чата после данного id"""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                SELECT id, tg_message_id, reply_to_message_id
+                FROM messages 
+                WHERE chat_id = ? AND id > ?
+                ORDER BY id
+                LIMIT ?
+            ''', (chat_id, message_id, limit))
+            links = cursor.fetchall()
+            
+            conn.close()
+            return links
+            
+        except Exception as e:
+            logger.error(f"Error getting reply links: {e}")
+            return []
+    
+    def get_window_start_id(self, chat_id: int, start_time: datetime, max_messages: int) -> int:
+        """id, после которого начинаются сообщения чата с start_time (не больше max_messages последних)"""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                SELECT MIN(id) FROM messages WHERE chat_id = ? AND timestamp >= ?
+            ''', (chat_id, start_time.isoformat(sep=' ', timespec='seconds')))
+            row = cursor.fetchone()
+            start_id = row[0] - 1 if row and row[0] is not None else 0
+            
+            cursor.execute('''
+                SELECT id FROM messages WHERE chat_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?
+            ''', (chat_id, max_messages))
+            row = cursor.fetchone()
+            
+            conn.close()
+            return max(start_id, row[0]) if row else start_id
+            
+        except Exception as e:
+            logger.error(f"Error getting window start id: {e}")
+            return 0
+    
+    def count_messages_since(self, chat_id: int, message_id: int) -> int:
+        """Количество сообщений чата после сообщения с данным id"""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            cursor.execute('SELECT COUNT(*) FROM messages WHERE chat_id = ? AND id > ?', (chat_id, message_id))
+            count = cursor.fetchone()[0]
+            
+            conn.close()
+            return count
+            
+        except Exception as e:
+            logger.error(f"Error counting new messages: {e}")
+            return 0
+    
+    def get_daily_summary_chats(self, hours: int = 24) -> List[Dict]:
+        """Чаты с сообщениями за период и включенной ежедневной суммаризацией"""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            since = datetime.now() - timedelta(hours=hours)
+            cursor.execute('''
+                SELECT m.chat_id, COALESCE(s.summary_time, '21:00')
+                FROM (SELECT DISTINCT chat_id FROM messages WHERE timestamp >= ?) m
+                LEFT JOIN chat_settings s ON s.chat_id = m.chat_id
+                WHERE COALESCE(s.daily_summary_enabled, 1) = 1
+            ''', (since,))
+            
+            chats = [{'chat_id': row[0], 'summary_time': row[1]} for row in cursor.fetchall()]
+            
+            conn.close()
+            return chats
+            
+        except Exception as e:
+            logger.error(f"Error getting daily summary chats: {e}")
+            return []
+    
+    # Методы для кэша кратких изложений
+    
+    def get_cached_brief(self, content_hash: str) -> Optional[str]:
+        """Краткое изложение по хэшу текста (с отметкой об использовании)"""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            cursor.execute('SELECT brief FROM brief_cache WHERE content_hash = ?', (content_hash,))
+            row = cursor.fetchone()
+            if row:
+                cursor.execute('''
+                    UPDATE brief_cache SET hits = hits + 1, last_used_at = ?
+                    WHERE content_hash = ?
+                ''', (datetime.now().isoformat(sep=' ', timespec='seconds'), content_hash))
+                conn.commit()
+            
+            conn.close()
+            return row[0] if row else None
+            
+        except Exception as e:
+            logger.error(f"Error getting cached brief: {e}")
+            return None
+    
+    def save_cached_brief(self, content_hash: str, brief: str, source_length: int) -> bool:
+        """Сохранение краткого изложения"""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            now = datetime.now().isoformat(sep=' ', timespec='seconds')
+            cursor.execute('''
+                INSERT OR REPLACE INTO brief_cache 
+                (content_hash, brief, source_length, hits, created_at, last_used_at)
+                VALUES (?, ?, ?, 0, ?, ?)
+            ''', (content_hash, brief, source_length, now, now))
+            
+            conn.commit()
+            conn.close()
+            return True
+            
+        except Exception as e:
+            logger.error(f"Error saving cached brief: {e}")
+            return False
+    
+    def prune_brief_cache(self, max_rows: int, max_age_days: int) -> int:
+        """Вытеснение устаревших и давно не использованных изложений"""
+        try:
+            conn = sqlite3.connect(self.db_path)
+            cursor = conn.cursor()
+            
+            cutoff = (datetime.now() - timedelta(days=max_age_days)).isoformat(sep=' ', timespec='seconds')
+            cursor.execute('DELETE FROM brief_cache WHERE last_used_at < ?', (cutoff,))
+            removed = cursor.rowcount
+            
+            cursor.execute('''
+                DELETE FROM brief_cache WHERE content_hash NOT IN (
+                    SELECT content_hash FROM brief_cache ORDER BY last_used_at DESC LIMIT ?
+                )
+            ''', (max_rows,))
+            removed += cursor.rowcount
+            
+            conn.commit()
+            conn.close()
+            return removed
+            
+        except Exception as e:
+            logger.error(f"Error pruning brief cache: {e}")
+            return 0
@@ -0,0 +1,131 @@
+import asyncio
+import logging
+import time
+from datetime import datetime, timedelta
+from typing import Dict, Optional
+
+from config import config
+from ai_client import is_local_fallback
+from ai_queue import AIPriority
+
+logger = logging.getLogger(__name__)
+
+
+class DailyDigestBuilder:
+    """Фоновое построение ежедневных дайджестов чатов
+
+    В течение дня дайджест (суммаризация последних 24 часов) пересчитывается
+    в фоне: после каждых AI_DIGEST_EVERY_MESSAGES сообщений или когда чат
+    затих на AI_DIGEST_QUIET_SECONDS. Благодаря кэшу сегментов каждый
+    пересчет стоит только новых сообщений. В summary_time отправка сводится
+    к чтению готового дайджеста из базы и вызову Telegram: дайджест
+    отправляется, даже если после него пришло несколько сообщений.
+    """
+
+    def __init__(self):
+        self.db = None
+        self.summary_handler = None
+        self._pending: Dict[int, int] = {}
+        self._last_message_at: Dict[int, float] = {}
+        self._locks: Dict[int, asyncio.Lock] = {}
+
+    def attach(self, db, summary_handler):
+        self.db = db
+        self.summary_handler = summary_handler
+
+    def note_message(self, chat_id: int):
+        """Учет нового сообщения чата (вызывается при сохранении)"""
+        self._pending[chat_id] = self._pending.get(chat_id, 0) + 1
+        self._last_message_at[chat_id] = time.monotonic()
+
+    async def refresh_due(self, upcoming_chats=()):
+        """Пересчет дайджестов, которые пора обновить
+
+        upcoming_chats - чаты, у которых скоро summary_time: их дайджест
+        обновляется, даже если порог сообщений не набран. Одновременно
+        пересчитывается не больше AI_DIGEST_CONCURRENCY дайджестов.
+        """
+        if not self.db:
+            return
+
+        now = time.monotonic()
+        due = [
+            chat_id for chat_id, pending in self._pending.items()
+            if pending >= config.AI_DIGEST_EVERY_MESSAGES
+            or (pending and now - self._last_message_at.get(chat_id, now) >= config.AI_DIGEST_QUIET_SECONDS)
+        ]
+        due.extend(chat_id for chat_id in upcoming_chats if chat_id not in due and self._is_stale(chat_id))
+
+        semaphore = asyncio.Semaphore(config.AI_DIGEST_CONCURRENCY)
+
+        async def refresh(chat_id: int):
+            async with semaphore:
+                await self.build(chat_id, priority=AIPriority.BULK)
+
+        await asyncio.gather(*(refresh(chat_id) for chat_id in due))
+
+    def _is_stale(self, chat_id: int) -> bool:
+        digest = self.db.get_daily_digest(chat_id)
+        return digest is None or digest['last_message_id'] != self.db.get_last_message_id(chat_id)
+
+    def _lock(self, chat_id: int) -> asyncio.Lock:
+        return self._locks.setdefault(chat_id, asyncio.Lock())
+
+    async def build(self, chat_id: int, priority: AIPriority = AIPriority.BULK) -> Optional[Dict]:
+        """Построение дайджеста за последние 24 часа и сохранение в базу"""
+        async with self._lock(chat_id):
+            return await self._build(chat_id, priority)
+
+    async def _build(self, chat_id: int, priority: AIPriority) -> Optional[Dict]:
+        try:
+            settings = self.db.get_chat_settings(chat_id)
+            if not settings.get('daily_summary_enabled', True):
+                self._pending.pop(chat_id, None)
+                return None
+
+            pending = self._pending.pop(chat_id, 0)
+            end_time = datetime.now()
+            messages = self.db.get_messages_by_time_range(chat_id, end_time - timedelta(hours=24), end_time)
+            if not messages:
+                return None
+
+            started = time.monotonic()
+            summary = await self.summary_handler._create_summary(
+                messages,
+                self.summary_handler._get_bot_personality(chat_id),
+                chat_id=chat_id,
+                priority=priority
+            )
+            if not summary or summary.startswith("❌") or is_local_fallback(summary):
+                # Повторим при следующей проверке
+                self._pending[chat_id] = self._pending.get(chat_id, 0) + pending
+                return None
+
+            last_message_id = max(msg['id'] for msg in messages)
+            self.db.save_daily_digest(chat_id, summary, len(messages), last_message_id)
+            logger.info(f"🗞️ Дайджест чата {chat_id} обновлен: {len(messages)} сообщений "
+                        f"за {time.monotonic() - started:.1f}с")
+            return {'summary': summary, 'message_count': len(messages), 'last_message_id': last_message_id}
+
+        except Exception as e:
+            logger.error(f"Error building daily digest for chat {chat_id}: {e}")
+            return None
+
+    async def get_digest(self, chat_id: int) -> Optional[Dict]:
+        """Сохраненный дайджест не старше AI_DIGEST_MAX_AGE_MINUTES
+
+        Новые сообщения после дайджеста не повод считать его заново: их
+        учтет фоновый пересчет. Если пересчет идет прямо сейчас, ждем его.
+        Строится заново только отсутствующий или устаревший дайджест.
+        """
+        async with self._lock(chat_id):
+            digest = self.db.get_daily_digest(chat_id)
+            if digest:
+                updated_at = datetime.fromisoformat(digest['updated_at'])
+                if datetime.now() - updated_at <= timedelta(minutes=config.AI_DIGEST_MAX_AGE_MINUTES):
+                    return digest
+            return await self._build(chat_id, priority=AIPriority.BACKGROUND)
+
+
+# Общий построитель дайджестов: обработчики сообщений сообщают ему о новых сообщениях
+digest_builder = DailyDigestBuilder()
@@ -6,10 +6,27 @@ from telegram import Update
 from telegram.ext import ContextTypes
 from config import config
 from database import DatabaseManager
-from ai_client import AIClient  # Добавляем импорт универсального клиента
+from ai_client import AIClient, is_local_fallback  # Добавляем импорт универсального клиента
+from quota import quota_manager
+from token_budget import get_history_budget, pack_messages
+from noise_filter import filter_noise
+from phrase_matcher import PhraseMatcher
+from user_profiles import profile_store
+from chat_analytics import chat_analytics
+from threads import thread_index
+from topic_segmenter import topic_segmenter
+from ai_usage import usage_tracker
 
 logger = logging.getLogger(__name__)
 
+# Фразы, которые могут быть восприняты негативно
+NEGATIVE_TONE = PhraseMatcher({
+    "negative": [
+        "плохой", "негативный", "слабый", "неудачный",
+        "проблема с", "недостаток", "минус", "отрицательный"
+    ],
+})
+
 class AnalysisHandler:
     """Обработчик команд анализа участников и комментариев"""
     
@@ -42,6 +59,12 @@ class AnalysisHandler:
                 await message.reply_text("❌ Укажите имя пользователя для анализа.")
                 return
             
+            # Без явного количества сообщений отвечаем по профилю участника,
+            # пока профили чата догоняют историю - по последним сообщениям
+            if len(context.args) == 1 and profile_store.is_ready(chat_id):
+                await self._opinion_from_profile(update, username)
+                return
+            
             # Получаем сообщения пользователя
             user_messages = self.db.get_user_messages(chat_id, username, message_limit)
             
@@ -55,6 +78,10 @@ class AnalysisHandler:
                 )
                 return
             
+            # Проверяем квоту AI запросов
+            if not await quota_manager.enforce(update, "opinion"):
+                return
+            
             # Сообщение о обработке
             processing_msg = await message.reply_text(
                 f"🔍 Анализирую стиль общения {username}..."
@@ -64,7 +91,7 @@ class AnalysisHandler:
             personality = self._get_bot_personality(chat_id)
             
             # Анализируем пользователя
-            analysis = await self._analyze_user_behavior(username, user_messages, personality)
+            analysis = await self._analyze_user_behavior(username, user_messages, personality, chat_id=chat_id)
             
             # Удаляем сообщение о обработке
             await processing_msg.delete()
@@ -77,14 +104,71 @@ class AnalysisHandler:
             logger.error(f"Error in handle_opinion: {e}")
             await self._send_error_message(update, "при анализе пользователя")
     
+    async def handle_stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработка команды /stats - локальная статистика чата без AI"""
+        try:
+            chat_id = update.effective_chat.id
+            message = update.effective_message
+            
+            days = config.STATS_REPORT_DEFAULT_DAYS
+            if context.args:
+                try:
+                    days = max(1, min(int(context.args[0]), config.STATS_WINDOW_DAYS))
+                except ValueError:
+                    await message.reply_text(f"📏 Укажите период в днях: `/stats 30` (до {config.STATS_WINDOW_DAYS})")
+                    return
+            
+            await message.reply_text(chat_analytics.report(chat_id, days), parse_mode='Markdown')
+            
+        except Exception as e:
+            logger.error(f"Error in handle_stats: {e}")
+            await self._send_error_message(update, "при подсчете статистики")
+    
+    async def _opinion_from_profile(self, update: Update, username: str):
+        """/opinion по профилю: статистика считается локально, AI-описание берется из кэша"""
+        chat_id = update.effective_chat.id
+        message = update.effective_message
+        
+        await profile_store.update_chat_async(chat_id)
+        profile = profile_store.get_profile(chat_id, username)
+        if not profile:
+            await message.reply_text(
+                f"📭 Не найдено сообщений от пользователя '{username}'.\n"
+                f"Убедитесь, что:\n"
+                f"• Пользователь писал сообщения в этом чате\n"
+                f"• Имя указано правильно\n"
+                f"• Сообщения не удалены из истории"
+            )
+            return
+        
+        stats = profile.format_stats()
+        personality = self._get_bot_personality(chat_id)
+        analysis = profile_store.fresh_narrative(profile, personality)
+        if analysis:
+            usage_tracker.record_cache_hit("opinion", chat_id)
+        else:
+            if not await quota_manager.enforce(update, "opinion"):
+                return
+            
+            processing_msg = await message.reply_text(f"🔍 Анализирую стиль общения {username}...")
+            user_messages = self.db.get_user_messages(chat_id, username, config.OPINION_DEFAULT_MESSAGES)
+            analysis = await self._analyze_user_behavior(username, user_messages, personality,
+                                                         chat_id=chat_id, stats=stats)
+            await processing_msg.delete()
+            if not analysis.startswith("❌") and not is_local_fallback(analysis):
+                profile_store.save_narrative(chat_id, profile, analysis, personality)
+        
+        response_text = self._format_opinion_response(username, analysis, profile.message_count, stats=stats)
+        await message.reply_text(response_text, parse_mode='Markdown')
+    
     async def handle_comment(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка команды /comment - анализ и комментарий к текущей теме"""
         try:
             chat_id = update.effective_chat.id
             message = update.effective_message
             
-            # Получаем последние сообщения для анализа текущей темы
-            messages = self.db.get_recent_messages(chat_id, config.COMMENT_MESSAGE_LIMIT)
+            # Получаем сообщения текущего обсуждения (без параллельных веток)
+            messages = self._get_current_discussion(chat_id)
             
             if not messages:
                 await message.reply_text(
@@ -93,6 +177,10 @@ class AnalysisHandler:
                 )
                 return
             
+            # Проверяем квоту AI запросов
+            if not await quota_manager.enforce(update, "comment"):
+                return
+            
             # Сообщение о обработке
             processing_msg = await message.reply_text(
                 "💭 Анализирую текущее обсуждение..."
@@ -102,7 +190,7 @@ class AnalysisHandler:
             personality = self._get_bot_personality(chat_id)
             
             # Создаем комментарий к текущей теме
-            comment = await self._create_topic_comment(messages, personality)
+            comment = await self._create_topic_comment(messages, personality, chat_id=chat_id)
             
             # Удаляем сообщение о обработке
             await processing_msg.delete()
@@ -115,9 +203,35 @@ class AnalysisHandler:
             logger.error(f"Error in handle_comment: {e}")
             await self._send_error_message(update, "при анализе текущей темы")
     
-    async def _analyze_user_behavior(self, username: str, messages: List[Dict], personality: str = "") -> str:
-        """Анализ поведения и характеристик пользователя с помощью Yandex GPT"""
+    def _get_current_discussion(self, chat_id: int) -> List[Dict]:
+        """Последние сообщения текущего обсуждения: с начала текущей темы и с учетом веток ответов"""
+        # Дальше окно разбирается от старых к новым: конец окна - самые свежие сообщения
+        window = sorted(self.db.get_recent_messages(chat_id, config.COMMENT_WINDOW_MESSAGES), key=lambda msg: msg['id'])
+        topic_start = topic_segmenter.current_topic_start(chat_id)
+        if topic_start:
+            topic = [msg for msg in window if msg['id'] >= topic_start]
+            if len(topic) >= config.TOPIC_MIN_SEGMENT:
+                window = topic
+        window_ids = [msg['id'] for msg in window]
+        selected = thread_index.current_conversation(chat_id, window_ids, config.COMMENT_THREAD_TAIL)
+        if selected == window_ids:
+            return window[-config.COMMENT_MESSAGE_LIMIT:]
+        
+        by_id = {msg['id']: msg for msg in window}
+        missing = [message_id for message_id in selected if message_id not in by_id]
+        for msg in self.db.get_messages_by_ids(chat_id, missing):
+            by_id[msg['id']] = msg
+        messages = [by_id[message_id] for message_id in selected if message_id in by_id]
+        return messages[-config.COMMENT_MESSAGE_LIMIT:]
+    
+    async def _analyze_user_behavior(self, username: str, messages: List[Dict], personality: str = "",
+                                     chat_id: Optional[int] = None, stats: str = "") -> str:
+        """Анализ поведения и характеристик пользователя с помощью Yandex GPT
+        
+        stats - статистика стиля из профиля участника, если она уже посчитана.
+        """
         messages_text = self._format_user_messages_for_analysis(messages)
+        stats_text = f"**Статистика по всей истории (посчитана точно):**\n{stats}\n\n" if stats else ""
         
         system_message = self._build_system_message(
             base_role=(
@@ -135,7 +249,7 @@ class AnalysisHandler:
 **Пользователь:** {username}
 **Количество сообщений:** {len(messages)}
 
-**Сообщения пользователя:**
+{stats_text}**Сообщения пользователя:**
 {messages_text}
 
 **Проанализируй следующие аспекты:**
@@ -181,7 +295,9 @@ class AnalysisHandler:
         analysis = await self.ai_client.chat_completion(
             ai_messages,
             max_tokens=config.ANALYSIS_MAX_TOKENS,
-            temperature=0.5
+            temperature=0.5,
+            chat_id=chat_id,
+            command="opinion"
         )
         
         if not analysis:
@@ -189,7 +305,8 @@ class AnalysisHandler:
         
         return self._validate_analysis_tone(analysis)
     
-    async def _create_topic_comment(self, messages: List[Dict], personality: str = "") -> str:
+    async def _create_topic_comment(self, messages: List[Dict], personality: str = "",
+                                    chat_id: Optional[int] = None) -> str:
         """Создание комментария к текущей теме обсуждения с помощью Yandex GPT"""
         conversation_text = self._format_messages_for_topic_analysis(messages)
         
@@ -249,7 +366,9 @@ class AnalysisHandler:
         comment = await self.ai_client.chat_completion(
             ai_messages,
             max_tokens=800,
-            temperature=0.7
+            temperature=0.7,
+            chat_id=chat_id,
+            command="comment"
         )
         
         if not comment:
@@ -280,56 +399,44 @@ class AnalysisHandler:
     
     def _format_user_messages_for_analysis(self, messages: List[Dict]) -> str:
         """Форматирование сообщений пользователя для анализа"""
-        formatted = []
-        for i, msg in enumerate(messages, 1):
-            text = msg.get('text', '')
-            timestamp = msg.get('timestamp', '')
-            
-            if text and len(text.strip()) > 0:
-                # Обрезаем очень длинные сообщения
-                if len(text) > 150:
-                    text = text[:147] + "..."
-                formatted.append(f"{i}. [{timestamp}] {text}")
-        
-        return "\n".join(formatted[:50])  # Ограничиваем 50 сообщениями для анализа
+        # Сообщения пользователя идут от новых к старым
+        messages, _ = filter_noise(messages, newest_first=True)
+        packed = pack_messages(
+            messages,
+            formatter=lambda i, msg, text: f"{i}. [{msg.get('timestamp', '')}] {text}",
+            budget=get_history_budget(config.ANALYSIS_MAX_TOKENS, command="opinion"),
+            max_chars=150,
+            newest_first=True
+        )
+        return packed.text
     
     def _format_messages_for_topic_analysis(self, messages: List[Dict]) -> str:
         """Форматирование сообщений для анализа темы"""
-        formatted = []
-        for msg in messages:
-            user = msg.get('user', 'Unknown')
-            text = msg.get('text', '')
-            
-            if text and len(text.strip()) > 0:
-                # Обрезаем длинные сообщения
-                if len(text) > 100:
-                    text = text[:97] + "..."
-                formatted.append(f"{user}: {text}")
-        
-        return "\n".join(formatted)
+        messages, _ = filter_noise(messages)
+        packed = pack_messages(
+            messages,
+            formatter=lambda i, msg, text: f"{msg.get('user', 'Unknown')}: {text}",
+            budget=get_history_budget(800, command="comment"),
+            max_chars=100
+        )
+        return packed.text
     
     def _validate_analysis_tone(self, analysis: str) -> str:
         """Проверка тона анализа на предмет тактичности"""
-        # Список фраз, которые могут быть восприняты негативно
-        negative_phrases = [
-            "плохой", "негативный", "слабый", "неудачный", 
-            "проблема с", "недостаток", "минус", "отрицательный"
-        ]
-        
-        analysis_lower = analysis.lower()
-        if any(phrase in analysis_lower for phrase in negative_phrases):
+        if NEGATIVE_TONE.matches(analysis):
             # Добавляем дисклеймер о тактичности
             disclaimer = "\n\n---\n*Анализ основан исключительно на стиле коммуникации и не является оценкой личности.*"
             return analysis + disclaimer
         
         return analysis
     
-    def _format_opinion_response(self, username: str, analysis: str, message_count: int) -> str:
+    def _format_opinion_response(self, username: str, analysis: str, message_count: int, stats: str = "") -> str:
         """Форматирование ответа для /opinion"""
+        stats_block = f"\n**📈 Статистика:**\n{stats}\n" if stats else ""
         return f"""👤 **Анализ стиля общения:** @{username}
 
 **📊 Проанализировано сообщений:** {message_count}
-
+{stats_block}
 **🔍 Результаты анализа:**
 {analysis}
 
@@ -8,15 +8,70 @@ from telegram.ext import ContextTypes
 from config import config
 from database import DatabaseManager
 from ai_client import AIClient  # Импортируем наш универсальный клиент
+from quota import quota_manager
+from token_budget import estimate_tokens, get_history_budget, pack_messages
+from noise_filter import filter_noise
+from retrieval import ChatRetriever
+from answer_cache import SCOPE_ASK, SCOPE_GPT, answer_cache
+from ai_client import is_local_fallback
+from ai_usage import usage_tracker
+from phrase_matcher import PhraseMatcher
+from ask_sessions import AskSession, ask_sessions
 
 logger = logging.getLogger(__name__)
 
+# Типы вопросов /gpt в порядке приоритета
+QUESTION_TYPES = PhraseMatcher({
+    "how_to": ['как', 'how to', 'инструкция', 'руководство'],
+    "definition": ['что такое', 'что значит', 'определение', 'definition'],
+    "explanation": ['почему', 'why', 'причина', 'cause'],
+    "comparison": ['сравни', 'difference', 'разница', 'vs', 'или'],
+    "list": ['список', 'list', 'перечень', 'примеры'],
+    "advice": ['совет', 'tip', 'recommend'],
+})
+
+# Частые вопросы, на которые есть ответ без AI
+FALLBACK_TOPICS = PhraseMatcher({
+    "greeting": ['привет', 'hello', 'hi', 'здравствуй'],
+    "how_are_you": ['как дела', 'how are you'],
+    "help": ['помощь', 'help', 'команды'],
+    "abilities": ['что ты умеешь', 'функции'],
+})
+
+# Признаки ответа "в истории чата этого нет"
+EVASIVE_PHRASES = PhraseMatcher({
+    "evasive": [
+        "не могу найти",
+        "не упоминается",
+        "не достаточно информации",
+        "информации нет",
+        "не говорится",
+        "не обсуждалось",
+        "в предоставленных сообщениях нет",
+        "не удалось найти"
+    ],
+})
+
+# С каких слов начинается уточняющий вопрос без знака вопроса
+FOLLOW_UP_WORDS = {
+    'а', 'кто', 'что', 'где', 'когда', 'куда', 'откуда', 'почему', 'зачем', 'как', 'какой', 'какая',
+    'какое', 'какие', 'каким', 'чей', 'чья', 'сколько', 'ли', 'расскажи', 'уточни', 'объясни', 'подробнее',
+}
+
+
+def is_follow_up_question(text: str) -> bool:
+    """Похоже ли сообщение на уточняющий вопрос (а не на "спасибо" или "+")"""
+    words = text.lower().split()
+    return '?' in text or (bool(words) and words[0].strip(',.:!') in FOLLOW_UP_WORDS)
+
+
 class QuestionsHandler:
     """Обработчик команд для работы с вопросами и ответами"""
     
     def __init__(self, db: DatabaseManager):
         self.db = db
         self.ai_client = AIClient()  # Используем универсальный AI клиент
+        self.retriever = ChatRetriever(db)
     
     async def handle_ask(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка команды /ask - ответ на вопрос по истории чата"""
@@ -37,8 +92,36 @@ class QuestionsHandler:
             
             question = " ".join(context.args)
             
-            # Получаем историю сообщений для контекста
-            messages = self.db.get_recent_messages(chat_id, config.MAX_MESSAGES_FOR_ANALYSIS)
+            # /ask ответом на сообщение бота продолжает разговор
+            session = self._get_reply_session(message)
+            if session:
+                await self._answer_follow_up(update, question, session)
+                return
+            
+            # Тот же (или перефразированный) вопрос уже задавали, и по теме ничего нового
+            cached = answer_cache.lookup(SCOPE_ASK, question, chat_id=chat_id)
+            if cached and not self._is_ask_answer_current(chat_id, question, cached):
+                answer_cache.discard(SCOPE_ASK, cached, chat_id=chat_id)
+                cached = None
+            if cached:
+                usage_tracker.record_cache_hit("ask", chat_id)
+                response_text = self._format_ask_response(question, cached.answer, cached.meta.get('message_count', 0))
+                reply = await message.reply_text(response_text, parse_mode='Markdown')
+                
+                # Ответ из кэша тоже можно уточнять: сессия из сохраненного контекста
+                session = AskSession(chat_id)
+                session.add_context(
+                    {'id': message_id, 'score': score} for message_id, score in cached.meta.get('scores', {}).items()
+                )
+                session.add_turn(question, cached.answer)
+                ask_sessions.bind(session, reply.message_id)
+                return
+            
+            # Подбираем контекст по всей истории: совпадения с вопросом, свежие сообщения и их соседи
+            if config.ASK_RETRIEVAL_ENABLED:
+                messages = self.retriever.retrieve(chat_id, question).messages
+            else:
+                messages = self.db.get_recent_messages(chat_id, config.MAX_MESSAGES_FOR_ANALYSIS)
             
             if not messages:
                 await message.reply_text(
@@ -47,6 +130,10 @@ class QuestionsHandler:
                 )
                 return
             
+            # Проверяем квоту AI запросов
+            if not await quota_manager.enforce(update, "ask"):
+                return
+            
             # Сообщение о обработке
             processing_msg = await message.reply_text(
                 "🔍 Ищу ответ в истории чата..."
@@ -56,19 +143,98 @@ class QuestionsHandler:
             personality = self._get_bot_personality(chat_id)
             
             # Получаем ответ на вопрос
-            answer = await self._answer_question_based_on_chat(question, messages, personality)
+            answer = await self._answer_question_based_on_chat(question, messages, personality, chat_id=chat_id)
             
             # Удаляем сообщение о обработке
             await processing_msg.delete()
             
             # Форматируем и отправляем ответ
             response_text = self._format_ask_response(question, answer, len(messages))
-            await message.reply_text(response_text, parse_mode='Markdown')
+            reply = await message.reply_text(response_text, parse_mode='Markdown')
+            
+            # Запоминаем контекст для уточняющих вопросов
+            session = AskSession(chat_id)
+            session.add_context(messages)
+            session.add_turn(question, answer)
+            ask_sessions.bind(session, reply.message_id)
             
         except Exception as e:
             logger.error(f"Error in handle_ask: {e}")
             await self._send_error_message(update, "при поиске ответа в истории чата")
     
+    async def handle_ask_reply(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Уточняющий вопрос обычным сообщением в ответ на ответ /ask
+
+        Запросом к AI считается только сообщение, похожее на вопрос: реплики
+        вроде "спасибо" или "+" в ответ боту квоту не тратят. Любой текст
+        можно уточнить явно, ответив боту командой /ask.
+        """
+        try:
+            message = update.effective_message
+            if not message or not message.text or not is_follow_up_question(message.text):
+                return
+            
+            session = self._get_reply_session(message)
+            if session:
+                await self._answer_follow_up(update, message.text.strip(), session)
+                
+        except Exception as e:
+            logger.error(f"Error in handle_ask_reply: {e}")
+            await self._send_error_message(update, "при ответе на уточняющий вопрос")
+    
+    def _get_reply_session(self, message) -> Optional[AskSession]:
+        """Сессия /ask, к ответу которой относится сообщение"""
+        reply_to = message.reply_to_message
+        if not reply_to or not reply_to.from_user or not reply_to.from_user.is_bot:
+            return None
+        return ask_sessions.get(message.chat_id, reply_to.message_id)
+    
+    async def _answer_follow_up(self, update: Update, question: str, session: AskSession):
+        """Ответ на уточняющий вопрос по контексту сессии и новым сообщениям"""
+        chat_id = update.effective_chat.id
+        message = update.effective_message
+        
+        if not await quota_manager.enforce(update, "ask"):
+            return
+        
+        processing_msg = await message.reply_text("🔍 Уточняю по истории чата...")
+        
+        messages = self._build_follow_up_context(chat_id, question, session)
+        personality = self._get_bot_personality(chat_id)
+        answer = await self._answer_question_based_on_chat(question, messages, personality, chat_id=chat_id,
+                                                           history=session.summary)
+        
+        await processing_msg.delete()
+        
+        response_text = self._format_ask_response(question, answer, len(messages))
+        reply = await message.reply_text(response_text, parse_mode='Markdown')
+        
+        session.add_turn(question, answer)
+        ask_sessions.bind(session, reply.message_id)
+    
+    def _build_follow_up_context(self, chat_id: int, question: str, session: AskSession) -> List[Dict]:
+        """Контекст сессии плюс лучшие из еще не виденных сообщений по уточнению
+        
+        Поиск повторяется только ради новых сообщений: уже найденные берутся
+        по id с прежними оценками, к ним добавляется не больше
+        ASK_SESSION_DELTA_MESSAGES новых.
+        """
+        known = self.db.get_messages_by_ids(chat_id, sorted(session.scores))
+        for msg in known:
+            msg['score'] = session.scores[msg['id']]
+        
+        if config.ASK_RETRIEVAL_ENABLED:
+            found = self.retriever.retrieve(chat_id, question).messages
+        else:
+            found = self.db.get_recent_messages(chat_id, config.ASK_RECENT_CONTEXT)
+        delta = [msg for msg in found if msg.get('id') not in session.scores]
+        delta.sort(key=lambda msg: (msg.get('score', 0.0), msg.get('id') or 0), reverse=True)
+        delta = delta[:config.ASK_SESSION_DELTA_MESSAGES]
+        session.add_context(delta)
+        
+        logger.info(f"💬 Уточнение /ask: {len(known)} сообщений из сессии, {len(delta)} новых")
+        return sorted(known + delta, key=lambda msg: msg['id'])
+    
     async def handle_gpt(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка команды /gpt - ответ на любой вопрос с помощью Yandex GPT"""
         try:
@@ -97,13 +263,25 @@ class QuestionsHandler:
                 await message.reply_text(f"📏 Вопрос слишком длинный. Пожалуйста, сократите его до {config.MAX_QUESTION_LENGTH} символов.")
                 return
             
+            # Частые общие вопросы отвечаем из кэша
+            cached = answer_cache.lookup(SCOPE_GPT, question)
+            if cached:
+                usage_tracker.record_cache_hit("gpt", update.effective_chat.id)
+                await message.reply_text(self._format_gpt_response(question, cached.answer), parse_mode='Markdown')
+                return
+            
+            # Проверяем квоту AI запросов
+            estimated_tokens = estimate_tokens(question) + config.GPT_MAX_TOKENS
+            if not await quota_manager.enforce(update, "gpt", estimated_tokens):
+                return
+            
             # Сообщение о обработке
             processing_msg = await message.reply_text(
                 "🤔 Думаю над ответом..."
             )
             
             # Получаем ответ от ИИ
-            answer = await self._answer_general_question(question)
+            answer = await self._answer_general_question(question, chat_id=update.effective_chat.id)
             
             # Удаляем сообщение о обработке
             await processing_msg.delete()
@@ -116,9 +294,14 @@ class QuestionsHandler:
             logger.error(f"Error in handle_gpt: {e}")
             await self._send_error_message(update, "при обработке вопроса")
     
-    async def _answer_question_based_on_chat(self, question: str, messages: List[Dict], personality: str = "") -> str:
-        """Ответ на вопрос на основе истории чата"""
-        conversation_text = self._format_messages_for_qa(messages)
+    async def _answer_question_based_on_chat(self, question: str, messages: List[Dict], personality: str = "",
+                                             chat_id: Optional[int] = None, history: str = "") -> str:
+        """Ответ на вопрос на основе истории чата
+        
+        history - предыдущие вопросы и ответы разговора, если вопрос уточняющий.
+        """
+        conversation_text = self._format_messages_for_qa(messages, question)
+        history_text = f"Предыдущие вопросы и ответы в этом разговоре:\n{history}\n\n" if history else ""
         
         system_message = self._build_system_message(
             base_role=(
@@ -135,7 +318,7 @@ class QuestionsHandler:
 
 {conversation_text}
 
-Вопрос: {question}
+{history_text}Вопрос: {question}
 
 Проанализируй историю сообщений и ответь на вопрос. 
 
@@ -156,7 +339,8 @@ class QuestionsHandler:
             {"role": "user", "content": prompt}
         ]
         
-        answer = await self.ai_client.chat_completion(ai_messages, max_tokens=800, temperature=0.3)
+        answer = await self.ai_client.chat_completion(ai_messages, max_tokens=800, temperature=0.3,
+                                                     chat_id=chat_id, command="ask")
         
         if not answer:
             return "❌ Не удалось получить ответ от AI-сервиса. Пожалуйста, попробуйте позже."
@@ -165,9 +349,17 @@ class QuestionsHandler:
         if self._is_evasive_answer(answer):
             return self._handle_insufficient_information(question)
         
+        # Ответ на уточнение зависит от предыдущих вопросов, его не кэшируем
+        if chat_id is not None and not history and not is_local_fallback(answer):
+            answer_cache.store(SCOPE_ASK, question, answer, chat_id=chat_id, meta={
+                'last_message_id': max((msg['id'] for msg in messages if msg.get('id') is not None), default=None),
+                'message_count': len(messages),
+                'scores': {msg['id']: msg.get('score', 0.0) for msg in messages if msg.get('id') is not None}
+            })
+        
         return answer
     
-    async def _answer_general_question(self, question: str) -> str:
+    async def _answer_general_question(self, question: str, chat_id: Optional[int] = None) -> str:
         """Ответ на общий вопрос с помощью Yandex GPT с fallback"""
         system_message = (
             "Ты - полезный AI-ассистент. Отвечай на вопросы подробно, точно и полезно. "
@@ -188,26 +380,32 @@ class QuestionsHandler:
         ]
         
         # Пытаемся получить ответ от основного AI
-        answer = await self.ai_client.chat_completion(ai_messages, max_tokens=1200, temperature=0.7)
+        answer = await self.ai_client.chat_completion(ai_messages, max_tokens=1200, temperature=0.7,
+                                                     chat_id=chat_id, command="gpt")
         
         # Если AI не ответил, используем fallback
         if not answer:
             return self._get_fallback_response(question)
         
-        return self._postprocess_answer(answer, question_type)
+        # Признак локального fallback проверяем до постобработки: она добавляет эмодзи в начало
+        cacheable = not is_local_fallback(answer)
+        answer = self._postprocess_answer(answer, question_type)
+        if cacheable:
+            answer_cache.store(SCOPE_GPT, question, answer)
+        return answer
 
     def _get_fallback_response(self, question: str) -> str:
         """Fallback ответ когда AI недоступен"""
-        question_lower = question.lower()
+        topic = FALLBACK_TOPICS.first(question)
         
         # Базовые ответы на частые вопросы
-        if any(word in question_lower for word in ['привет', 'hello', 'hi', 'здравствуй']):
+        if topic == "greeting":
             return "Привет! 👋 Рад вас видеть! К сожалению, AI-сервис временно недоступен, но я могу помочь с базовыми командами."
         
-        elif any(word in question_lower for word in ['как дела', 'how are you']):
+        elif topic == "how_are_you":
             return "Всё хорошо, спасибо! 😊 AI-сервис временно не отвечает, но основные функции бота работают."
         
-        elif any(word in question_lower for word in ['помощь', 'help', 'команды']):
+        elif topic == "help":
             return ("🤖 **Доступные команды:**\n\n"
                     "• `/summary [n]` - суммаризация чата\n"
                     "• `/themes [n]` - основные темы\n"
@@ -216,7 +414,7 @@ class QuestionsHandler:
                     "• `/opinion [@user]` - анализ стиля\n\n"
                     "💡 *AI-сервис временно недоступен*")
         
-        elif any(word in question_lower for word in ['что ты умеешь', 'функции']):
+        elif topic == "abilities":
             return ("🤖 **Мои возможности:**\n\n"
                     "• Анализ групповых чатов\n"
                     "• Суммаризация обсуждений\n"
@@ -236,22 +434,14 @@ class QuestionsHandler:
 
     def _classify_question(self, question: str) -> str:
         """Классификация типа вопроса для улучшения ответа"""
-        question_lower = question.lower()
-        
-        if any(word in question_lower for word in ['как', 'how to', 'инструкция', 'руководство']):
-            return "how_to"
-        elif any(word in question_lower for word in ['что такое', 'что значит', 'определение', 'definition']):
-            return "definition"
-        elif any(word in question_lower for word in ['почему', 'why', 'причина', 'cause']):
-            return "explanation"
-        elif any(word in question_lower for word in ['сравни', 'difference', 'разница', 'vs', 'или']):
-            return "comparison"
-        elif any(word in question_lower for word in ['список', 'list', 'перечень', 'примеры']):
-            return "list"
-        elif re.search(r'\d+', question) and any(word in question_lower for word in ['совет', 'tip', 'recommend']):
+        found = QUESTION_TYPES.categories(question)
+        
+        for question_type in ("how_to", "definition", "explanation", "comparison", "list"):
+            if question_type in found:
+                return question_type
+        if "advice" in found and re.search(r'\d+', question):
             return "numbered_advice"
-        else:
-            return "general"
+        return "general"
     
     def _enhance_prompt_based_on_type(self, question: str, question_type: str) -> str:
         """Улучшение промпта в зависимости от типа вопроса"""
@@ -316,37 +506,44 @@ class QuestionsHandler:
         
         return answer
     
-    def _format_messages_for_qa(self, messages: List[Dict]) -> str:
-        """Форматирование сообщений для вопросов-ответов"""
-        formatted = []
-        for i, msg in enumerate(messages, 1):
-            user = msg.get('user', 'Unknown')
-            text = msg.get('text', '')
-            timestamp = msg.get('timestamp', '')
-            
-            if text and len(text.strip()) > 0:
-                # Обрезаем очень длинные сообщения
-                if len(text) > 200:
-                    text = text[:197] + "..."
-                formatted.append(f"{i}. {user} ({timestamp}): {text}")
+    def _format_messages_for_qa(self, messages: List[Dict], question: Optional[str] = None) -> str:
+        """Форматирование сообщений для вопросов-ответов
+        
+        Если история не помещается в бюджет токенов, в первую очередь остаются
+        сообщения с лучшей оценкой поиска (ChatRetriever), а без нее - свежие
+        сообщения и сообщения со словами из вопроса.
+        """
+        messages, _ = filter_noise(messages)
+        ranked = any('score' in msg for msg in messages)
+        packed = pack_messages(
+            messages,
+            formatter=lambda i, msg, text: f"{i}. {msg.get('user', 'Unknown')} ({msg.get('timestamp', '')}): {text}",
+            budget=get_history_budget(800, command="ask"),
+            max_chars=200,
+            query=question,
+            priority=(lambda msg: msg.get('score', 0.0)) if ranked else None
+        )
+        return packed.text
+    
+    def _is_ask_answer_current(self, chat_id: int, question: str, cached) -> bool:
+        """Ответ /ask из кэша актуален: после него в чате нет сообщений по теме вопроса
         
-        return "\n".join(formatted)
+        Если новых сообщений больше, чем ASK_RECENT_CONTEXT, контекст последних
+        сообщений сменился полностью, и ответ считается устаревшим.
+        """
+        last_message_id = cached.meta.get('last_message_id')
+        current_id = self.db.get_last_message_id(chat_id)
+        if last_message_id is None or current_id is None:
+            return False
+        if current_id == last_message_id:
+            return True
+        if self.db.count_messages_since(chat_id, last_message_id) > config.ASK_RECENT_CONTEXT:
+            return False
+        return not self.retriever.has_new_matches(chat_id, question, last_message_id)
     
     def _is_evasive_answer(self, answer: str) -> bool:
         """Проверяет, является ли ответ уклончивым (недостаточно информации)"""
-        evasive_phrases = [
-            "не могу найти",
-            "не упоминается", 
-            "не достаточно информации",
-            "информации нет",
-            "не говорится",
-            "не обсуждалось",
-            "в предоставленных сообщениях нет",
-            "не удалось найти"
-        ]
-        
-        answer_lower = answer.lower()
-        return any(phrase in answer_lower for phrase in evasive_phrases)
+        return EVASIVE_PHRASES.matches(answer)
     
     def _handle_insufficient_information(self, question: str) -> str:
         """Обработка случая недостаточной информации"""
@@ -5,15 +5,28 @@ from telegram.ext import ContextTypes
 from config import config
 from database import DatabaseManager
 from ai_client import AIClient  # Добавляем импорт универсального клиента
+from quota import quota_manager
+from ai_queue import AIPriority
+from token_budget import get_history_budget, pack_messages
+from summarizer import MapReduceSummarizer
+from segment_cache import SegmentSummaryCache
+from topics import extract_topics, format_topics, format_topics_for_ai
+from noise_filter import filter_noise
+from brief_cache import brief_cache
 
 logger = logging.getLogger(__name__)
 
+# Аргументы /themes, включающие быстрый режим без AI
+THEMES_FAST_ARGS = ("fast", "быстро")
+
 class SummaryHandler:
     """Обработчик команд суммаризации и анализа тем"""
     
     def __init__(self, db: DatabaseManager):
         self.db = db
         self.ai_client = AIClient()  # Заменяем OpenAI клиент на универсальный
+        self.summarizer = MapReduceSummarizer(self.ai_client)
+        self.segment_cache = SegmentSummaryCache(db, self.summarizer)
     
     async def handle_summary(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка команды /summary [n]"""
@@ -22,15 +35,16 @@ class SummaryHandler:
             message = update.effective_message
             
             # Получаем количество сообщений для анализа
-            n_messages = self._parse_message_count(context.args, default=50)
+            # Длинные окна суммаризируются по частям (map-reduce), поэтому лимит выше
+            n_messages = self._parse_message_count(context.args, default=50, max_count=None)
             
             # Проверяем лимит сообщений
-            if n_messages > config.MAX_MESSAGES_FOR_ANALYSIS:
+            if n_messages > config.SUMMARY_MAX_MESSAGES:
                 await message.reply_text(
-                    f"⚠️ Максимальное количество сообщений для анализа: {config.MAX_MESSAGES_FOR_ANALYSIS}\n"
-                    f"Использую {config.MAX_MESSAGES_FOR_ANALYSIS} сообщений."
+                    f"⚠️ Максимальное количество сообщений для суммаризации: {config.SUMMARY_MAX_MESSAGES}\n"
+                    f"Использую {config.SUMMARY_MAX_MESSAGES} сообщений."
                 )
-                n_messages = config.MAX_MESSAGES_FOR_ANALYSIS
+                n_messages = config.SUMMARY_MAX_MESSAGES
             
             # Получаем сообщения из базы данных
             messages = self.db.get_recent_messages(chat_id, n_messages)
@@ -39,6 +53,14 @@ class SummaryHandler:
                 await message.reply_text("📭 Нет сообщений для суммаризации.")
                 return
             
+            # Проверяем квоту AI запросов: оценка по частям map-reduce без уже готовых сводок сегментов
+            estimated_tokens = max(
+                config.AI_QUOTA_COMMAND_TOKENS["summary"],
+                self.segment_cache.estimate_cost(messages, chat_id)
+            )
+            if not await quota_manager.enforce(update, "summary", estimated_tokens):
+                return
+            
             # Отправляем сообщение о начале обработки
             processing_msg = await message.reply_text(
                 f"🔄 Анализирую последние {len(messages)} сообщений..."
@@ -48,7 +70,7 @@ class SummaryHandler:
             personality = self._get_bot_personality(chat_id)
             
             # Создаем суммаризацию
-            summary = await self._create_summary(messages, personality)
+            summary = await self._create_summary(messages, personality, chat_id=chat_id)
             
             # Удаляем сообщение о обработке
             await processing_msg.delete()
@@ -76,8 +98,15 @@ class SummaryHandler:
             chat_id = update.effective_chat.id
             message = update.effective_message
             
+            # Быстрый режим: /themes fast - темы выделяются локально, без AI.
+            # Слово режима и число сообщений разбираются независимо, в любом порядке
+            args = context.args or []
+            fast_mode = config.THEMES_LOCAL_ONLY or any(arg.lower() in THEMES_FAST_ARGS for arg in args)
+            
             # Получаем количество сообщений для анализа
-            n_messages = self._parse_message_count(context.args, default=50)
+            n_messages = self._parse_message_count(
+                [arg for arg in args if arg.lower() not in THEMES_FAST_ARGS], default=50, max_count=None
+            )
             
             if n_messages > config.MAX_MESSAGES_FOR_ANALYSIS:
                 await message.reply_text(
@@ -92,6 +121,19 @@ class SummaryHandler:
                 await message.reply_text("📭 Нет сообщений для анализа тем.")
                 return
             
+            # Кандидаты тем считаем локально (TF-IDF + кластеризация), без шума и дубликатов
+            topics = extract_topics(filter_noise(messages)[0])
+            
+            if fast_mode and topics:
+                await message.reply_text(
+                    f"🎯 **Основные темы из {len(messages)} сообщений (быстрый режим):**\n\n{format_topics(topics)}"
+                )
+                return
+            
+            # Проверяем квоту AI запросов
+            if not await quota_manager.enforce(update, "themes"):
+                return
+            
             # Сообщение о обработке
             processing_msg = await message.reply_text(
                 f"🎯 Анализирую темы из {len(messages)} сообщений..."
@@ -101,7 +143,7 @@ class SummaryHandler:
             personality = self._get_bot_personality(chat_id)
             
             # Анализируем темы
-            themes = await self._analyze_themes(messages, personality)
+            themes = await self._analyze_themes(messages, personality, chat_id=chat_id, topics=topics)
             
             # Удаляем сообщение о обработке
             await processing_msg.delete()
@@ -130,6 +172,11 @@ class SummaryHandler:
             # Получаем текст сообщения, на которое ответили
             target_message = message.reply_to_message
             text_to_summarize = self._extract_text_from_message(target_message)
+            if not text_to_summarize:
+                # Голосовое или изображение: берем ранее извлеченный текст
+                text_to_summarize = self.db.get_extracted_text(
+                    update.effective_chat.id, target_message.message_id
+                ) or ""
             
             if not text_to_summarize:
                 await message.reply_text("❌ Не удалось извлечь текст из сообщения.")
@@ -143,14 +190,21 @@ class SummaryHandler:
                 )
                 return
             
-            # Сообщение о обработке
-            processing_msg = await message.reply_text("🔄 Сокращаю сообщение...")
-            
-            # Создаем краткое изложение
-            brief = await self._create_brief_summary(text_to_summarize)
-            
-            # Удаляем сообщение о обработке
-            await processing_msg.delete()
+            # Это же сообщение (или его копию) уже сокращали - отвечаем сразу
+            brief = brief_cache.lookup(text_to_summarize, chat_id=update.effective_chat.id)
+            if brief is None:
+                # Проверяем квоту AI запросов
+                if not await quota_manager.enforce(update, "brief"):
+                    return
+                
+                # Сообщение о обработке
+                processing_msg = await message.reply_text("🔄 Сокращаю сообщение...")
+                
+                # Создаем краткое изложение
+                brief, _ = await brief_cache.get_or_create(text_to_summarize, chat_id=update.effective_chat.id)
+                
+                # Удаляем сообщение о обработке
+                await processing_msg.delete()
             
             # Отправляем результат
             preview = text_to_summarize[:200] + "..." if len(text_to_summarize) > 200 else text_to_summarize
@@ -165,9 +219,28 @@ class SummaryHandler:
             logger.error(f"Error in handle_brief: {e}")
             await self._send_error_message(update, "при создании краткого изложения")
     
-    async def _create_summary(self, messages: List[Dict], personality: str = "") -> str:
-        """Создание суммаризации сообщений с помощью Yandex GPT"""
-        conversation_text = self._format_messages_for_ai(messages)
+    async def _create_summary(self, messages: List[Dict], personality: str = "",
+                              chat_id: Optional[int] = None,
+                              priority: AIPriority = AIPriority.INTERACTIVE) -> str:
+        """Создание суммаризации сообщений с помощью Yandex GPT
+        
+        Длинные окна собираются из закэшированных сводок сегментов и свежего
+        хвоста. Если и это не помещается в контекст модели, строки сжимаются
+        map-reduce суммаризацией по частям, а итоговый промпт строится по
+        кратким содержаниям частей.
+        """
+        lines = await self.segment_cache.build_lines(messages, chat_id, priority)
+        conversation_text, condensed, lost = await self.summarizer.condense(
+            lines,
+            budget=get_history_budget(config.AI_MAX_TOKENS, command="summary"),
+            chat_id=chat_id,
+            priority=priority
+        )
+        
+        if not conversation_text:
+            return "❌ Не удалось создать суммаризацию. Пожалуйста, попробуйте позже."
+        
+        source = "краткие содержания последовательных частей обсуждения" if condensed else "сообщения"
         
         system_message = self._build_system_message(
             base_role="Ты - помощник для суммаризации групповых чатов. "
@@ -175,7 +248,7 @@ class SummaryHandler:
             personality=personality
         )
         
-        prompt = f"""Проанализируй следующие сообщения из группового чата и создай краткое содержание:
+        prompt = f"""Проанализируй следующие {source} из группового чата и создай краткое содержание:
 
 {conversation_text}
 
@@ -207,17 +280,31 @@ class SummaryHandler:
         summary = await self.ai_client.chat_completion(
             ai_messages, 
             max_tokens=config.AI_MAX_TOKENS,
-            temperature=config.AI_TEMPERATURE
+            temperature=config.AI_TEMPERATURE,
+            priority=priority,
+            chat_id=chat_id,
+            command="summary"
         )
         
         if not summary:
             return "❌ Не удалось создать суммаризацию. Пожалуйста, попробуйте позже."
         
+        if lost:
+            summary += f"\n\n⚠️ Часть обсуждения не вошла в суммаризацию ({lost} фрагм. не успели обработаться)."
+        
         return summary
     
-    async def _analyze_themes(self, messages: List[Dict], personality: str = "") -> str:
-        """Анализ основных тем в сообщениях с помощью Yandex GPT"""
-        conversation_text = self._format_messages_for_ai(messages)
+    async def _analyze_themes(self, messages: List[Dict], personality: str = "",
+                              chat_id: Optional[int] = None, topics: Optional[List[Dict]] = None) -> str:
+        """Анализ основных тем в сообщениях с помощью Yandex GPT
+        
+        Если темы уже выделены локально (topics), AI только называет и описывает
+        готовые кластеры, что намного короче полного анализа сообщений.
+        """
+        if topics:
+            return await self._label_topics(topics, personality, chat_id=chat_id)
+        
+        conversation_text = self._format_messages_for_ai(messages, max_tokens=800, command="themes")
         
         system_message = self._build_system_message(
             base_role="Ты анализируешь групповые чаты и выделяешь основные темы обсуждения. "
@@ -260,7 +347,9 @@ class SummaryHandler:
         themes = await self.ai_client.chat_completion(
             ai_messages,
             max_tokens=800,
-            temperature=0.5  # Более низкая температура для большей консистентности
+            temperature=0.5,  # Более низкая температура для большей консистентности
+            chat_id=chat_id,
+            command="themes"
         )
         
         if not themes:
@@ -268,7 +357,50 @@ class SummaryHandler:
         
         return themes
     
-    async def _create_brief_summary(self, text: str) -> str:
+    async def _label_topics(self, topics: List[Dict], personality: str = "",
+                            chat_id: Optional[int] = None) -> str:
+        """Названия и описания для локально найденных кластеров тем"""
+        system_message = self._build_system_message(
+            base_role="Ты анализируешь групповые чаты и даешь точные названия темам обсуждения.",
+            personality=personality
+        )
+        
+        prompt = f"""Сообщения группового чата уже разбиты на кластеры по темам:
+
+{format_topics_for_ai(topics)}
+
+**Требования:**
+- Для каждого кластера придумай короткое название темы и опиши ее в одном предложении
+- Похожие кластеры можно объединить, кластер без ясной темы - пропустить
+- Активность и участников бери из описания кластера
+- Используй понятные эмодзи для визуального разделения
+- Пиши на русском языке
+
+**Формат ответа:**
+🎯 **Тема 1: [Название]**
+• Описание: [краткое описание]
+• Активность: [уровень]
+• Участники: [список]"""
+        
+        themes = await self.ai_client.chat_completion(
+            [
+                {"role": "system", "content": system_message},
+                {"role": "user", "content": prompt}
+            ],
+            max_tokens=600,
+            temperature=0.5,
+            chat_id=chat_id,
+            command="themes"
+        )
+        
+        if not themes:
+            # Локальный результат лучше, чем ошибка
+            return format_topics(topics)
+        
+        return themes
+    
+    async def _create_brief_summary(self, text: str, chat_id: Optional[int] = None,
+                                    priority: AIPriority = AIPriority.INTERACTIVE) -> str:
         """Создание краткого изложения длинного текста с помощью Yandex GPT"""
         system_message = (
             "Ты - эксперт по созданию кратких изложений. "
@@ -298,7 +430,10 @@ class SummaryHandler:
         brief = await self.ai_client.chat_completion(
             ai_messages,
             max_tokens=500,
-            temperature=0.3  # Низкая температура для большей точности
+            temperature=0.3,  # Низкая температура для большей точности
+            priority=priority,
+            chat_id=chat_id,
+            command="brief"
         )
         
         if not brief:
@@ -306,30 +441,29 @@ class SummaryHandler:
         
         return brief
     
-    def _parse_message_count(self, args: List[str], default: int = 50) -> int:
+    def _parse_message_count(self, args: List[str], default: int = 50,
+                             max_count: Optional[int] = config.MAX_MESSAGES_FOR_ANALYSIS) -> int:
         """Парсинг количества сообщений из аргументов"""
         if not args:
             return default
         
         try:
-            count = int(args[0])
-            return max(1, min(count, config.MAX_MESSAGES_FOR_ANALYSIS))
+            count = max(1, int(args[0]))
+            return min(count, max_count) if max_count else count
         except (ValueError, TypeError):
             return default
     
-    def _format_messages_for_ai(self, messages: List[Dict]) -> str:
-        """Форматирование сообщений для передачи в AI"""
-        formatted = []
-        for msg in messages:
-            user = msg.get('user', 'Unknown')
-            text = msg.get('text', '')
-            if text and len(text.strip()) > 0:  # Игнорируем пустые сообщения
-                # Обрезаем слишком длинные сообщения
-                if len(text) > 300:
-                    text = text[:297] + "..."
-                formatted.append(f"{user}: {text}")
-        
-        return "\n".join(formatted)
+    def _format_messages_for_ai(self, messages: List[Dict], max_tokens: int = None,
+                                command: Optional[str] = None) -> str:
+        """Форматирование сообщений для передачи в AI (в пределах бюджета токенов модели)"""
+        messages, _ = filter_noise(messages)
+        packed = pack_messages(
+            messages,
+            formatter=lambda i, msg, text: f"{msg.get('user', 'Unknown')}: {text}",
+            budget=get_history_budget(max_tokens or config.AI_MAX_TOKENS, command=command),
+            max_chars=300
+        )
+        return packed.text
     
     def _extract_text_from_message(self, message: Message) -> str:
         """Извлечение текста из сообщения Telegram"""
@@ -9,12 +9,23 @@ import sqlite3
 from telegram import Update, Message
 from telegram.ext import ContextTypes, filters
 import openai
-from PIL import Image
 import requests
-from pydub import AudioSegment
 
 from config import config
 from database import DatabaseManager
+from ai_queue import request_queue
+from ai_router import get_router
+from ai_hedging import hedge_controller
+from quota import SCOPE_CHAT, SCOPE_GLOBAL, SCOPES, quota_manager
+from ai_usage import usage_tracker
+from digest import digest_builder
+from noise_filter import noise_stats
+from brief_cache import brief_cache
+from answer_cache import answer_cache
+from ask_sessions import ask_sessions
+from user_profiles import profile_store
+from topic_segmenter import topic_segmenter
+from media_pool import media_pool
 
 
 logger = logging.getLogger(__name__)
@@ -24,7 +35,10 @@ class UtilsHandler:
     
     def __init__(self, db: DatabaseManager):
         self.db = db
-        self.openai_client = openai.AsyncOpenAI(api_key=config.OPENAI_API_KEY)
+        self.openai_client = openai.AsyncOpenAI(
+            api_key=config.OPENAI_API_KEY,
+            base_url=config.OPENAI_MEDIA_BASE_URL
+        )
     
     async def handle_text_extraction(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка команды /text - извлечение текста из голосовых и изображений"""
@@ -206,6 +220,51 @@ class UtilsHandler:
             logger.error(f"Error in handle_settings_pin: {e}")
             await self._send_error_message(update, "при настройке закрепления")
     
+    async def handle_settings_brief(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработка команды /settings_brief - вкл/выкл заблаговременного сокращения длинных сообщений"""
+        try:
+            chat_id = update.effective_chat.id
+            message = update.effective_message
+            
+            current_setting = self.db.get_chat_settings(chat_id).get('brief_precompute', False)
+            
+            if not context.args:
+                status = "включено" if current_setting else "выключено"
+                await message.reply_text(
+                    f"📝 **Заблаговременное сокращение:** {status}\n\n"
+                    f"Бот заранее готовит краткое изложение сообщений длиннее {config.BRIEF_MIN_LENGTH} "
+                    "символов, и /brief отвечает мгновенно.\n"
+                    "`/settings_brief on` - включить\n"
+                    "`/settings_brief off` - выключить"
+                )
+                return
+            
+            action = context.args[0].lower()
+            
+            if action in ['on', 'вкл', 'enable', 'true', '1']:
+                new_setting = True
+                status_text = "включено"
+            elif action in ['off', 'выкл', 'disable', 'false', '0']:
+                new_setting = False
+                status_text = "выключено"
+            else:
+                await message.reply_text(
+                    "❌ Неверный аргумент.\n"
+                    "Используйте:\n"
+                    "`/settings_brief on` - включить\n"
+                    "`/settings_brief off` - выключить"
+                )
+                return
+            
+            if self._set_brief_precompute_setting(chat_id, new_setting):
+                await message.reply_text(f"✅ Заблаговременное сокращение длинных сообщений **{status_text}**")
+            else:
+                await message.reply_text("❌ Не удалось сохранить настройки.")
+                
+        except Exception as e:
+            logger.error(f"Error in handle_settings_brief: {e}")
+            await self._send_error_message(update, "при настройке сокращения сообщений")
+    
     async def handle_set_personality(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработка команды /set_personality - установка личности бота"""
         try:
@@ -284,6 +343,124 @@ class UtilsHandler:
             logger.error(f"Error in handle_clear_personality: {e}")
             await self._send_error_message(update, "при очистке личности")
     
+    async def handle_ai_status(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработка команды /ai_status - состояние очереди AI запросов и провайдеров"""
+        try:
+            status_text = f"{request_queue.format_metrics()}\n\n{get_router().format_status()}"
+            if config.AI_HEDGING_ENABLED:
+                status_text += f"\n\n{hedge_controller.format_stats()}"
+            status_text += f"\n\n{noise_stats.format_stats()}\n{brief_cache.format_stats()}\n{answer_cache.format_stats()}\n{ask_sessions.format_stats()}\n{profile_store.format_stats()}\n{topic_segmenter.format_stats()}\n{media_pool.format_stats()}"
+            await update.effective_message.reply_text(status_text)
+        except Exception as e:
+            logger.error(f"Error in handle_ai_status: {e}")
+            await self._send_error_message(update, "при получении состояния AI")
+    
+    async def handle_quota(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработка команды /quota - использование квот AI запросов"""
+        try:
+            message = update.effective_message
+            chat_id = update.effective_chat.id
+            
+            # Ответом на сообщение можно посмотреть квоту другого участника
+            target = message.reply_to_message.from_user if message.reply_to_message else update.effective_user
+            
+            await message.reply_text(quota_manager.format_usage(chat_id, target.id if target else None))
+            
+        except Exception as e:
+            logger.error(f"Error in handle_quota: {e}")
+            await self._send_error_message(update, "при получении квот")
+    
+    async def handle_quota_set(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработка команды /quota_set - изменение лимитов квот (только для администраторов)"""
+        try:
+            message = update.effective_message
+            chat_id = update.effective_chat.id
+            
+            if len(context.args) != 3 or context.args[0] not in SCOPES:
+                await message.reply_text(
+                    "📏 **Как изменить квоту:**\n\n"
+                    "`/quota_set chat 200 300000` - лимит чата\n"
+                    "`/quota_set user 50 80000` - ответом на сообщение участника\n"
+                    "`/quota_set global 2000 5000000` - общий лимит бота\n\n"
+                    "Формат: область, запросов и токенов за окно. 0 - без ограничений."
+                )
+                return
+            
+            scope = context.args[0]
+            try:
+                max_requests, max_tokens = int(context.args[1]), int(context.args[2])
+            except ValueError:
+                await message.reply_text("❌ Лимиты должны быть целыми числами.")
+                return
+            if max_requests < 0 or max_tokens < 0:
+                await message.reply_text("❌ Лимиты не могут быть отрицательными.")
+                return
+            
+            if scope == SCOPE_GLOBAL:
+                if update.effective_user.id not in config.BOT_ADMIN_IDS:
+                    await message.reply_text("❌ Общий лимит меняют только администраторы бота!")
+                    return
+                scope_id = 0
+            else:
+                if not await self._is_chat_admin(update):
+                    await message.reply_text("❌ Эта команда только для администраторов!")
+                    return
+                if scope == SCOPE_CHAT:
+                    scope_id = chat_id
+                elif message.reply_to_message:
+                    scope_id = message.reply_to_message.from_user.id
+                else:
+                    await message.reply_text("❌ Ответьте командой на сообщение участника.")
+                    return
+            
+            if quota_manager.set_limit(scope, scope_id, max_requests, max_tokens):
+                await message.reply_text(f"✅ Лимит обновлен\n\n{quota_manager.format_usage(chat_id)}")
+            else:
+                await message.reply_text("❌ Не удалось сохранить лимит.")
+            
+        except Exception as e:
+            logger.error(f"Error in handle_quota_set: {e}")
+            await self._send_error_message(update, "при изменении квоты")
+    
+    async def handle_ai_usage(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработка команды /ai_usage - токены, задержки и ошибки AI вызовов"""
+        try:
+            message = update.effective_message
+            
+            days = config.STATS_DEFAULT_DAYS
+            if context.args:
+                try:
+                    days = max(1, min(int(context.args[0]), config.MAX_STATS_DAYS))
+                except ValueError:
+                    await message.reply_text("❌ Укажите количество дней числом: `/ai_usage 7`")
+                    return
+            
+            # Записываем накопленное, чтобы отчет был полным
+            usage_tracker.flush()
+            report = self.db.get_ai_usage_report(days)
+            if not report or not report.get('commands'):
+                await message.reply_text(f"📭 Нет AI вызовов за {days} дн.\n\n{usage_tracker.format_stats()}")
+                return
+            
+            costs = {f"{backend.provider}:{backend.model}": backend.cost for backend in get_router().backends}
+            
+            lines = [f"📊 **Использование AI за {days} дн.:**", "\nПо командам:"]
+            for row in report['commands']:
+                lines.append(self._format_usage_row(row))
+            lines.append("\nПо моделям:")
+            for row in report['models']:
+                line = self._format_usage_row(row)
+                if row['name'] in costs:
+                    tokens = row['prompt_tokens'] + row['completion_tokens']
+                    line += f", стоимость ~{tokens / 1000 * costs[row['name']]:.1f}"
+                lines.append(line)
+            
+            await message.reply_text("\n".join(lines) + f"\n\n{usage_tracker.format_stats()}")
+            
+        except Exception as e:
+            logger.error(f"Error in handle_ai_usage: {e}")
+            await self._send_error_message(update, "при получении статистики AI")
+    
     async def save_text_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Сохранение текстовых сообщений в базу данных"""
         try:
@@ -299,10 +476,17 @@ class UtilsHandler:
                 user_id=user.id,
                 user_name=user.username or user.first_name,
                 message_text=message.text,
-                message_type='text'
+                message_type='text',
+                reply_to_message_id=message.reply_to_message.message_id if message.reply_to_message else None,
+                tg_message_id=message.message_id
             )
             
-            if not success:
+            if success:
+                digest_builder.note_message(chat_id)
+                profile_store.note_message(chat_id)
+                topic_segmenter.note_message(chat_id)
+                brief_cache.schedule_precompute(chat_id, message.text)
+            else:
                 logger.warning(f"Failed to save message from user {user.id} in chat {chat_id}")
                 
         except Exception as e:
@@ -346,10 +530,17 @@ class UtilsHandler:
                 user_name=user.username or user.first_name,
                 message_text=media_text,
                 message_type=media_type,
-                media_file_id=file_id
+                media_file_id=file_id,
+                reply_to_message_id=message.reply_to_message.message_id if message.reply_to_message else None,
+                tg_message_id=message.message_id
             )
             
-            if not success:
+            if success:
+                digest_builder.note_message(chat_id)
+                profile_store.note_message(chat_id)
+                topic_segmenter.note_message(chat_id)
+                brief_cache.schedule_precompute(chat_id, media_text)
+            else:
                 logger.warning(f"Failed to save media message from user {user.id} in chat {chat_id}")
                 
         except Exception as e:
@@ -390,10 +581,11 @@ class UtilsHandler:
             with tempfile.NamedTemporaryFile(suffix='.ogg', delete=False) as temp_file:
                 await voice_file.download_to_drive(temp_file.name)
                 
-                # Конвертируем в формат, подходящий для OpenAI
-                audio = AudioSegment.from_ogg(temp_file.name)
+                # Конвертируем в формат, подходящий для OpenAI (в пуле, не блокируя бота)
                 wav_path = temp_file.name.replace('.ogg', '.wav')
-                audio.export(wav_path, format='wav')
+                if not await media_pool.convert_audio(temp_file.name, wav_path):
+                    os.unlink(temp_file.name)
+                    return None
                 
                 # Отправляем в OpenAI Whisper для транскрибации
                 with open(wav_path, 'rb') as audio_file:
@@ -483,6 +675,12 @@ class UtilsHandler:
                 message_text=f"[Извлеченный текст] {extracted_text}",
                 message_type='extracted_text'
             )
+            # Привязка к исходному медиа: по ней /brief находит текст голосового или картинки
+            self.db.save_extracted_text(
+                original_message.message_id, chat_id, extracted_text,
+                'voice' if original_message.voice else 'image' if original_message.photo else 'document'
+            )
+            brief_cache.schedule_precompute(chat_id, extracted_text)
         except Exception as e:
             logger.error(f"Error saving extracted text: {e}")
     
@@ -627,6 +825,28 @@ class UtilsHandler:
             logger.error(f"Error setting pin: {e}")
             return False
     
+    def _set_brief_precompute_setting(self, chat_id: int, enabled: bool) -> bool:
+        """Установка заблаговременного сокращения (остальные настройки чата не меняются)"""
+        try:
+            conn = sqlite3.connect(self.db.db_path)
+            cursor = conn.cursor()
+            
+            cursor.execute('''
+                INSERT INTO chat_settings (chat_id, brief_precompute, updated_at) 
+                VALUES (?, ?, CURRENT_TIMESTAMP)
+                ON CONFLICT(chat_id) DO UPDATE SET 
+                    brief_precompute = excluded.brief_precompute,
+                    updated_at = CURRENT_TIMESTAMP
+            ''', (chat_id, enabled))
+            
+            conn.commit()
+            conn.close()
+            return True
+            
+        except Exception as e:
+            logger.error(f"Error setting brief precompute: {e}")
+            return False
+    
     def _get_bot_personality(self, chat_id: int) -> Optional[str]:
         """Получение личности бота"""
         try:
@@ -687,6 +907,23 @@ class UtilsHandler:
             logger.error(f"Error clearing bot personality: {e}")
             return False
     
+    def _format_usage_row(self, row: Dict) -> str:
+        """Строка отчета /ai_usage"""
+        return (
+            f"• {row['name']}: {row['calls']} вызовов, токены {row['prompt_tokens']}+{row['completion_tokens']}, "
+            f"задержка ср. {row['avg_latency_ms'] / 1000:.2f}с / макс. {row['max_latency_ms'] / 1000:.2f}с, "
+            f"ошибок {row['errors']}, повторов {row['retries']}, кэш {row['cache_hits']}"
+        )
+    
+    async def _is_chat_admin(self, update: Update) -> bool:
+        """Проверка, что автор команды - администратор чата"""
+        try:
+            member = await update.effective_chat.get_member(update.effective_user.id)
+            return member.status in ['administrator', 'creator']
+        except Exception as e:
+            logger.error(f"Ошибка проверки прав: {e}")
+            return False
+    
     async def _send_error_message(self, update: Update, action: str):
         """Отправка сообщения об ошибке"""
         try:
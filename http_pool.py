@@ -0,0 +1,43 @@
+import asyncio
+import logging
+from typing import Optional
+
+import aiohttp
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+_session: Optional[aiohttp.ClientSession] = None
+_session_loop: Optional[asyncio.AbstractEventLoop] = None
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    """Общая HTTP-сессия с пулом соединений для запросов к AI провайдерам
+
+    Соединения (TCP + TLS) переиспользуются между запросами вместо создания
+    новой сессии на каждый вызов. Сессия привязана к текущему event loop.
+    """
+    global _session, _session_loop
+    loop = asyncio.get_running_loop()
+    if _session is None or _session.closed or _session_loop is not loop:
+        connector = aiohttp.TCPConnector(
+            limit=config.AI_HTTP_POOL_SIZE,
+            limit_per_host=config.AI_HTTP_POOL_SIZE,
+            keepalive_timeout=config.AI_HTTP_KEEPALIVE,
+            ttl_dns_cache=300
+        )
+        _session = aiohttp.ClientSession(connector=connector)
+        _session_loop = loop
+        logger.info(f"🔌 HTTP пул создан (до {config.AI_HTTP_POOL_SIZE} соединений)")
+    return _session
+
+
+async def close_http_session():
+    """Закрытие общей HTTP-сессии при остановке бота"""
+    global _session, _session_loop
+    if _session is not None and not _session.closed:
+        await _session.close()
+        logger.info("🔌 HTTP пул закрыт")
+    _session = None
+    _session_loop = None
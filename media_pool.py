@@ -0,0 +1,217 @@
+import asyncio
+import logging
+import weakref
+from concurrent.futures import Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Dict, Optional, Set, TypeVar
+
+from config import config
+from media_processor import MediaProcessor
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+# Виды задач: OCR нагружает процессор и идет в процессы, аудио - в потоки
+KIND_OCR = "ocr"
+KIND_AUDIO = "audio"
+KINDS = (KIND_OCR, KIND_AUDIO)
+
+
+class MediaJobError(Exception):
+    """Задача обработки медиа не выполнена"""
+
+
+class MediaQueueFull(MediaJobError):
+    """В очереди уже MEDIA_QUEUE_SIZE задач этого вида"""
+
+
+class MediaJobTimeout(MediaJobError):
+    """Задача не уложилась в таймаут"""
+
+
+class MediaWorkerPool:
+    """Пул обработки медиа вне event loop
+
+    Распознавание текста на изображениях выполняется в отдельных процессах
+    (MEDIA_OCR_PROCESSES), конвертация аудио и распознавание речи - в
+    потоках (MEDIA_IO_THREADS): там в основном ожидание ffmpeg и сети.
+    Обработчик ждет результат через await, бот в это время обслуживает
+    остальные чаты.
+
+    На каждый вид задач в очереди и в работе не больше MEDIA_QUEUE_SIZE
+    задач, сверх этого задача сразу отклоняется (MediaQueueFull). Таймаут
+    считается с постановки в очередь. Задача, не начавшая выполняться,
+    при таймауте или отмене вызывающей корутины снимается с очереди.
+
+    Какой процесс выполняет зависшую задачу OCR, пул процессов не сообщает,
+    поэтому пул выводится из работы целиком: новые задачи идут в новый пул,
+    еще не начатые задачи старого переходят туда же, а начатые задачи
+    других пользователей дорабатывают. Процессы старого пула завершаются,
+    когда у него не остается ожидаемых задач или когда брошенные задачи
+    заняли все его процессы - тогда ожидавшие задачи тоже уходят в новый
+    пул. Поток остановить нельзя, поэтому у конвертации и распознавания
+    речи есть собственные таймауты.
+    """
+
+    def __init__(self):
+        self._executors: Dict[str, Executor] = {}
+        self._pending: Dict[str, int] = {kind: 0 for kind in KINDS}
+        self._futures: Set[Future] = set()
+        self._live: Dict[Executor, Set[Future]] = {}
+        self._retired: Set[Executor] = set()
+        self._abandoned: Dict[Executor, int] = {}
+        self._terminated: "weakref.WeakSet[Executor]" = weakref.WeakSet()
+        self.completed: Dict[str, int] = {kind: 0 for kind in KINDS}
+        self.rejected: Dict[str, int] = {kind: 0 for kind in KINDS}
+        self.timeouts: Dict[str, int] = {kind: 0 for kind in KINDS}
+
+    def _executor(self, kind: str) -> Executor:
+        executor = self._executors.get(kind)
+        if executor is None:
+            if kind == KIND_OCR:
+                executor = ProcessPoolExecutor(max_workers=config.MEDIA_OCR_PROCESSES)
+            else:
+                executor = ThreadPoolExecutor(max_workers=config.MEDIA_IO_THREADS, thread_name_prefix="media")
+            self._executors[kind] = executor
+        return executor
+
+    def _retire(self, executor: Executor):
+        """Вывод пула OCR из работы (зависшая задача или упавший процесс)
+
+        Сработает только для текущего пула: пул, уже замененный новым, не
+        трогаем. Не начатые задачи снимаются с него и переходят в новый пул.
+        """
+        if self._executors.get(KIND_OCR) is not executor:
+            return
+        del self._executors[KIND_OCR]
+        self._retired.add(executor)
+        for future in list(self._live.get(executor, ())):
+            future.cancel()
+        logger.warning("🖼️ Пул процессов OCR выведен из работы, новые задачи идут в новый пул")
+
+    def _abandon(self, executor: Executor):
+        """Начатая задача OCR больше не ожидается (таймаут или отмена) и занимает процесс"""
+        self._retire(executor)
+        if executor not in self._retired:
+            return
+        self._abandoned[executor] = self._abandoned.get(executor, 0) + 1
+        if self._abandoned[executor] >= getattr(executor, "_max_workers", config.MEDIA_OCR_PROCESSES):
+            # Свободных процессов не осталось: ждать в этом пуле бессмысленно
+            self._terminate(executor)
+
+    def _finish(self, executor: Executor, future: Future):
+        """Задача больше не ожидается; опустевший выведенный пул останавливается"""
+        live = self._live.get(executor, set())
+        live.discard(future)
+        if executor in self._retired and not live:
+            self._terminate(executor)
+
+    def _terminate(self, executor: Executor):
+        for process in list((getattr(executor, "_processes", None) or {}).values()):
+            process.terminate()
+        executor.shutdown(wait=False, cancel_futures=True)
+        self._retired.discard(executor)
+        self._abandoned.pop(executor, None)
+        self._live.pop(executor, None)
+        self._terminated.add(executor)
+        logger.warning("🖼️ Процессы выведенного пула OCR завершены")
+
+    async def run(self, kind: str, func: Callable[..., T], *args, timeout: Optional[float] = None) -> T:
+        """Выполнить блокирующую функцию в пуле и дождаться результата"""
+        if self._pending[kind] >= config.MEDIA_QUEUE_SIZE:
+            self.rejected[kind] += 1
+            raise MediaQueueFull(f"media queue '{kind}' is full")
+        if timeout is None:
+            timeout = config.MEDIA_OCR_TIMEOUT if kind == KIND_OCR else config.MEDIA_AUDIO_TIMEOUT
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        self._pending[kind] += 1
+        try:
+            while True:
+                executor = self._executor(kind)
+                future = executor.submit(func, *args)
+                self._futures.add(future)
+                self._live.setdefault(executor, set()).add(future)
+                try:
+                    result = await asyncio.wait_for(asyncio.wrap_future(future), max(0.0, deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    self.timeouts[kind] += 1
+                    if not future.cancel() and kind == KIND_OCR:
+                        self._abandon(executor)
+                    logger.warning(f"⏱️ Задача {kind} не уложилась в {timeout:.0f}с")
+                    raise MediaJobTimeout(f"media job '{kind}' timed out after {timeout:.0f}s")
+                except asyncio.CancelledError:
+                    if (future.cancelled() and self._executors.get(kind) is not executor
+                            and not asyncio.current_task().cancelling()):
+                        # Задача снята с выведенного пула до начала - отправляем в новый
+                        continue
+                    if not future.cancel() and kind == KIND_OCR:
+                        self._abandon(executor)
+                    raise
+                except BrokenProcessPool as e:
+                    if executor in self._terminated:
+                        # Процессы пула завершили мы сами, задача не виновата
+                        continue
+                    self._retire(executor)
+                    raise MediaJobError(f"OCR worker died: {e}")
+                finally:
+                    self._futures.discard(future)
+                    self._finish(executor, future)
+                self.completed[kind] += 1
+                return result
+        finally:
+            self._pending[kind] -= 1
+
+    async def extract_text(self, image_path: str) -> str:
+        return await self.run(KIND_OCR, MediaProcessor.extract_text_from_image, image_path)
+
+    async def convert_audio(self, ogg_path: str, wav_path: str) -> bool:
+        return await self.run(KIND_AUDIO, MediaProcessor.convert_audio_ogg_to_wav, ogg_path, wav_path)
+
+    async def transcribe(self, wav_path: str) -> str:
+        return await self.run(KIND_AUDIO, MediaProcessor.transcribe_audio, wav_path)
+
+    async def warm_up(self):
+        """Фоновая загрузка движков OCR и распознавания речи
+
+        Запускается после старта бота (MEDIA_WARMUP_ENABLED), чтобы первое
+        голосовое или изображение не ждало загрузки движка. По задаче на
+        каждый процесс OCR: процессы свободны, и задачи расходятся по ним.
+        """
+        await asyncio.sleep(config.MEDIA_WARMUP_DELAY_SECONDS)
+        jobs = [self.run(KIND_AUDIO, MediaProcessor.warm_up_audio, timeout=config.MEDIA_WARMUP_TIMEOUT)]
+        jobs += [
+            self.run(KIND_OCR, MediaProcessor.warm_up_ocr, timeout=config.MEDIA_WARMUP_TIMEOUT)
+            for _ in range(config.MEDIA_OCR_PROCESSES)
+        ]
+        results = await asyncio.gather(*jobs, return_exceptions=True)
+        failed = [result for result in results if isinstance(result, Exception)]
+        for error in failed:
+            logger.warning(f"⚙️ Не удалось прогреть движок обработки медиа: {error}")
+        if not failed:
+            logger.info("⚙️ Движки обработки медиа прогреты")
+
+    def shutdown(self):
+        """Отмена ожидающих задач и остановка пулов (начатые задачи дорабатывают)"""
+        for future in list(self._futures):
+            future.cancel()
+        for executor in self._executors.values():
+            executor.shutdown(wait=False, cancel_futures=True)
+        self._executors.clear()
+        for executor in list(self._retired):
+            self._terminate(executor)
+
+    def format_stats(self) -> str:
+        parts = []
+        for kind in KINDS:
+            parts.append(
+                f"{kind}: в очереди {self._pending[kind]}, выполнено {self.completed[kind]}, "
+                f"отклонено {self.rejected[kind]}, таймаутов {self.timeouts[kind]}"
+            )
+        return "🎞️ **Обработка медиа:** " + "; ".join(parts)
+
+
+# Общий пул обработки голосовых и изображений
+media_pool = MediaWorkerPool()
@@ -0,0 +1,156 @@
+import logging
+import subprocess
+import threading
+import time
+from typing import Callable, Dict
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# Движки OCR и распознавания речи загружаются при первом использовании:
+# их импорт занимает секунды и сотни МБ, а медиа в чат могут не прислать вовсе.
+# В пуле процессов у каждого процесса OCR свой экземпляр движка.
+_engines: Dict[str, object] = {}
+_engines_lock = threading.Lock()
+
+
+def _load_ocr() -> Callable[[str], str]:
+    if config.OCR_ENGINE == "easyocr":
+        import easyocr
+        reader = easyocr.Reader(['ru', 'en'])
+        return lambda image_path: '\n'.join(result[1] for result in reader.readtext(image_path))
+
+    import pytesseract
+    from PIL import Image
+    return lambda image_path: pytesseract.image_to_string(Image.open(image_path), lang='rus+eng')
+
+
+def _load_speech_recognition():
+    import speech_recognition
+    return speech_recognition
+
+
+def _load_audio_segment():
+    from pydub import AudioSegment
+    return AudioSegment
+
+
+def _engine(name: str, loader: Callable):
+    """Движок name, загруженный при первом обращении (один раз на процесс)"""
+    engine = _engines.get(name)
+    if engine is None:
+        with _engines_lock:
+            engine = _engines.get(name)
+            if engine is None:
+                started = time.perf_counter()
+                engine = loader()
+                _engines[name] = engine
+                logger.info(f"⚙️ Загружен движок {name} за {time.perf_counter() - started:.1f}с")
+    return engine
+
+
+class MediaProcessor:
+    """Класс для обработки медиа-контента (голосовые, изображения)
+
+    Методы блокирующие и выполняются в пуле media_pool: распознавание
+    текста - в отдельных процессах, конвертация и распознавание речи - в
+    потоках. Поэтому все они статические и объявлены на уровне модуля.
+    """
+
+    @staticmethod
+    def warm_up_ocr() -> bool:
+        """Загрузка движка OCR заранее (в процессе пула)"""
+        _engine("ocr", _load_ocr)
+        return True
+
+    @staticmethod
+    def warm_up_audio() -> bool:
+        """Загрузка pydub и распознавания речи заранее"""
+        _engine("audio_segment", _load_audio_segment)
+        _engine("speech_recognition", _load_speech_recognition)
+        return True
+
+    @staticmethod
+    def extract_text_from_image(image_path: str) -> str:
+        try:
+            text = _engine("ocr", _load_ocr)(image_path)
+            if not text.strip():
+                return "Текст на изображении не обнаружен"
+            logger.info(f"Распознанный текст: {text[:100]}...")
+            return text
+        except Exception as e:
+            logger.error(f"Ошибка при распознавании текста: {e}")
+            return f"Ошибка при распознавании текста: {str(e)}"
+
+    @staticmethod
+    def convert_audio_ogg_to_wav(ogg_path: str, wav_path: str) -> bool:
+        """Конвертирует OGG в WAV используя pydub"""
+        try:
+            audio = _engine("audio_segment", _load_audio_segment).from_ogg(ogg_path)
+            audio.export(wav_path, format="wav")
+            return True
+        except Exception as e:
+            logger.error(f"Ошибка конвертации аудио через pydub: {e}")
+            return MediaProcessor.convert_audio_ffmpeg(ogg_path, wav_path)
+
+    @staticmethod
+    def convert_audio_ffmpeg(ogg_path: str, wav_path: str) -> bool:
+        """Альтернативный способ конвертации через ffmpeg"""
+        try:
+            ffmpeg_paths = [
+                'ffmpeg', 'ffmpeg.exe', './ffmpeg',
+                './ffmpeg.exe', 'C:\\ffmpeg\\bin\\ffmpeg.exe'
+            ]
+
+            for ffmpeg_path in ffmpeg_paths:
+                try:
+                    result = subprocess.run(
+                        [ffmpeg_path, '-y', '-i', ogg_path, wav_path],
+                        stdout=subprocess.DEVNULL,
+                        stderr=subprocess.PIPE,
+                        timeout=30
+                    )
+                    if result.returncode == 0:
+                        logger.info(f"Аудио сконвертировано с помощью: {ffmpeg_path}")
+                        return True
+                except (subprocess.TimeoutExpired, FileNotFoundError, Exception):
+                    continue
+
+            logger.error("Не удалось найти рабочий ffmpeg")
+            return False
+
+        except Exception as e:
+            logger.error(f"Ошибка конвертации через ffmpeg: {e}")
+            return False
+
+    @staticmethod
+    def transcribe_audio(audio_path: str) -> str:
+        """Транскрибирует аудио в текст"""
+        try:
+            sr = _engine("speech_recognition", _load_speech_recognition)
+        except Exception as e:
+            logger.error(f"Ошибка загрузки распознавания речи: {e}")
+            return f"Ошибка обработки аудио: {str(e)}"
+        
+        try:
+            r = sr.Recognizer()
+            # Без таймаута зависший запрос к сервису занимает поток пула навсегда
+            r.operation_timeout = config.MEDIA_AUDIO_TIMEOUT
+            with sr.AudioFile(audio_path) as source:
+                r.adjust_for_ambient_noise(source, duration=0.5)
+                audio = r.record(source)
+
+            text = r.recognize_google(audio, language="ru-RU")
+            logger.info(f"Распознанная речь: {text}")
+            return text
+
+        except sr.UnknownValueError:
+            logger.error("Не удалось распознать речь")
+            return "Не удалось распознать речь. Попробуйте говорить четче и громче."
+        except sr.RequestError as e:
+            logger.error(f"Ошибка сервиса распознавания речи: {e}")
+            return "Ошибка сервиса распознавания речи. Проверьте подключение к интернету."
+        except Exception as e:
+            logger.error(f"Ошибка транскрибации аудио: {e}")
+            return f"Ошибка обработки аудио: {str(e)}"
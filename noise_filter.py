@@ -0,0 +1,219 @@
+import hashlib
+import logging
+import re
+from collections import Counter
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from config import config
+from token_budget import estimate_tokens, tokenize
+
+logger = logging.getLogger(__name__)
+
+# Короткие реакции, которые сами по себе не несут содержания
+REACTIONS = {
+    "+", "+1", "++", "-", "-1", "ок", "окей", "ok", "okay", "да", "неа", "нет", "ага", "угу", "ясно",
+    "понял", "поняла", "понятно", "спс", "спасибо", "thx", "thanks", "лол", "lol", "кек", "ха", "хах",
+    "ахах", "хаха", "жиза", "база", "класс", "круто", "топ", "норм", "го", "👍", "👌", "🔥", "😂", "🤣",
+    "❤️", "ну", "мм", "ммм", "хм", "wow", "вау", "согласен", "согласна", "точно", "именно", "реально",
+}
+
+WORD_CHAR_RE = re.compile(r"\w", re.UNICODE)
+REPEATED_CHAR_RE = re.compile(r"(.)\1{2,}")
+LAUGH_RE = re.compile(r"^(а?х[ах]+|(ха)+|(ах)+|(ло)+л|l+o+l+|)+$")
+
+SIMHASH_BITS = 64
+SIMHASH_BANDS = 4
+_BIT_SHIFTS = np.arange(SIMHASH_BITS, dtype=np.uint64)
+
+
+class NoiseReport:
+    """Что и сколько убрала предобработка"""
+
+    def __init__(self):
+        self.total = 0
+        self.empty = 0
+        self.duplicates = 0
+        self.collapsed = 0
+        self.tokens_saved = 0
+
+    @property
+    def removed(self) -> int:
+        return self.empty + self.duplicates + self.collapsed
+
+    def report(self) -> str:
+        return (
+            f"шум: из {self.total} сообщений убрано {self.removed} "
+            f"(пустых {self.empty}, почти-дубликатов {self.duplicates}, реакций свернуто {self.collapsed}), "
+            f"сэкономлено ~{self.tokens_saved} токенов"
+        )
+
+
+class NoiseStats:
+    """Суммарная экономия с момента запуска"""
+
+    def __init__(self):
+        self.calls = 0
+        self.messages = 0
+        self.removed = 0
+        self.tokens_saved = 0
+
+    def add(self, report: NoiseReport):
+        self.calls += 1
+        self.messages += report.total
+        self.removed += report.removed
+        self.tokens_saved += report.tokens_saved
+
+    def format_stats(self) -> str:
+        return (
+            f"🧹 **Фильтр шума:** промптов {self.calls}, сообщений {self.messages}, "
+            f"убрано {self.removed}, сэкономлено ~{self.tokens_saved} токенов"
+        )
+
+
+noise_stats = NoiseStats()
+
+
+def _normalize(text: str) -> str:
+    text = REPEATED_CHAR_RE.sub(r"\1\1", text.lower().strip())
+    return text.strip(" .,!?)(:;")
+
+
+def is_reaction(text: str) -> bool:
+    """Короткая реакция: '+1', 'ок', 'ахаха', '))' и т.п."""
+    normalized = _normalize(text)
+    if normalized in REACTIONS:
+        return True
+    if len(normalized) <= 12 and normalized and LAUGH_RE.match(normalized.replace(" ", "")):
+        return True
+    return False
+
+
+def _has_content(text: str) -> bool:
+    """Есть ли в тексте хоть одно слово (а не только эмодзи, смайлы и пунктуация)"""
+    return bool(WORD_CHAR_RE.search(text)) or _normalize(text) in REACTIONS
+
+
+def _shingle_hashes(text: str) -> List[int]:
+    words = tokenize(text)
+    shingles = [" ".join(words[i:i + 2]) for i in range(max(1, len(words) - 1))]
+    return [int.from_bytes(hashlib.blake2b(s.encode("utf-8"), digest_size=8).digest(), "little") for s in shingles]
+
+
+def simhash(text: str) -> int:
+    """64-битный SimHash по парам слов: у похожих текстов отличается мало бит"""
+    hashes = np.array(_shingle_hashes(text), dtype=np.uint64)
+    bits = ((hashes[:, None] >> _BIT_SHIFTS) & np.uint64(1)).astype(np.int8)
+    weights = (bits * 2 - 1).sum(axis=0)
+    return int(np.packbits((weights > 0)[::-1].astype(np.uint8)).view(">u8")[0])
+
+
+class _SimHashIndex:
+    """Поиск почти-дубликатов: расстояние Хэмминга до уже принятых текстов
+
+    По принципу Дирихле при расстоянии меньше числа полос хотя бы одна
+    16-битная полоса совпадает, поэтому сравниваются только кандидаты из
+    тех же полос.
+    """
+
+    def __init__(self, max_distance: int):
+        self.max_distance = max_distance
+        self.bands: List[Dict[int, List[int]]] = [{} for _ in range(SIMHASH_BANDS)]
+        self.band_bits = SIMHASH_BITS // SIMHASH_BANDS
+        self.mask = (1 << self.band_bits) - 1
+
+    def _keys(self, value: int):
+        return [(value >> (band * self.band_bits)) & self.mask for band in range(SIMHASH_BANDS)]
+
+    def contains_near(self, value: int) -> bool:
+        for band, key in enumerate(self._keys(value)):
+            for other in self.bands[band].get(key, ()):
+                if bin(value ^ other).count("1") <= self.max_distance:
+                    return True
+        return False
+
+    def add(self, value: int):
+        for band, key in enumerate(self._keys(value)):
+            self.bands[band].setdefault(key, []).append(value)
+
+
+def _collapse_run(run: List[Dict]) -> Dict:
+    """Серия реакций подряд -> одно сообщение 'реакции: +1 ×3, ок'"""
+    counts = Counter(_normalize(msg.get('text') or '') for msg in run)
+    users = list(dict.fromkeys(msg.get('user') or 'Unknown' for msg in run))
+    collapsed = dict(run[-1])
+    collapsed['user'] = ", ".join(users[:3]) + (f" и еще {len(users) - 3}" if len(users) > 3 else "")
+    collapsed['text'] = "реакции: " + ", ".join(
+        f"{text} ×{count}" if count > 1 else text for text, count in counts.most_common()
+    )
+    return collapsed
+
+
+def filter_noise(messages: List[Dict], newest_first: bool = False) -> Tuple[List[Dict], NoiseReport]:
+    """Удаление шума перед построением промпта
+
+    - сообщения без слов (эмодзи, стикеры текстом, пунктуация) удаляются;
+    - серии реакций подряд ('+1', 'ок', 'ахах') сворачиваются в одну строку;
+    - почти-дубликаты (пересылки, копипаста, спам) находятся по SimHash,
+      остается первое по времени сообщение.
+    Порядок сообщений сохраняется.
+    """
+    report = NoiseReport()
+    report.total = len(messages)
+    if not config.NOISE_FILTER_ENABLED or not messages:
+        return messages, report
+
+    chronological = list(reversed(messages)) if newest_first else list(messages)
+    index = _SimHashIndex(config.NOISE_SIMHASH_DISTANCE)
+    result: List[Dict] = []
+    removed_tokens = 0
+    added_tokens = 0
+    run: List[Dict] = []
+
+    def flush_run():
+        nonlocal added_tokens, removed_tokens
+        if len(run) >= 2:
+            collapsed = _collapse_run(run)
+            result.append(collapsed)
+            report.collapsed += len(run) - 1
+            removed_tokens += sum(estimate_tokens(msg.get('text') or '') for msg in run)
+            added_tokens += estimate_tokens(collapsed['text'])
+        else:
+            result.extend(run)
+        run.clear()
+
+    for msg in chronological:
+        text = (msg.get('text') or '').strip()
+        if not text:
+            # Медиа без подписи в промпт и так не попадает
+            continue
+        if not _has_content(text):
+            report.empty += 1
+            removed_tokens += estimate_tokens(text)
+            continue
+
+        if is_reaction(text):
+            run.append(msg)
+            continue
+        flush_run()
+
+        if len(tokenize(text)) >= config.NOISE_MIN_DUPLICATE_WORDS:
+            fingerprint = simhash(text)
+            if index.contains_near(fingerprint):
+                report.duplicates += 1
+                removed_tokens += estimate_tokens(text)
+                continue
+            index.add(fingerprint)
+
+        result.append(msg)
+    flush_run()
+
+    report.tokens_saved = max(0, removed_tokens - added_tokens)
+    if newest_first:
+        result.reverse()
+
+    if report.removed:
+        noise_stats.add(report)
+        logger.info(f"🧹 Фильтр {report.report()}")
+    return result, report
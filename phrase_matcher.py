@@ -0,0 +1,48 @@
+import re
+from typing import Dict, Iterable, List, Optional, Set
+
+
+class PhraseMatcher:
+    """Поиск словарных фраз нескольких категорий за один проход по тексту
+
+    Все фразы собираются в одно регулярное выражение-альтернацию при создании
+    (обычно при импорте модуля), найденная фраза переводится в категорию по
+    словарю. Как и проверка `phrase in text`, фраза ищется как подстрока
+    текста в нижнем регистре. Длинные фразы стоят в альтернации первыми,
+    поэтому из пересекающихся в одном месте фраз находится самая длинная.
+
+    Порядок категорий задает приоритет для first().
+
+    matches() отвечает только "есть ли хоть одна фраза" и проверяет фразы
+    поиском подстроки: на длинных ответах AI он быстрее обхода текста
+    регулярным выражением (см. benchmarks/matcher_benchmark.py).
+    """
+
+    def __init__(self, categories: Dict[str, Iterable[str]]):
+        self.order: List[str] = list(categories)
+        self._category_by_phrase: Dict[str, str] = {}
+        for category in self.order:
+            for phrase in categories[category]:
+                # Фраза из нескольких категорий относится к более приоритетной
+                self._category_by_phrase.setdefault(phrase.lower(), category)
+        phrases = sorted(self._category_by_phrase, key=len, reverse=True)
+        self._phrases = tuple(phrases)
+        self._pattern = re.compile("|".join(re.escape(phrase) for phrase in phrases))
+
+    def categories(self, text: str) -> Set[str]:
+        """Все категории, фразы которых встречаются в тексте"""
+        if not text:
+            return set()
+        return {self._category_by_phrase[phrase] for phrase in self._pattern.findall(text.lower())}
+
+    def first(self, text: str) -> Optional[str]:
+        """Самая приоритетная из найденных категорий"""
+        found = self.categories(text)
+        return next((category for category in self.order if category in found), None)
+
+    def matches(self, text: str) -> bool:
+        """Есть ли в тексте хотя бы одна фраза"""
+        if not text:
+            return False
+        text_lower = text.lower()
+        return any(phrase in text_lower for phrase in self._phrases)
@@ -0,0 +1,219 @@
+import logging
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional, Tuple
+
+from telegram import Update
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+SCOPE_USER = "user"
+SCOPE_CHAT = "chat"
+SCOPE_GLOBAL = "global"
+SCOPES = (SCOPE_USER, SCOPE_CHAT, SCOPE_GLOBAL)
+
+
+class SlidingWindowCounter:
+    """Счетчик запросов и токенов в скользящем окне
+
+    Окно делится на корзины по bucket_seconds, поэтому учет и проверка
+    стоят O(число корзин) и не требуют хранить каждый запрос.
+    """
+
+    def __init__(self, window_seconds: int, bucket_seconds: int):
+        self.window_seconds = window_seconds
+        self.bucket_seconds = bucket_seconds
+        # [начало корзины, запросы, токены]
+        self.buckets: Deque[List[int]] = deque()
+
+    def _prune(self, now: float):
+        threshold = now - self.window_seconds
+        while self.buckets and self.buckets[0][0] + self.bucket_seconds <= threshold:
+            self.buckets.popleft()
+
+    def add(self, requests: int, tokens: int, now: float = None):
+        now = now if now is not None else time.time()
+        bucket_start = int(now // self.bucket_seconds * self.bucket_seconds)
+        if self.buckets and self.buckets[-1][0] == bucket_start:
+            self.buckets[-1][1] += requests
+            self.buckets[-1][2] += tokens
+        else:
+            self.buckets.append([bucket_start, requests, tokens])
+        self._prune(now)
+
+    def totals(self, now: float = None) -> Tuple[int, int]:
+        now = now if now is not None else time.time()
+        self._prune(now)
+        return (
+            sum(bucket[1] for bucket in self.buckets),
+            sum(bucket[2] for bucket in self.buckets),
+        )
+
+    def oldest_bucket_expires_in(self, now: float = None) -> int:
+        """Через сколько секунд освободится самая старая корзина"""
+        now = now if now is not None else time.time()
+        if not self.buckets:
+            return 0
+        return max(1, int(self.buckets[0][0] + self.bucket_seconds + self.window_seconds - now))
+
+
+class QuotaDecision:
+    """Результат проверки квоты"""
+
+    def __init__(self, allowed: bool, scope: str = "", retry_after: int = 0):
+        self.allowed = allowed
+        self.scope = scope
+        self.retry_after = retry_after
+
+
+class QuotaManager:
+    """Квоты на AI запросы по пользователю, чату и глобально
+
+    Счетчики живут в памяти и периодически сохраняются в базу, чтобы
+    переживать перезапуск. Индивидуальные лимиты задаются админ-командами
+    и хранятся в таблице ai_quota_limits.
+    """
+
+    def __init__(self):
+        self.db = None
+        self._counters: Dict[Tuple[str, int], SlidingWindowCounter] = {}
+        self._limits: Dict[Tuple[str, int], Tuple[int, int]] = {}
+        self._dirty = set()
+        self._last_persist = time.monotonic()
+
+    def attach(self, db):
+        """Подключение базы: загрузка лимитов и сохраненных счетчиков"""
+        self.db = db
+        try:
+            for scope, scope_id, max_requests, max_tokens in db.get_quota_limits():
+                self._limits[(scope, scope_id)] = (max_requests, max_tokens)
+            since = int(time.time()) - config.AI_QUOTA_WINDOW_SECONDS
+            for scope, scope_id, bucket_start, requests, tokens in db.load_quota_usage(since):
+                self._counter((scope, scope_id)).buckets.append([bucket_start, requests, tokens])
+            logger.info(f"📏 Квоты загружены: лимитов {len(self._limits)}, счетчиков {len(self._counters)}")
+        except Exception as e:
+            logger.error(f"Error loading quotas: {e}")
+
+    def _counter(self, key: Tuple[str, int]) -> SlidingWindowCounter:
+        counter = self._counters.get(key)
+        if counter is None:
+            counter = SlidingWindowCounter(config.AI_QUOTA_WINDOW_SECONDS, config.AI_QUOTA_BUCKET_SECONDS)
+            self._counters[key] = counter
+        return counter
+
+    def get_limit(self, scope: str, scope_id: int) -> Tuple[int, int]:
+        """Лимит (запросы, токены) для области; 0 - без ограничений"""
+        if (scope, scope_id) in self._limits:
+            return self._limits[(scope, scope_id)]
+        defaults = {
+            SCOPE_USER: (config.AI_QUOTA_USER_REQUESTS, config.AI_QUOTA_USER_TOKENS),
+            SCOPE_CHAT: (config.AI_QUOTA_CHAT_REQUESTS, config.AI_QUOTA_CHAT_TOKENS),
+            SCOPE_GLOBAL: (config.AI_QUOTA_GLOBAL_REQUESTS, config.AI_QUOTA_GLOBAL_TOKENS),
+        }
+        return defaults[scope]
+
+    def set_limit(self, scope: str, scope_id: int, max_requests: int, max_tokens: int) -> bool:
+        """Установка индивидуального лимита"""
+        self._limits[(scope, scope_id)] = (max_requests, max_tokens)
+        if self.db:
+            return self.db.set_quota_limit(scope, scope_id, max_requests, max_tokens)
+        return True
+
+    def get_usage(self, scope: str, scope_id: int) -> Tuple[int, int]:
+        counter = self._counters.get((scope, scope_id))
+        return counter.totals() if counter else (0, 0)
+
+    def check_and_consume(self, chat_id: int, user_id: int, estimated_tokens: int) -> QuotaDecision:
+        """Проверить все квоты и, если запрос разрешен, учесть его"""
+        if not config.AI_QUOTA_ENABLED:
+            return QuotaDecision(True)
+
+        now = time.time()
+        keys = [(SCOPE_USER, user_id), (SCOPE_CHAT, chat_id), (SCOPE_GLOBAL, 0)]
+        for scope, scope_id in keys:
+            max_requests, max_tokens = self.get_limit(scope, scope_id)
+            counter = self._counter((scope, scope_id))
+            requests, tokens = counter.totals(now)
+            if (max_requests and requests + 1 > max_requests) or (max_tokens and tokens + estimated_tokens > max_tokens):
+                logger.warning(f"📏 Квота {scope}:{scope_id} исчерпана ({requests} запросов, {tokens} токенов)")
+                return QuotaDecision(False, scope, counter.oldest_bucket_expires_in(now))
+
+        for key in keys:
+            self._counter(key).add(1, estimated_tokens, now)
+            self._dirty.add(key)
+
+        self._maybe_persist()
+        return QuotaDecision(True)
+
+    async def enforce(self, update: Update, command: str, estimated_tokens: Optional[int] = None) -> bool:
+        """Проверка квоты перед AI командой; при превышении отвечает пользователю"""
+        try:
+            chat_id = update.effective_chat.id
+            user_id = update.effective_user.id if update.effective_user else 0
+            if estimated_tokens is None:
+                estimated_tokens = config.AI_QUOTA_COMMAND_TOKENS.get(command, config.AI_QUOTA_DEFAULT_TOKENS)
+
+            decision = self.check_and_consume(chat_id, user_id, estimated_tokens)
+            if decision.allowed:
+                return True
+
+            scope_text = {
+                SCOPE_USER: "ваш лимит",
+                SCOPE_CHAT: "лимит этого чата",
+                SCOPE_GLOBAL: "общий лимит бота",
+            }[decision.scope]
+            await update.effective_message.reply_text(
+                f"⏳ Исчерпан {scope_text} на AI запросы.\n"
+                f"Попробуйте через {max(1, decision.retry_after // 60)} мин."
+            )
+            return False
+
+        except Exception as e:
+            # Ошибка учета квот не должна ломать команды
+            logger.error(f"Error enforcing quota: {e}")
+            return True
+
+    def _maybe_persist(self):
+        if self.db and time.monotonic() - self._last_persist >= config.AI_QUOTA_PERSIST_INTERVAL:
+            self.persist()
+
+    def persist(self):
+        """Сохранение измененных счетчиков в базу"""
+        if not self.db or not self._dirty:
+            return
+        rows = []
+        for key in self._dirty:
+            counter = self._counters.get(key)
+            if counter:
+                counter.totals()  # Удаляем устаревшие корзины
+                rows.extend((key[0], key[1], bucket[0], bucket[1], bucket[2]) for bucket in counter.buckets)
+        cutoff = int(time.time()) - config.AI_QUOTA_WINDOW_SECONDS - config.AI_QUOTA_BUCKET_SECONDS
+        if self.db.save_quota_usage(rows, cutoff):
+            self._dirty.clear()
+        self._last_persist = time.monotonic()
+
+    def format_usage(self, chat_id: int, user_id: Optional[int] = None) -> str:
+        """Использование квот в читаемом формате"""
+        keys = [(SCOPE_CHAT, chat_id), (SCOPE_GLOBAL, 0)]
+        if user_id is not None:
+            keys.insert(0, (SCOPE_USER, user_id))
+        names = {SCOPE_USER: "Пользователь", SCOPE_CHAT: "Чат", SCOPE_GLOBAL: "Всего"}
+
+        def limit_text(value: int) -> str:
+            return str(value) if value else "∞"
+
+        lines = [f"📏 **Квоты AI (окно {config.AI_QUOTA_WINDOW_SECONDS // 60} мин):**\n"]
+        for scope, scope_id in keys:
+            requests, tokens = self.get_usage(scope, scope_id)
+            max_requests, max_tokens = self.get_limit(scope, scope_id)
+            lines.append(
+                f"• {names[scope]}: запросов {requests}/{limit_text(max_requests)}, "
+                f"токенов ~{tokens}/{limit_text(max_tokens)}"
+            )
+        return "\n".join(lines)
+
+
+# Общий менеджер квот для всех обработчиков
+quota_manager = QuotaManager()
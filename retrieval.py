@@ -0,0 +1,232 @@
+import logging
+import math
+import re
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, Set, Tuple
+
+from config import config
+from token_budget import WORD_RE, tokenize
+from topics import STOP_WORDS, stem
+from threads import thread_index
+
+logger = logging.getLogger(__name__)
+
+# Слова вопроса, по которым искать бессмысленно
+QUESTION_WORDS = {
+    "кто", "что", "чем", "когда", "где", "куда", "откуда", "почему", "зачем", "какой", "какая", "какое",
+    "какие", "сколько", "ли", "говорил", "говорила", "говорили", "писал", "писала", "писали", "сказал",
+    "сказала", "обсуждали", "обсуждалось", "чате", "вчера", "сегодня", "who", "what", "when", "where", "why",
+}
+
+
+class RetrievalResult:
+    """Отобранный для /ask контекст"""
+
+    def __init__(self, messages: List[Dict], matched: int, elapsed_ms: float, author: Optional[str]):
+        self.messages = messages
+        self.matched = matched
+        self.elapsed_ms = elapsed_ms
+        self.author = author
+
+
+def _parse_timestamp(value) -> Optional[datetime]:
+    try:
+        return datetime.fromisoformat(str(value))
+    except (TypeError, ValueError):
+        return None
+
+
+PREFIX_LENGTHS = (5, 4)  # совпадают с prefix='4 5' индекса messages_fts
+
+
+def _fold(text: str) -> str:
+    """Как tokenizer unicode61 с remove_diacritics в полнотекстовом индексе"""
+    return text.replace("ё", "е").replace("й", "и")
+
+
+class ChatRetriever:
+    """Поиск контекста для /ask по всей истории чата
+
+    Кандидаты - совпадения полнотекстового индекса (SQLite FTS5) и последние
+    сообщения чата. Итоговая оценка сообщения складывается из:
+    - релевантности BM25 (нормированной на лучший результат);
+    - свежести (экспоненциальное затухание с периодом ASK_RECENCY_HALF_LIFE_HOURS);
+    - принадлежности к одной ветке ответов с другими найденными сообщениями,
+      а для сообщений без ответов - близости к ним по времени;
+    - совпадения автора с участником, названным в вопросе.
+    Лучшие сообщения дополняются соседями и сообщениями своей ветки, а
+    упаковка в промпт идет по этой оценке.
+
+    BM25 считается здесь, а не функцией bm25() SQLite: она пересчитывает
+    частоты слов по всему индексу на каждый запрос. Индекс отдает только
+    ASK_RETRIEVAL_SCAN_LIMIT самых свежих совпадений, а частоты слов
+    кэшируются, поэтому время поиска не растет вместе с историей чата.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self._document_frequency: Dict[str, Tuple[float, int]] = {}
+
+    def query_terms(self, question: str) -> List[Tuple[str, bool]]:
+        """Значимые слова вопроса: (основа или слово, искать ли по префиксу)"""
+        terms = []
+        for word in tokenize(question):
+            if len(word) < 3 or word.isdigit() or word in STOP_WORDS or word in QUESTION_WORDS:
+                continue
+            base = _fold(stem(word))
+            length = next((size for size in PREFIX_LENGTHS if len(base) >= size), None)
+            term = (base[:length], True) if length else (_fold(word), False)
+            if term not in terms:
+                terms.append(term)
+        return terms[:config.ASK_MAX_QUERY_TERMS]
+
+    @staticmethod
+    def _phrase(term: Tuple[str, bool]) -> str:
+        return f'"{term[0]}"*' if term[1] else f'"{term[0]}"'
+
+    def has_new_matches(self, chat_id: int, question: str, since_id: int) -> bool:
+        """Есть ли после since_id сообщения со словами вопроса (если неизвестно - True)"""
+        terms = self.query_terms(question)
+        if not terms or not self.db.fts_enabled:
+            return True
+        newest = self.db.search_message_ids(chat_id, " OR ".join(self._phrase(term) for term in terms), 1)
+        return bool(newest) and newest[0] > since_id
+
+    def _get_document_frequency(self, term: Tuple[str, bool]) -> int:
+        key = self._phrase(term)
+        now = time.monotonic()
+        cached = self._document_frequency.get(key)
+        if cached and cached[0] > now:
+            return cached[1]
+        if len(self._document_frequency) >= config.ASK_IDF_CACHE_SIZE:
+            self._document_frequency.clear()
+        count = self.db.count_fulltext_matches(key)
+        self._document_frequency[key] = (now + config.ASK_IDF_CACHE_SECONDS, count)
+        return count
+
+    def _bm25(self, terms: List[Tuple[str, bool]], messages: List[Dict]) -> Dict[int, float]:
+        """Okapi BM25 для сообщений-кандидатов (k1=1.2, b=0.75)"""
+        total = max(1, self.db.get_max_message_id())
+        idf = []
+        for term in terms:
+            frequency = self._get_document_frequency(term)
+            idf.append(math.log(1 + (total - frequency + 0.5) / (frequency + 0.5)))
+
+        # Вхождения слова с начала токена: по префиксу или целиком
+        patterns = [
+            re.compile(rf"(?<!\w){re.escape(value)}" + ("" if prefix else r"(?!\w)"))
+            for value, prefix in terms
+        ]
+        texts = [_fold((msg.get('text') or '').lower()) for msg in messages]
+        lengths = [len(WORD_RE.findall(text)) for text in texts]
+        average_length = sum(lengths) / max(1, len(lengths)) or 1.0
+
+        scores = {}
+        for msg, text, length in zip(messages, texts, lengths):
+            score = 0.0
+            norm = 1.2 * (0.25 + 0.75 * length / average_length)
+            for pattern, weight in zip(patterns, idf):
+                tf = len(pattern.findall(text))
+                if tf:
+                    score += weight * tf * 2.2 / (tf + norm)
+            if score > 0:
+                scores[msg['id']] = score
+        return scores
+
+    def _find_author(self, question: str, messages: List[Dict]) -> Optional[str]:
+        """Участник чата, названный в вопросе (@username или имя в любой форме)"""
+        words = {stem(word) for word in tokenize(question.replace("@", " ")) if len(word) >= 3}
+        for name in dict.fromkeys(msg.get('user') for msg in reversed(messages) if msg.get('user')):
+            name_words = tokenize(name)
+            if name_words and all(stem(word) in words for word in name_words):
+                return name
+        return None
+
+    def retrieve(self, chat_id: int, question: str) -> RetrievalResult:
+        started = time.perf_counter()
+        recent = self.db.get_recent_messages(chat_id, config.ASK_RECENT_CONTEXT)
+
+        terms = self.query_terms(question)
+        match_query = " OR ".join(self._phrase(term) for term in terms)
+        hit_ids = self.db.search_message_ids(chat_id, match_query, config.ASK_RETRIEVAL_SCAN_LIMIT) if terms else []
+        if not hit_ids:
+            # Искать нечего (или индекс недоступен): отвечаем по последним сообщениям
+            messages = self.db.get_recent_messages(chat_id, config.MAX_MESSAGES_FOR_ANALYSIS)
+            return RetrievalResult(messages, 0, (time.perf_counter() - started) * 1000, None)
+
+        matched = self.db.get_messages_by_ids(chat_id, hit_ids)
+        bm25 = self._bm25(terms, matched)
+        hits = sorted(bm25.items(), key=lambda item: item[1], reverse=True)[:config.ASK_RETRIEVAL_CANDIDATES]
+
+        known = {msg['id']: msg for msg in recent}
+        by_id = {msg['id']: msg for msg in matched}
+        for message_id, _ in hits:
+            known[message_id] = by_id[message_id]
+        bm25 = dict(hits)
+
+        candidates = list(known.values())
+        author = self._find_author(question, candidates)
+        times = {msg['id']: _parse_timestamp(msg.get('timestamp')) for msg in candidates}
+        newest = max((value for value in times.values() if value), default=None)
+
+        best_bm25 = max(bm25.values(), default=0.0) or 1.0
+        # Опорные моменты разговора: время лучших совпадений
+        anchors = [
+            times[message_id] for message_id, _ in hits[:config.ASK_RETRIEVAL_EXPAND]
+            if times.get(message_id)
+        ]
+
+        # Ветки ответов, в которые попали лучшие совпадения
+        roots = thread_index.roots(chat_id, list(known))
+        anchor_ids = {message_id for message_id, _ in hits[:config.ASK_RETRIEVAL_EXPAND]}
+        anchor_roots: Dict[int, int] = {}
+        for message_id in anchor_ids:
+            if message_id in roots:
+                anchor_roots[roots[message_id]] = anchor_roots.get(roots[message_id], 0) + 1
+
+        scores: Dict[int, float] = {}
+        for msg in candidates:
+            message_id = msg['id']
+            score = config.ASK_WEIGHT_BM25 * bm25.get(message_id, 0.0) / best_bm25
+            moment = times.get(message_id)
+            if moment and newest:
+                age_hours = max(0.0, (newest - moment).total_seconds() / 3600)
+                score += config.ASK_WEIGHT_RECENCY * 0.5 ** (age_hours / config.ASK_RECENCY_HALF_LIFE_HOURS)
+            root = roots.get(message_id)
+            if root is not None:
+                # Другие совпадения в той же ветке ответов
+                if anchor_roots.get(root, 0) - (message_id in anchor_ids) > 0:
+                    score += config.ASK_WEIGHT_THREAD
+            elif moment and newest:
+                gaps = [abs((moment - anchor).total_seconds()) / 60 for anchor in anchors if anchor != moment]
+                if gaps:
+                    score += config.ASK_WEIGHT_THREAD * math.exp(-min(gaps) / config.ASK_THREAD_MINUTES)
+            if author and msg.get('user') == author:
+                score += config.ASK_WEIGHT_AUTHOR
+            scores[message_id] = score
+
+        # Соседи лучших сообщений - чтобы был виден ход разговора
+        top = sorted(scores, key=scores.get, reverse=True)[:config.ASK_RETRIEVAL_EXPAND]
+        neighbours = self.db.get_neighbour_message_ids(chat_id, top, config.ASK_NEIGHBOUR_RADIUS)
+        for message_id, ids in thread_index.related(chat_id, top).items():
+            neighbours[message_id] = list(neighbours.get(message_id, [])) + ids
+        extra: Set[int] = set()
+        for message_id, ids in neighbours.items():
+            for neighbour_id in ids:
+                inherited = scores[message_id] * config.ASK_NEIGHBOUR_DECAY
+                if inherited > scores.get(neighbour_id, 0.0):
+                    scores[neighbour_id] = inherited
+                    if neighbour_id not in known:
+                        extra.add(neighbour_id)
+        for msg in self.db.get_messages_by_ids(chat_id, sorted(extra)):
+            known[msg['id']] = msg
+
+        messages = sorted(known.values(), key=lambda msg: msg['id'])
+        for msg in messages:
+            msg['score'] = scores.get(msg['id'], 0.0)
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        logger.info(f"🔎 Поиск /ask: {len(hit_ids)} совпадений, {len(messages)} сообщений в контексте, "
+                    f"автор: {author or '-'}, {elapsed_ms:.1f}мс")
+        return RetrievalResult(messages, len(hit_ids), elapsed_ms, author)
@@ -1,19 +1,42 @@
+import asyncio
 import logging
-from apscheduler.schedulers.background import BackgroundScheduler
-from apscheduler.triggers.cron import CronTrigger
-from datetime import datetime
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Set
+from config import config
 from database import DatabaseManager
 from handlers.summary import SummaryHandler
+from digest import digest_builder
+from user_profiles import profile_store
+from topic_segmenter import topic_segmenter
 
 logger = logging.getLogger(__name__)
 
 class TaskScheduler:
+    """Фоновые задачи бота: обновление дайджестов и ежедневные суммаризации
+
+    Работает в event loop бота (задачи асинхронные), раз в
+    SCHEDULER_TICK_SECONDS проверяет, каким чатам пора отправить
+    суммаризацию и какие дайджесты пора обновить. Отправки и пересчет
+    дайджестов идут отдельными задачами, чтобы долгий пересчет одного чата
+    не задерживал отправку остальным.
+    """
+
     def __init__(self, db: DatabaseManager, application):
         self.db = db
         self.application = application
-        self.scheduler = BackgroundScheduler()
         self.summary_handler = SummaryHandler(db)
-        
+        digest_builder.attach(db, self.summary_handler)
+        self._task: Optional[asyncio.Task] = None
+        self._refresh_task: Optional[asyncio.Task] = None
+        self._jobs: Set[asyncio.Task] = set()
+        self._sent_dates: Dict[int, str] = {}
+
+    def _spawn(self, coro) -> asyncio.Task:
+        task = asyncio.get_running_loop().create_task(coro)
+        self._jobs.add(task)
+        task.add_done_callback(self._jobs.discard)
+        return task
+
     async def send_daily_summary(self, chat_id: str):
         """Отправка ежедневной суммаризации"""
         try:
@@ -21,48 +44,73 @@ class TaskScheduler:
             settings = self.db.get_chat_settings(int(chat_id))
             if not settings.get('daily_summary_enabled', True):
                 return
-                
-            # Получаем сообщения за последние 24 часа
-            from datetime import datetime, timedelta
-            start_time = datetime.now() - timedelta(hours=24)
-            messages = self.db.get_messages_by_time_range(
-                int(chat_id), start_time, datetime.now()
-            )
-            
-            if not messages:
+
+            # Дайджест обычно уже готов и просто читается из базы
+            digest = await digest_builder.get_digest(int(chat_id))
+            if not digest:
                 return
-                
-            # Создаем суммаризацию
-            # Здесь нужно адаптировать вызов для планировщика
-            # Это упрощенная версия - в реальности нужно больше логики
-            
-        except Exception as e:
-            logger.error(f"Error sending daily summary for chat {chat_id}: {e}")
-    
-    def setup_daily_summaries(self):
-        """Настройка ежедневных суммаризаций для всех чатов"""
-        try:
-            # Здесь будет логика получения всех чатов и их настроек времени
-            # Пока просто пример для 21:00
-            self.scheduler.add_job(
-                self.send_daily_summaries,
-                trigger=CronTrigger(hour=21, minute=0),
-                id='daily_summaries'
+
+            sent_message = await self.application.bot.send_message(
+                chat_id=int(chat_id),
+                text=f"📋 **Суммаризация за день ({digest['message_count']} сообщений):**\n\n{digest['summary']}"
             )
+
+            if settings.get('pin_summary', True):
+                try:
+                    await sent_message.pin(disable_notification=True)
+                except Exception as e:
+                    logger.warning(f"Could not pin daily summary in chat {chat_id}: {e}")
+
         except Exception as e:
-            logger.error(f"Error setting up daily summaries: {e}")
-    
+            logger.error(f"Error sending daily summary for chat {chat_id}: {e}")
+
     async def send_daily_summaries(self):
-        """Отправка суммаризаций всем активным чатам"""
-        # Логика получения всех чатов с включенными ежедневными суммаризациями
-        pass
-    
+        """Отправка суммаризаций чатам, у которых наступило summary_time"""
+        now = datetime.now()
+        today = now.date().isoformat()
+        upcoming = []
+
+        for chat in self.db.get_daily_summary_chats():
+            try:
+                hours, minutes = map(int, chat['summary_time'].split(':'))
+            except (ValueError, AttributeError):
+                continue
+            due_at = now.replace(hour=hours, minute=minutes, second=0, microsecond=0)
+
+            if due_at <= now < due_at + timedelta(minutes=config.DAILY_SUMMARY_SEND_WINDOW_MINUTES):
+                if self._sent_dates.get(chat['chat_id']) != today:
+                    self._sent_dates[chat['chat_id']] = today
+                    self._spawn(self.send_daily_summary(str(chat['chat_id'])))
+            elif now < due_at <= now + timedelta(minutes=config.AI_DIGEST_LEAD_MINUTES):
+                upcoming.append(chat['chat_id'])
+
+        return upcoming
+
+    async def _run(self):
+        """Основной цикл планировщика"""
+        while True:
+            try:
+                upcoming = await self.send_daily_summaries()
+                # Следующий пересчет - только после завершения предыдущего
+                if self._refresh_task is None or self._refresh_task.done():
+                    self._refresh_task = self._spawn(digest_builder.refresh_due(upcoming))
+                profile_store.refresh_due()
+                topic_segmenter.refresh_due()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Error in scheduler loop: {e}")
+            await asyncio.sleep(config.SCHEDULER_TICK_SECONDS)
+
     def start(self):
-        """Запуск планировщика"""
-        self.scheduler.start()
+        """Запуск планировщика (внутри работающего event loop)"""
+        self._task = asyncio.get_running_loop().create_task(self._run())
         logger.info("Task scheduler started")
-    
+
     def shutdown(self):
         """Остановка планировщика"""
-        self.scheduler.shutdown()
-        logger.info("Task scheduler stopped")
\ No newline at end of file
+        if self._task and not self._task.done():
+            self._task.cancel()
+        for job in list(self._jobs):
+            job.cancel()
+        logger.info("Task scheduler stopped")
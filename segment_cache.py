@@ -0,0 +1,172 @@
+import asyncio
+import logging
+import math
+from typing import Dict, List, Optional, Tuple
+
+from config import config
+from ai_queue import AIPriority
+from summarizer import (
+    MAP_PROMPT, REDUCE_PROMPT, MapReduceSummarizer, format_message_line, is_usable_summary, split_into_chunks
+)
+from noise_filter import filter_noise
+from token_budget import estimate_tokens, get_history_budget
+
+logger = logging.getLogger(__name__)
+
+
+def _format_lines(messages: List[Dict]) -> List[str]:
+    """Строки сообщений без шума (границы сегментов по id при этом не меняются)"""
+    filtered, _ = filter_noise(messages)
+    return [format_message_line(msg) for msg in filtered if (msg.get('text') or '').strip()]
+
+
+class SegmentSummaryCache:
+    """Кэш кратких содержаний сегментов истории чата
+
+    Сегмент - непрерывный диапазон сообщений чата (по id) длиной до
+    AI_SEGMENT_SIZE сообщений. Сообщения в прошлом не меняются, поэтому
+    содержание закрытого сегмента можно посчитать один раз и хранить в
+    таблице summary_segments. Повторная суммаризация окна собирается из
+    готовых сегментов и коротких необработанных кусков (свежий хвост,
+    края окна), поэтому стоит лишь малую долю исходных токенов.
+    """
+
+    def __init__(self, db, summarizer: MapReduceSummarizer):
+        self.db = db
+        self.summarizer = summarizer
+        self._locks: Dict[int, asyncio.Lock] = {}
+
+    async def build_lines(self, messages: List[Dict], chat_id: Optional[int],
+                          priority: AIPriority = AIPriority.INTERACTIVE) -> List[str]:
+        """Строки для промпта суммаризации: содержания сегментов и необработанные сообщения
+
+        Отсутствующие сегменты создаются лениво, только для непрерывных кусков
+        окна длиной не меньше AI_SEGMENT_SIZE. Более короткие куски остаются
+        обычными строками сообщений.
+        """
+        messages = [msg for msg in messages if msg.get('id') is not None]
+        if chat_id is None or len(messages) < config.AI_SEGMENT_SIZE:
+            return _format_lines(messages)
+
+        messages.sort(key=lambda msg: msg['id'])
+        lock = self._locks.setdefault(chat_id, asyncio.Lock())
+        async with lock:
+            pieces = self._plan(messages, chat_id)
+            await self._fill_missing(pieces, chat_id, priority)
+
+        lines = []
+        cached = 0
+        for kind, payload in pieces:
+            if kind == "segment" and payload['summary']:
+                cached += payload['message_count']
+                lines.append(f"[Сводка {payload['message_count']} сообщений] {payload['summary']}")
+            else:
+                block = payload['messages'] if kind == "segment" else payload
+                lines.extend(_format_lines(block))
+
+        logger.info(f"🧱 Сегменты: {cached} из {len(messages)} сообщений покрыты сводками, строк в промпте: {len(lines)}")
+        return lines
+
+    def estimate_cost(self, messages: List[Dict], chat_id: Optional[int]) -> int:
+        """Оценка токенов AI на суммаризацию окна - без обращений к AI
+
+        Готовые сводки сегментов стоят только своих токенов в промпте. Если
+        окно помещается в один запрос, это его размер плюс ответ. Иначе
+        map шаг читает все несжатые сообщения и по каждому фрагменту пишет
+        содержание AI_SUMMARY_PARTIAL_TOKENS, а итоговый запрос не больше
+        бюджета истории плюс ответ.
+        """
+        messages = sorted((msg for msg in messages if msg.get('id') is not None), key=lambda msg: msg['id'])
+        if chat_id is None or len(messages) < config.AI_SEGMENT_SIZE:
+            pieces = [("raw", messages)]
+        else:
+            pieces = self._plan(messages, chat_id)
+
+        cached_tokens = raw_tokens = 0
+        for kind, payload in pieces:
+            if kind == "segment" and payload['summary']:
+                cached_tokens += estimate_tokens(payload['summary'])
+            else:
+                block = payload['messages'] if kind == "segment" else payload
+                raw_tokens += sum(estimate_tokens(line) + 1 for line in _format_lines(block))
+
+        budget = get_history_budget(config.AI_MAX_TOKENS, command="summary")
+        if cached_tokens + raw_tokens <= budget:
+            return cached_tokens + raw_tokens + config.AI_MAX_TOKENS
+        chunks = math.ceil(raw_tokens / config.AI_SUMMARY_CHUNK_TOKENS)
+        return raw_tokens + chunks * config.AI_SUMMARY_PARTIAL_TOKENS + budget + config.AI_MAX_TOKENS
+
+    def _plan(self, messages: List[Dict], chat_id: int) -> List[Tuple[str, object]]:
+        """Разбиение окна на готовые сегменты, новые сегменты и сырые куски"""
+        first_id, last_id = messages[0]['id'], messages[-1]['id']
+        segments = {}
+        for segment in self.db.get_summary_segments(chat_id, first_id, last_id):
+            # Для одного начала берем самый длинный сегмент
+            if segment['start_id'] not in segments or segment['end_id'] > segments[segment['start_id']]['end_id']:
+                segments[segment['start_id']] = segment
+
+        pieces: List[Tuple[str, object]] = []
+        run: List[Dict] = []
+        index = 0
+        while index < len(messages):
+            segment = segments.get(messages[index]['id'])
+            if segment is None:
+                run.append(messages[index])
+                index += 1
+                continue
+            pieces.extend(self._split_run(run))
+            run = []
+            pieces.append(("segment", segment))
+            while index < len(messages) and messages[index]['id'] <= segment['end_id']:
+                index += 1
+        pieces.extend(self._split_run(run))
+        return pieces
+
+    def _split_run(self, run: List[Dict]) -> List[Tuple[str, object]]:
+        """Непрерывный кусок без сводок: полные блоки - в новые сегменты, остаток - как есть"""
+        size = config.AI_SEGMENT_SIZE
+        pieces: List[Tuple[str, object]] = []
+        full = len(run) - len(run) % size
+        for start in range(0, full, size):
+            block = run[start:start + size]
+            pieces.append(("segment", {
+                'start_id': block[0]['id'],
+                'end_id': block[-1]['id'],
+                'message_count': len(block),
+                'summary': None,
+                'messages': block
+            }))
+        if full < len(run):
+            pieces.append(("raw", run[full:]))
+        return pieces
+
+    async def _fill_missing(self, pieces: List[Tuple[str, object]], chat_id: int, priority: AIPriority):
+        """Параллельная суммаризация новых сегментов и сохранение в базу"""
+        missing = [payload for kind, payload in pieces if kind == "segment" and payload['summary'] is None]
+        if not missing:
+            return
+
+        logger.info(f"🧱 Сегменты: создаем {len(missing)} новых сводок для чата {chat_id}")
+        results = await asyncio.gather(
+            *(self._summarize_segment(segment, chat_id, priority) for segment in missing),
+            return_exceptions=True
+        )
+        for segment, summary in zip(missing, results):
+            if isinstance(summary, str) and is_usable_summary(summary):
+                segment['summary'] = summary
+                self.db.save_summary_segment(
+                    chat_id, segment['start_id'], segment['end_id'], segment['message_count'], summary
+                )
+
+    async def _summarize_segment(self, segment: Dict, chat_id: int, priority: AIPriority) -> Optional[str]:
+        lines = _format_lines(segment['messages'])
+        if not lines:
+            return None
+        chunks = split_into_chunks(lines, config.AI_SUMMARY_CHUNK_TOKENS)
+        partials, lost = await self.summarizer.summarize_chunks(chunks, MAP_PROMPT, chat_id, priority)
+        if len(partials) > 1 and not lost:
+            partials, lost = await self.summarizer.summarize_chunks(
+                ["\n\n".join(partials)], REDUCE_PROMPT, chat_id, priority
+            )
+        # Неполную сводку не кэшируем
+        return partials[0] if partials and not lost else None
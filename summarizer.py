@@ -0,0 +1,165 @@
+import asyncio
+import logging
+import time
+from typing import Dict, List, Optional, Tuple
+
+from config import config
+from ai_client import AIClient, is_local_fallback
+from ai_queue import AIPriority
+from token_budget import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+
+def is_usable_summary(text: Optional[str]) -> bool:
+    """Настоящая сводка AI, а не ошибка или локальный fallback (их нельзя кэшировать)"""
+    return bool(text) and not text.strip().startswith("❌") and not is_local_fallback(text)
+
+
+MAP_SYSTEM_PROMPT = (
+    "Ты - помощник для суммаризации групповых чатов. "
+    "Кратко перескажи фрагмент обсуждения, сохраняя факты, решения и имена участников."
+)
+
+MAP_PROMPT = """Это фрагмент {part} из {total} длинного обсуждения в групповом чате:
+
+{text}
+
+Перескажи фрагмент в 3-7 пунктах: темы, ключевые факты и решения, кто что предлагал.
+Не добавляй вступлений и выводов, пиши на русском языке."""
+
+REDUCE_PROMPT = """Ниже краткие содержания последовательных частей обсуждения в групповом чате:
+
+{text}
+
+Объедини их в одно краткое содержание в 5-10 пунктах, убрав повторы и сохранив порядок событий.
+Пиши на русском языке."""
+
+
+def format_message_line(msg: Dict, max_chars: int = 300) -> str:
+    """Строка сообщения для промпта суммаризации"""
+    text = (msg.get('text') or '').strip()
+    if len(text) > max_chars:
+        text = text[:max_chars - 3] + "..."
+    return f"{msg.get('user', 'Unknown')}: {text}"
+
+
+def split_into_chunks(lines: List[str], chunk_tokens: int) -> List[str]:
+    """Разбиение строк на последовательные фрагменты примерно по chunk_tokens токенов"""
+    chunks = []
+    current: List[str] = []
+    current_tokens = 0
+    for line in lines:
+        tokens = estimate_tokens(line) + 1
+        if current and current_tokens + tokens > chunk_tokens:
+            chunks.append("\n".join(current))
+            current, current_tokens = [], 0
+        current.append(line)
+        current_tokens += tokens
+    if current:
+        chunks.append("\n".join(current))
+    return chunks
+
+
+class MapReduceSummarizer:
+    """Иерархическая суммаризация длинных окон сообщений
+
+    Окно делится на фрагменты по AI_SUMMARY_CHUNK_TOKENS токенов, фрагменты
+    суммаризируются параллельно через общую очередь AI запросов (map), а
+    частичные содержания объединяются (reduce), пока не поместятся в
+    итоговый промпт. Время работы ограничено AI_SUMMARY_DEADLINE: фрагменты,
+    не успевшие к сроку, отбрасываются.
+    """
+
+    def __init__(self, ai_client: Optional[AIClient] = None):
+        self.ai_client = ai_client or AIClient()
+
+    async def condense(self, lines: List[str], budget: int, chat_id: Optional[int] = None,
+                       priority: AIPriority = AIPriority.INTERACTIVE,
+                       command: str = "summary") -> Tuple[str, bool, int]:
+        """Сжатие строк сообщений до текста, помещающегося в budget токенов
+
+        Возвращает (текст, является ли он пересказом частей, число потерянных фрагментов).
+        Если сообщения и так помещаются, они возвращаются без обращения к AI.
+        """
+        text = "\n".join(lines)
+        if estimate_tokens(text) + len(lines) <= budget:
+            return text, False, 0
+
+        deadline = time.monotonic() + config.AI_SUMMARY_DEADLINE
+        chunks = split_into_chunks(lines, min(config.AI_SUMMARY_CHUNK_TOKENS, budget))
+        logger.info(f"🧩 Map-reduce суммаризация: {len(lines)} сообщений, {len(chunks)} фрагментов")
+
+        partials, lost = await self.summarize_chunks(chunks, MAP_PROMPT, chat_id, priority, command, deadline)
+        partials = [f"Часть {index + 1}: {partial}" for index, partial in enumerate(partials)]
+
+        # Пока частичные содержания не помещаются в бюджет - объединяем их группами
+        level = 1
+        while len(partials) > 1 and estimate_tokens("\n\n".join(partials)) > budget:
+            groups = split_into_chunks(partials, min(config.AI_SUMMARY_CHUNK_TOKENS, budget))
+            if len(groups) >= len(partials):
+                # Каждое содержание больше фрагмента - дальше сжимать группами нельзя
+                break
+            level += 1
+            logger.info(f"🧩 Reduce уровень {level}: {len(partials)} содержаний -> {len(groups)}")
+            partials, reduce_lost = await self.summarize_chunks(
+                groups, REDUCE_PROMPT, chat_id, priority, command, deadline
+            )
+            lost += reduce_lost
+
+        # Если сжать группами не удалось, берем содержания, пока они помещаются в бюджет
+        fitted: List[str] = []
+        used = 0
+        for partial in partials:
+            tokens = estimate_tokens(partial) + 2
+            if used + tokens > budget:
+                break
+            fitted.append(partial)
+            used += tokens
+        if len(fitted) < len(partials):
+            logger.warning(f"⚠️ Map-reduce: {len(partials) - len(fitted)} содержаний не поместились в бюджет")
+            lost += len(partials) - len(fitted)
+
+        return "\n\n".join(fitted), True, lost
+
+    async def summarize_chunks(self, chunks: List[str], template: str, chat_id: Optional[int] = None,
+                               priority: AIPriority = AIPriority.INTERACTIVE, command: str = "summary",
+                               deadline: Optional[float] = None) -> Tuple[List[str], int]:
+        """Параллельная суммаризация фрагментов с общим сроком
+
+        Возвращает содержания успевших фрагментов (в исходном порядке) и число потерянных.
+        """
+        if deadline is None:
+            deadline = time.monotonic() + config.AI_SUMMARY_DEADLINE
+        semaphore = asyncio.Semaphore(config.AI_SUMMARY_MAP_CONCURRENCY)
+
+        async def summarize(index: int, chunk: str) -> Optional[str]:
+            async with semaphore:
+                prompt = template.format(part=index + 1, total=len(chunks), text=chunk)
+                return await self.ai_client.chat_completion(
+                    [
+                        {"role": "system", "content": MAP_SYSTEM_PROMPT},
+                        {"role": "user", "content": prompt}
+                    ],
+                    max_tokens=config.AI_SUMMARY_PARTIAL_TOKENS,
+                    temperature=0.3,
+                    priority=priority,
+                    chat_id=chat_id,
+                    command=command
+                )
+
+        tasks = [asyncio.create_task(summarize(i, chunk)) for i, chunk in enumerate(chunks)]
+        done, pending = await asyncio.wait(tasks, timeout=max(0.0, deadline - time.monotonic()))
+        for task in pending:
+            task.cancel()
+
+        results = []
+        for index, task in enumerate(tasks):
+            if task in done and task.exception() is None and is_usable_summary(task.result()):
+                results.append(task.result().strip())
+
+        lost = len(chunks) - len(results)
+        if lost:
+            logger.warning(f"⚠️ Map-reduce: {lost} из {len(chunks)} фрагментов не обработано "
+                           f"(не успели: {len(pending)})")
+        return results, lost
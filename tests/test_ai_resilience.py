@@ -0,0 +1,26 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ai_resilience import CircuitBreaker, RetryPolicy, call_with_retry
+
+
+def test_cancelled_probe_frees_half_open_slot():
+    breaker = CircuitBreaker("test", failure_threshold=1, recovery_timeout=0)
+    breaker.record_failure()
+
+    async def probe():
+        task = asyncio.create_task(call_with_retry(lambda: asyncio.sleep(5), RetryPolicy(1), breaker))
+        await asyncio.sleep(0)
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(probe())
+
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.allow_request()
@@ -0,0 +1,47 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from answer_cache import SCOPE_GPT, AnswerCache, embed_question, normalize_question
+from config import config
+
+CAKE = "Как приготовить шоколадный бисквит для торта {} духовки"
+THREADS = "Объясни {} между процессом и потоком в операционной системе простыми словами"
+
+
+def _similarity(first, second):
+    return float(embed_question(normalize_question(first)) @ embed_question(normalize_question(second)))
+
+
+@pytest.fixture
+def cache():
+    cache = AnswerCache()
+    cache.store(SCOPE_GPT, CAKE.format("без"), "на сковороде")
+    cache.store(SCOPE_GPT, THREADS.format("разницу"), "разница")
+    return cache
+
+
+@pytest.mark.parametrize("stored, question", [
+    (CAKE.format("без"), "Как приготовить шоколадный бисквит для торта в духовке"),
+    (CAKE.format("без"), "Как приготовить шоколадный бисквит для торта с духовкой"),
+    (THREADS.format("разницу"), THREADS.format("сходство")),
+])
+def test_question_differing_in_one_word_is_a_miss(cache, stored, question):
+    # Вектор считает такие вопросы похожими, отличить их должна проверка слов
+    assert _similarity(stored, question) >= config.ANSWER_CACHE_GPT_SIMILARITY
+
+    assert cache.lookup(SCOPE_GPT, question) is None
+
+
+@pytest.mark.parametrize("question, answer", [
+    ("как мне приготовить шоколадные бисквиты для торта без духовки", "на сковороде"),
+    ("Без духовки как приготовить шоколадный бисквит для торта?", "на сковороде"),
+    ("Объясни простыми словами разницу между процессами и потоками в операционной системе", "разница"),
+])
+def test_paraphrase_is_a_hit(cache, question, answer):
+    entry = cache.lookup(SCOPE_GPT, question)
+
+    assert entry is not None and entry.answer == answer
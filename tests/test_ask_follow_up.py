@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from handlers.questions import is_follow_up_question
+
+
+@pytest.mark.parametrize("text", ["а кто это предложил?", "Когда релиз", "почему, кстати, так решили", "сроки?"])
+def test_question_like_reply_is_follow_up(text):
+    assert is_follow_up_question(text)
+
+
+@pytest.mark.parametrize("text", ["спасибо", "+", "ок, понял", "👍"])
+def test_plain_reply_is_not_follow_up(text):
+    assert not is_follow_up_question(text)
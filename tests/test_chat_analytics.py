@@ -0,0 +1,19 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from chat_analytics import ChatArrays
+
+
+def test_trim_drops_everything_when_all_messages_are_old():
+    arrays = ChatArrays()
+    arrays.append([
+        {'id': 1, 'user': 'a', 'text': 'деплой прошел', 'timestamp': '2020-01-01 10:00:00'},
+        {'id': 2, 'user': 'b', 'text': 'отлично', 'timestamp': '2020-01-02 10:00:00'},
+    ])
+
+    arrays.trim(min_time=2_000_000_000)
+
+    assert arrays.ids.size == 0 and arrays.word_hash.size == 0
+    assert arrays.last_id == 2
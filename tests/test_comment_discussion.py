@@ -0,0 +1,67 @@
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import config
+from database import DatabaseManager
+from handlers.analysis import AnalysisHandler
+from threads import thread_index
+from topic_segmenter import topic_segmenter
+
+DEPLOY = "деплой сервер прод релиз откат логи ошибка база миграция".split()
+LUNCH = "обед пицца кафе суши бургер доставка столовая меню салат".split()
+
+
+@pytest.fixture
+def handler(tmp_path):
+    db = DatabaseManager(str(tmp_path / "chat.db"))
+    thread_index.attach(db)
+    thread_index._chats.clear()
+    topic_segmenter.attach(db)
+    topic_segmenter._chats.clear()
+    return AnalysisHandler(db)
+
+
+def _save(db, chat_id, words, count, rng, **kwargs):
+    for i in range(count):
+        db.save_message(chat_id, i % 3, f"u{i % 3}", " ".join(rng.sample(words, 4)), **kwargs)
+
+
+def _last_ids(db, chat_id, count):
+    return sorted(msg['id'] for msg in db.get_recent_messages(chat_id, count))
+
+
+def test_comment_returns_most_recent_messages(handler):
+    _save(handler.db, 1, DEPLOY, 80, random.Random(1))
+
+    messages = handler._get_current_discussion(1)
+
+    assert [msg['id'] for msg in messages] == _last_ids(handler.db, 1, config.COMMENT_MESSAGE_LIMIT)
+
+
+def test_comment_keeps_only_current_topic(handler):
+    rng = random.Random(2)
+    _save(handler.db, 1, DEPLOY, 50, rng)
+    _save(handler.db, 1, LUNCH, 20, rng)
+
+    messages = handler._get_current_discussion(1)
+
+    assert [msg['id'] for msg in messages] == _last_ids(handler.db, 1, 20)
+
+
+def test_comment_follows_thread_of_newest_messages(handler):
+    rng = random.Random(3)
+    handler.db.save_message(1, 0, "u0", "выкатываем релиз на прод", tg_message_id=1)
+    for i in range(40):
+        handler.db.save_message(1, 1, "u1", " ".join(rng.sample(DEPLOY, 4)), tg_message_id=100 + i)
+    for i in range(5):
+        handler.db.save_message(1, 2, "u2", " ".join(rng.sample(DEPLOY, 4)),
+                                reply_to_message_id=1, tg_message_id=200 + i)
+
+    ids = [msg['id'] for msg in handler._get_current_discussion(1)]
+
+    assert ids[-5:] == _last_ids(handler.db, 1, 5)
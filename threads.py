@@ -0,0 +1,161 @@
+import logging
+from collections import OrderedDict, deque
+from datetime import datetime, timedelta
+from typing import Deque, Dict, List, Optional, Set
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+
+class _ChatThreads:
+    """Связи "ответ на сообщение" одного чата (id сообщений в базе)"""
+
+    def __init__(self):
+        self.last_id = 0
+        self.by_telegram_id: Dict[int, int] = {}
+        self.parent: Dict[int, int] = {}
+        self.children: Dict[int, List[int]] = {}
+        self._order: Deque[tuple] = deque()
+
+    def add(self, message_id: int, telegram_id: Optional[int], reply_to: Optional[int]):
+        if telegram_id is None:
+            return
+        self.by_telegram_id[telegram_id] = message_id
+        self._order.append((message_id, telegram_id))
+        parent = self.by_telegram_id.get(reply_to) if reply_to is not None else None
+        if parent is not None and parent != message_id:
+            self.parent[message_id] = parent
+            self.children.setdefault(parent, []).append(message_id)
+
+    def trim(self, max_messages: int):
+        while len(self._order) > max_messages:
+            message_id, telegram_id = self._order.popleft()
+            if self.by_telegram_id.get(telegram_id) == message_id:
+                del self.by_telegram_id[telegram_id]
+            parent = self.parent.pop(message_id, None)
+            if parent is not None and parent in self.children:
+                self.children[parent] = [child for child in self.children[parent] if child != message_id]
+                if not self.children[parent]:
+                    del self.children[parent]
+            for child in self.children.pop(message_id, []):
+                self.parent.pop(child, None)
+
+    def is_linked(self, message_id: int) -> bool:
+        return message_id in self.parent or message_id in self.children
+
+    def root(self, message_id: int) -> int:
+        seen = {message_id}
+        while message_id in self.parent:
+            message_id = self.parent[message_id]
+            if message_id in seen:
+                break
+            seen.add(message_id)
+        return message_id
+
+    def members(self, root: int, limit: int) -> List[int]:
+        """Сообщения ветки от корня (обход в ширину, не больше limit)"""
+        members, queue = [], deque([root])
+        while queue and len(members) < limit:
+            message_id = queue.popleft()
+            members.append(message_id)
+            queue.extend(self.children.get(message_id, []))
+        return sorted(members)
+
+
+class ThreadIndex:
+    """Индекс веток обсуждения по ответам на сообщения (reply_to_message_id)
+
+    Для каждого чата в памяти хранится соответствие Telegram id -> id в базе
+    и связи родитель/ответы за последние THREAD_INDEX_DAYS дней (не больше
+    THREAD_INDEX_MAX_MESSAGES сообщений). Индекс дополняется только новыми
+    сообщениями при обращении; чаты вытесняются по LRU.
+    """
+
+    def __init__(self):
+        self.db = None
+        self._chats: "OrderedDict[int, _ChatThreads]" = OrderedDict()
+
+    def attach(self, db):
+        self.db = db
+
+    def _refresh(self, chat_id: int) -> Optional[_ChatThreads]:
+        if not self.db:
+            return None
+        threads = self._chats.get(chat_id)
+        if threads is None:
+            threads = _ChatThreads()
+            window_start = datetime.utcnow() - timedelta(days=config.THREAD_INDEX_DAYS)
+            threads.last_id = self.db.get_window_start_id(chat_id, window_start, config.THREAD_INDEX_MAX_MESSAGES)
+            self._chats[chat_id] = threads
+            while len(self._chats) > config.THREAD_INDEX_MAX_CHATS:
+                self._chats.popitem(last=False)
+        self._chats.move_to_end(chat_id)
+
+        while True:
+            links = self.db.get_reply_links_after(chat_id, threads.last_id, config.THREAD_INDEX_BATCH_SIZE)
+            for message_id, telegram_id, reply_to in links:
+                threads.add(message_id, telegram_id, reply_to)
+            if links:
+                threads.last_id = links[-1][0]
+            if len(links) < config.THREAD_INDEX_BATCH_SIZE:
+                break
+        threads.trim(config.THREAD_INDEX_MAX_MESSAGES)
+        return threads
+
+    def roots(self, chat_id: int, message_ids: List[int]) -> Dict[int, int]:
+        """Корень ветки для сообщений, связанных ответами с другими"""
+        threads = self._refresh(chat_id)
+        if not threads:
+            return {}
+        return {
+            message_id: threads.root(message_id)
+            for message_id in message_ids if threads.is_linked(message_id)
+        }
+
+    def related(self, chat_id: int, message_ids: List[int]) -> Dict[int, List[int]]:
+        """Родитель и ответы каждого сообщения"""
+        threads = self._refresh(chat_id)
+        if not threads:
+            return {}
+        related = {}
+        for message_id in message_ids:
+            ids = list(threads.children.get(message_id, []))
+            if message_id in threads.parent:
+                ids.append(threads.parent[message_id])
+            if ids:
+                related[message_id] = ids
+        return related
+
+    def current_conversation(self, chat_id: int, window_ids: List[int], tail: int) -> List[int]:
+        """Сообщения текущего обсуждения из окна последних сообщений
+
+        Ветки, которых касаются tail самых свежих сообщений, берутся целиком
+        (включая начало ветки до окна). Сообщения других веток из окна
+        отбрасываются - это параллельные разговоры. Сообщения без ответов
+        остаются: по ним нельзя сказать, к чему они относятся. Если последние
+        сообщения не связаны ответами, окно возвращается как есть.
+        """
+        threads = self._refresh(chat_id)
+        if not threads or not window_ids:
+            return window_ids
+        window_ids = sorted(window_ids)
+        roots = {
+            message_id: threads.root(message_id)
+            for message_id in window_ids if threads.is_linked(message_id)
+        }
+        active: Set[int] = {roots[message_id] for message_id in window_ids[-tail:] if message_id in roots}
+        if not active:
+            return window_ids
+
+        keep = {message_id for message_id in window_ids if message_id not in roots or roots[message_id] in active}
+        for root in active:
+            keep.update(threads.members(root, config.THREAD_MAX_MESSAGES))
+        dropped = len(window_ids) - len(keep.intersection(window_ids))
+        if dropped:
+            logger.info(f"🧵 Чат {chat_id}: отброшено {dropped} сообщений параллельных веток")
+        return sorted(keep)
+
+
+# Общий индекс веток для /ask и /comment
+thread_index = ThreadIndex()
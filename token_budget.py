@@ -0,0 +1,168 @@
+import logging
+import math
+import re
+from typing import Callable, Dict, List, Optional, Set
+
+from config import config
+
+logger = logging.getLogger(__name__)
+
+# Слово, число или отдельный знак препинания
+TOKEN_RE = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+# Среднее количество символов слова на один токен модели
+CHARS_PER_TOKEN = 4.0
+
+
+def estimate_tokens(text: str) -> int:
+    """Быстрая локальная оценка количества токенов в тексте
+
+    Короткие слова и знаки препинания считаются одним токеном, длинные слова
+    делятся на части по CHARS_PER_TOKEN символов. Оценка намеренно немного
+    завышена, чтобы промпт гарантированно поместился в контекст модели.
+    """
+    if not text:
+        return 0
+    tokens = 0
+    for match in TOKEN_RE.finditer(text):
+        length = match.end() - match.start()
+        tokens += 1 if length <= CHARS_PER_TOKEN else math.ceil(length / CHARS_PER_TOKEN)
+    return tokens
+
+
+def tokenize(text: str) -> List[str]:
+    """Разбиение текста на слова в нижнем регистре"""
+    return WORD_RE.findall(text.lower()) if text else []
+
+
+def get_model_context_tokens(model: Optional[str] = None) -> int:
+    """Размер контекста модели в токенах"""
+    if model is None:
+        model = config.YANDEX_MODEL if config.AI_PROVIDER == "yandex" else config.AI_MODEL
+    return config.MODEL_CONTEXT_TOKENS.get(model, config.DEFAULT_CONTEXT_TOKENS)
+
+
+def get_routed_context_tokens(command: Optional[str] = None) -> int:
+    """Контекст моделей, которым маршрутизатор отправит запрос команды
+
+    Промпт строится до выбора бэкенда, а при сбое тот же промпт уходит
+    следующему, поэтому берется наименьший контекст среди бэкендов маршрута.
+    """
+    from ai_router import get_router
+
+    models = [backend.model for backend in get_router().route(command) if backend.provider != "local"]
+    if not models:
+        return get_model_context_tokens()
+    return min(get_model_context_tokens(model) for model in models)
+
+
+def get_history_budget(max_tokens: int, prompt_overhead: int = None, model: Optional[str] = None,
+                       command: Optional[str] = None) -> int:
+    """Сколько токенов можно отдать под историю сообщений
+
+    Из контекста модели вычитаются ответ (max_tokens) и инструкции промпта.
+    Без явной модели берется контекст бэкендов, выбранных для команды.
+    """
+    if prompt_overhead is None:
+        prompt_overhead = config.PROMPT_OVERHEAD_TOKENS
+    context = get_model_context_tokens(model) if model else get_routed_context_tokens(command)
+    return max(0, context - max_tokens - prompt_overhead)
+
+
+class PackResult:
+    """Результат упаковки сообщений в промпт"""
+
+    def __init__(self, text: str, included: int, dropped: int, duplicates: int,
+                 tokens: int, dropped_tokens: int, budget: int):
+        self.text = text
+        self.included = included
+        self.dropped = dropped
+        self.duplicates = duplicates
+        self.tokens = tokens
+        self.dropped_tokens = dropped_tokens
+        self.budget = budget
+
+    def report(self) -> str:
+        return (
+            f"промпт: {self.included} сообщений, ~{self.tokens}/{self.budget} токенов; "
+            f"отброшено {self.dropped} (~{self.dropped_tokens} токенов), дубликатов {self.duplicates}"
+        )
+
+
+def pack_messages(messages: List[Dict], formatter: Callable[[int, Dict, str], str],
+                  budget: int, max_chars: int = 300, query: Optional[str] = None,
+                  newest_first: bool = False,
+                  priority: Optional[Callable[[Dict], float]] = None) -> PackResult:
+    """Упаковка истории сообщений в бюджет токенов
+
+    Каждое сообщение обрезается до max_chars, точные повторы удаляются
+    (остается самое свежее). Если всё не помещается в бюджет, в промпт
+    попадают сообщения с наибольшим приоритетом: свежие и совпадающие по
+    словам с query. Отобранные строки возвращаются в исходном порядке.
+
+    formatter(номер, сообщение, обрезанный текст) -> строка промпта.
+    priority(сообщение) -> оценка, заменяющая встроенную (например, из поиска /ask).
+    """
+    query_terms: Set[str] = set(tokenize(query)) if query else set()
+
+    # Индексы от самого свежего сообщения к самому старому
+    order = range(len(messages)) if newest_first else range(len(messages) - 1, -1, -1)
+
+    candidates = []
+    seen = set()
+    duplicates = 0
+    for age, index in enumerate(order):
+        msg = messages[index]
+        text = (msg.get('text') or '').strip()
+        if not text:
+            continue
+
+        key = (msg.get('user'), " ".join(text.lower().split()))
+        if key in seen:
+            duplicates += 1
+            continue
+        seen.add(key)
+
+        if len(text) > max_chars:
+            text = text[:max_chars - 3] + "..."
+
+        line = formatter(index + 1, msg, text)
+        if priority is not None:
+            score = priority(msg)
+        else:
+            score = 1.0 / (1.0 + age * 0.05)
+            if query_terms:
+                overlap = len(query_terms.intersection(tokenize(text)))
+                score += overlap / len(query_terms)
+
+        candidates.append((score, index, line, estimate_tokens(line) + 1))
+
+    total_tokens = sum(item[3] for item in candidates)
+    if total_tokens <= budget:
+        selected = candidates
+    else:
+        selected = []
+        used = 0
+        for item in sorted(candidates, key=lambda item: item[0], reverse=True):
+            if used + item[3] <= budget:
+                selected.append(item)
+                used += item[3]
+
+    # Возвращаем исходный порядок сообщений
+    selected.sort(key=lambda item: item[1])
+    tokens = sum(item[3] for item in selected)
+
+    result = PackResult(
+        text="\n".join(item[2] for item in selected),
+        included=len(selected),
+        dropped=len(candidates) - len(selected),
+        duplicates=duplicates,
+        tokens=tokens,
+        dropped_tokens=total_tokens - tokens,
+        budget=budget
+    )
+
+    if result.dropped or result.duplicates:
+        logger.info(f"📦 Упаковка {result.report()}")
+    return result
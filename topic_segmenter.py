@@ -0,0 +1,190 @@
+import logging
+import math
+from collections import Counter, OrderedDict, deque
+from datetime import datetime, timedelta
+from typing import Deque, Dict, Optional, Tuple
+
+from config import config
+from topics import message_terms
+
+logger = logging.getLogger(__name__)
+
+
+def _cosine(left: Counter, right: Counter) -> Optional[float]:
+    if not left or not right:
+        return None
+    dot = sum(count * right.get(term, 0) for term, count in left.items())
+    norm = math.sqrt(sum(v * v for v in left.values())) * math.sqrt(sum(v * v for v in right.values()))
+    return dot / norm
+
+
+def _seconds(timestamp) -> Optional[float]:
+    try:
+        return datetime.fromisoformat(str(timestamp)).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+class _ChatTopic:
+    """Потоковая сегментация одного чата
+
+    Хранит только окно из 2 * TOPIC_BLOCK_SIZE последних сообщений,
+    столько же последних значений связности и несколько последних границ.
+    """
+
+    def __init__(self):
+        self.last_id = 0
+        self.seq = 0
+        self.last_time: Optional[float] = None
+        self.window: Deque[Tuple[int, int, Counter]] = deque(maxlen=2 * config.TOPIC_BLOCK_SIZE)
+        self.similarities: Deque[Tuple[float, int, int]] = deque(maxlen=2 * config.TOPIC_BLOCK_SIZE)
+        self.boundaries: Deque[Tuple[int, int, str]] = deque([(0, 0, "start")], maxlen=config.TOPIC_BOUNDARY_HISTORY)
+
+    def observe(self, message_id: int, timestamp, text: str) -> Optional[str]:
+        """Учет сообщения; возвращает причину границы темы, если она найдена"""
+        self.seq += 1
+        self.last_id = message_id
+        found = None
+
+        moment = _seconds(timestamp)
+        if moment is not None and self.last_time is not None \
+                and moment - self.last_time > config.TOPIC_GAP_MINUTES * 60:
+            # После долгой паузы сравнивать лексику с прошлым разговором незачем
+            self.window.clear()
+            self.similarities.clear()
+            found = self._add_boundary(self.seq, message_id, "pause")
+        if moment is not None:
+            self.last_time = moment
+
+        self.window.append((self.seq, message_id, Counter(message_terms(text or ''))))
+        if len(self.window) < self.window.maxlen:
+            return found
+
+        # Связность двух соседних блоков (TextTiling): провал - смена темы
+        block = config.TOPIC_BLOCK_SIZE
+        items = list(self.window)
+        before, after = Counter(), Counter()
+        for _, _, terms in items[:block]:
+            before.update(terms)
+        for _, _, terms in items[block:]:
+            after.update(terms)
+        similarity = _cosine(before, after)
+        if similarity is None:
+            return found
+        gap_seq, gap_id, _ = items[block]
+        self.similarities.append((similarity, gap_seq, gap_id))
+
+        valley = self._deepest_valley()
+        if valley:
+            found = self._add_boundary(valley[0], valley[1], "lexical") or found
+        return found
+
+    def _deepest_valley(self) -> Optional[Tuple[int, int]]:
+        """Провал связности глубиной не меньше TOPIC_MIN_DEPTH после последней границы
+
+        Глубина считается как в TextTiling: подъем от минимума до ближайших
+        вершин слева и справа. Смена темы растягивает провал на размер
+        блока, поэтому соседних значений для оценки глубины мало.
+        """
+        last_seq = self.boundaries[-1][0]
+        raw = [item for item in self.similarities if item[1] > last_seq]
+        if len(raw) < 3:
+            return None
+        # Сглаживание соседними значениями, как в TextTiling: одиночные провалы - шум
+        sims = [
+            (sum(item[0] for item in raw[max(0, index - 1):index + 2]) / len(raw[max(0, index - 1):index + 2]),
+             raw[index][1], raw[index][2])
+            for index in range(len(raw))
+        ]
+        bottom = min(range(len(sims) - 1), key=lambda index: sims[index][0])
+        left = right = bottom
+        while left > 0 and sims[left - 1][0] >= sims[left][0]:
+            left -= 1
+        while right < len(sims) - 1 and sims[right + 1][0] >= sims[right][0]:
+            right += 1
+        if right == bottom:
+            return None  # связность еще падает, дно провала впереди
+        depth = (sims[left][0] - sims[bottom][0]) + (sims[right][0] - sims[bottom][0])
+        if depth < config.TOPIC_MIN_DEPTH:
+            return None
+        return sims[bottom][1], sims[bottom][2]
+
+    def _add_boundary(self, seq: int, message_id: int, reason: str) -> Optional[str]:
+        last_seq = self.boundaries[-1][0]
+        if seq <= last_seq or (reason == "lexical" and seq - last_seq < config.TOPIC_MIN_SEGMENT):
+            return None
+        self.boundaries.append((seq, message_id, reason))
+        return reason
+
+    def current_start(self) -> int:
+        """id, с которого начинается текущая тема (не короче TOPIC_MIN_SEGMENT сообщений)"""
+        for seq, message_id, _ in reversed(self.boundaries):
+            if self.seq - seq + 1 >= config.TOPIC_MIN_SEGMENT:
+                return message_id
+        return self.boundaries[0][1]
+
+
+class TopicSegmenter:
+    """Определение текущей темы чата для /comment без AI
+
+    Каждое новое сообщение учитывается один раз: граница темы ставится
+    при паузе дольше TOPIC_GAP_MINUTES или в точке провала лексической
+    связности соседних блоков по TOPIC_BLOCK_SIZE сообщений (потоковый
+    вариант TextTiling с задержкой в один блок). Для чата хранится только
+    окно последних сообщений и последние границы.
+    """
+
+    def __init__(self):
+        self.db = None
+        self._chats: "OrderedDict[int, _ChatTopic]" = OrderedDict()
+        self._pending: Dict[int, int] = {}
+        self.boundaries_found = 0
+
+    def attach(self, db):
+        self.db = db
+
+    def note_message(self, chat_id: int):
+        """Учет нового сообщения чата (вызывается при сохранении)"""
+        self._pending[chat_id] = self._pending.get(chat_id, 0) + 1
+
+    def refresh_due(self):
+        for chat_id in list(self._pending):
+            self._refresh(chat_id)
+
+    def _refresh(self, chat_id: int) -> Optional[_ChatTopic]:
+        if not self.db or not config.TOPIC_SEGMENTATION_ENABLED:
+            return None
+        self._pending.pop(chat_id, None)
+        state = self._chats.get(chat_id)
+        if state is None:
+            state = _ChatTopic()
+            # После перезапуска прогоняем недавнюю историю, чтобы восстановить границы
+            window_start = datetime.utcnow() - timedelta(hours=config.TOPIC_WARMUP_HOURS)
+            state.last_id = self.db.get_window_start_id(chat_id, window_start, config.TOPIC_WARMUP_MESSAGES)
+            self._chats[chat_id] = state
+            while len(self._chats) > config.TOPIC_MAX_CHATS:
+                self._chats.popitem(last=False)
+        self._chats.move_to_end(chat_id)
+
+        while True:
+            messages = self.db.get_messages_after(chat_id, state.last_id, config.TOPIC_SEGMENT_BATCH_SIZE)
+            for msg in messages:
+                reason = state.observe(msg['id'], msg.get('timestamp'), msg.get('text'))
+                if reason:
+                    self.boundaries_found += 1
+                    logger.debug(f"🧭 Чат {chat_id}: новая тема ({reason}) с сообщения {state.boundaries[-1][1]}")
+            if len(messages) < config.TOPIC_SEGMENT_BATCH_SIZE:
+                break
+        return state
+
+    def current_topic_start(self, chat_id: int) -> int:
+        """id первого сообщения текущей темы (0 - граница не найдена)"""
+        state = self._refresh(chat_id)
+        return state.current_start() if state else 0
+
+    def format_stats(self) -> str:
+        return f"🧭 **Темы /comment:** чатов {len(self._chats)}, найдено смен темы {self.boundaries_found}"
+
+
+# Общий сегментатор: обработчики сообщений сообщают ему о новых сообщениях
+topic_segmenter = TopicSegmenter()
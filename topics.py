@@ -0,0 +1,249 @@
+import logging
+import time
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from config import config
+from token_budget import tokenize
+
+logger = logging.getLogger(__name__)
+
+# Частые слова, которые не несут темы
+STOP_WORDS = {
+    "это", "как", "так", "что", "чтобы", "там", "тут", "здесь", "вот", "еще", "ещё", "уже", "или", "если",
+    "когда", "где", "кто", "они", "она", "оно", "его", "её", "ее", "них", "нас", "вас", "нам", "вам", "мне",
+    "меня", "тебя", "тебе", "себя", "свой", "все", "всё", "всех", "весь", "был", "была", "было", "были",
+    "быть", "будет", "есть", "нет", "для", "при", "про", "без", "под", "над", "через", "после", "перед",
+    "только", "тоже", "также", "даже", "очень", "можно", "нужно", "надо", "просто", "потом", "сейчас",
+    "тогда", "почему", "зачем", "который", "которые", "какой", "какие", "этот", "эта", "эти", "того",
+    "тот", "той", "того", "чем", "чего", "ничего", "что-то", "наверное", "вообще", "ладно", "давай",
+    "кстати", "короче", "типа", "спасибо", "привет", "пока", "хорошо", "норм", "ага", "угу",
+    "the", "and", "for", "that", "this", "with", "you", "are", "was", "but", "not", "have", "just",
+}
+
+# Облегченный стемминг вместо морфологии: "релиза", "релизе" -> "релиз"
+ENDINGS = sorted([
+    "ами", "ями", "ого", "его", "ому", "ему", "ыми", "ими", "ах", "ях", "ам", "ям", "ом", "ем", "ой", "ей",
+    "ый", "ий", "ая", "яя", "ое", "ее", "ые", "ие", "ую", "ов", "ев", "ть", "ся", "а", "я", "о", "е", "у",
+    "ю", "ы", "и", "ь", "й",
+], key=len, reverse=True)
+STEM_LENGTH = 7
+
+
+def stem(word: str) -> str:
+    if len(word) > 4:
+        for ending in ENDINGS:
+            if word.endswith(ending) and len(word) - len(ending) >= 3:
+                word = word[:-len(ending)]
+                break
+    return word[:STEM_LENGTH]
+
+
+def message_terms(text: str) -> List[str]:
+    return [
+        stem(word) for word in tokenize(text)
+        if len(word) >= 3 and not word.isdigit() and word not in STOP_WORDS
+    ]
+
+
+def _spherical_kmeans(X: np.ndarray, k: int, rng: np.random.Generator):
+    """Mini-batch k-means по косинусной близости (строки X нормированы)
+
+    Инициализация k-means++; для небольших окон пакет совпадает со всеми
+    данными, и алгоритм сводится к обычному k-means.
+    """
+    n = X.shape[0]
+    centers = np.empty((k, X.shape[1]), dtype=X.dtype)
+    centers[0] = X[rng.integers(n)]
+    distance = 1.0 - X @ centers[0]
+    for c in range(1, k):
+        weights = np.maximum(distance, 0.0) ** 2
+        total = weights.sum()
+        index = rng.choice(n, p=weights / total) if total > 0 else rng.integers(n)
+        centers[c] = X[index]
+        distance = np.minimum(distance, 1.0 - X @ centers[c])
+
+    counts = np.zeros(k)
+    batch_size = config.TOPIC_BATCH_SIZE
+    for _ in range(config.TOPIC_KMEANS_ITERATIONS):
+        full_batch = n <= batch_size
+        batch = X if full_batch else X[rng.choice(n, batch_size, replace=False)]
+        labels = np.argmax(batch @ centers.T, axis=1)
+        for c in range(k):
+            members = batch[labels == c]
+            if not len(members):
+                continue
+            counts[c] += len(members)
+            rate = 1.0 if full_batch else len(members) / counts[c]
+            centers[c] = (1.0 - rate) * centers[c] + rate * members.mean(axis=0)
+        norms = np.linalg.norm(centers, axis=1, keepdims=True)
+        centers /= np.where(norms > 0, norms, 1.0)
+
+    return np.argmax(X @ centers.T, axis=1), centers
+
+
+def _merge_similar_clusters(X: np.ndarray, labels: np.ndarray, centers: np.ndarray):
+    """Объединение кластеров с близкими центрами (одна тема, разбитая k-means на части)"""
+    while len(centers) > 1:
+        similarity = centers @ centers.T
+        np.fill_diagonal(similarity, -1.0)
+        a, b = np.unravel_index(np.argmax(similarity), similarity.shape)
+        if similarity[a, b] < config.TOPIC_MERGE_SIMILARITY:
+            break
+        a, b = min(a, b), max(a, b)
+        labels = np.where(labels == b, a, labels)
+        labels = np.where(labels > b, labels - 1, labels)
+        centers = np.delete(centers, b, axis=0)
+        center = X[labels == a].mean(axis=0)
+        centers[a] = center / (np.linalg.norm(center) or 1.0)
+    return labels, centers
+
+
+def extract_topics(messages: List[Dict], max_topics: Optional[int] = None) -> List[Dict]:
+    """Локальное выделение тем: TF-IDF + кластеризация сообщений
+
+    Возвращает темы по убыванию размера: ключевые слова, число сообщений,
+    доля обсуждения, уровень активности, основные участники и характерные
+    сообщения. Пустой список - если сообщений слишком мало для кластеров.
+    """
+    started = time.monotonic()
+    max_topics = max_topics or config.TOPIC_MAX_CLUSTERS
+
+    docs = []
+    for msg in messages:
+        terms = message_terms(msg.get('text') or '')
+        if terms:
+            docs.append((msg, terms))
+    if len(docs) < config.TOPIC_MIN_MESSAGES:
+        return []
+
+    # Словарь: термины, встречающиеся хотя бы в двух сообщениях, но не во всех подряд
+    document_frequency = Counter(term for _, terms in docs for term in set(terms))
+    max_df = max(2, int(len(docs) * config.TOPIC_MAX_DF))
+    vocabulary = [
+        term for term, df in document_frequency.most_common(config.TOPIC_MAX_VOCABULARY)
+        if 2 <= df <= max_df
+    ]
+    if len(vocabulary) < 2:
+        return []
+    term_index = {term: i for i, term in enumerate(vocabulary)}
+
+    rows, cols, values = [], [], []
+    for row, (_, terms) in enumerate(docs):
+        for term, count in Counter(terms).items():
+            if term in term_index:
+                rows.append(row)
+                cols.append(term_index[term])
+                values.append(count)
+
+    tf = np.zeros((len(docs), len(vocabulary)), dtype=np.float32)
+    tf[rows, cols] = values
+    df = np.array([document_frequency[term] for term in vocabulary], dtype=np.float32)
+    X = np.log1p(tf) * (np.log((1 + len(docs)) / (1 + df)) + 1.0)
+
+    # Сообщения без слов из словаря не участвуют в кластеризации
+    norms = np.linalg.norm(X, axis=1)
+    keep = norms > 0
+    X = X[keep] / norms[keep, None]
+    kept_docs = [doc for doc, flag in zip(docs, keep) if flag]
+
+    k = int(min(max_topics, max(2, round(np.sqrt(len(kept_docs) / 2)))))
+    if len(kept_docs) < k * 2:
+        return []
+
+    # Несколько запусков с разной инициализацией, берем самый плотный результат
+    rng = np.random.default_rng(config.TOPIC_RANDOM_SEED)
+    best_score = -1.0
+    for _ in range(config.TOPIC_KMEANS_RUNS):
+        run_labels, run_centers = _spherical_kmeans(X, k, rng)
+        score = float(np.sum(X * run_centers[run_labels]))
+        if score > best_score:
+            best_score, labels, centers = score, run_labels, run_centers
+    labels, centers = _merge_similar_clusters(X, labels, centers)
+    k = len(centers)
+
+    # Самая частая исходная форма слова для каждого префикса
+    surface_forms: Dict[str, Counter] = defaultdict(Counter)
+    for msg, _ in kept_docs:
+        for word in tokenize(msg.get('text') or ''):
+            if len(word) >= 3:
+                surface_forms[stem(word)][word] += 1
+
+    topics = []
+    total = len(kept_docs)
+    for c in range(k):
+        member_rows = np.flatnonzero(labels == c)
+        if len(member_rows) < config.TOPIC_MIN_CLUSTER_SIZE:
+            continue
+
+        # Слова со слабым весом в центре кластера - шум, а не тема
+        top_terms = np.argsort(-centers[c])[:config.TOPIC_KEYWORDS]
+        keywords = [
+            surface_forms[vocabulary[i]].most_common(1)[0][0]
+            for i in top_terms
+            if centers[c, i] >= centers[c, top_terms[0]] * 0.25 and surface_forms[vocabulary[i]]
+        ]
+
+        similarity = X[member_rows] @ centers[c]
+        examples = [
+            kept_docs[member_rows[i]][0].get('text', '').strip()
+            for i in np.argsort(-similarity)[:config.TOPIC_EXAMPLES]
+        ]
+
+        participants = Counter(kept_docs[i][0].get('user') or 'Unknown' for i in member_rows)
+        share = len(member_rows) / total
+        if share >= 0.35:
+            activity = "высокий"
+        elif share >= 0.15:
+            activity = "средний"
+        else:
+            activity = "низкий"
+
+        topics.append({
+            'keywords': keywords,
+            'message_count': len(member_rows),
+            'share': share,
+            'activity': activity,
+            'participants': [name for name, _ in participants.most_common(3)],
+            'examples': examples,
+        })
+
+    topics.sort(key=lambda topic: -topic['message_count'])
+    logger.info(f"🧮 Локальные темы: {len(topics)} из {len(docs)} сообщений, словарь {len(vocabulary)}, "
+                f"{(time.monotonic() - started) * 1000:.0f}мс")
+    return topics
+
+
+def format_topics(topics: List[Dict]) -> str:
+    """Темы в формате ответа /themes без обращения к AI"""
+    blocks = []
+    for number, topic in enumerate(topics, start=1):
+        example = topic['examples'][0] if topic['examples'] else ""
+        if len(example) > 150:
+            example = example[:147] + "..."
+        blocks.append(
+            f"🎯 **Тема {number}: {', '.join(topic['keywords'][:3])}**\n"
+            f"• Ключевые слова: {', '.join(topic['keywords'])}\n"
+            f"• Пример: «{example}»\n"
+            f"• Активность: {topic['activity']} ({topic['message_count']} сообщ., {topic['share']:.0%})\n"
+            f"• Участники: {', '.join(topic['participants'])}"
+        )
+    return "\n\n".join(blocks)
+
+
+def format_topics_for_ai(topics: List[Dict], max_chars: int = 200) -> str:
+    """Краткое описание кластеров для промпта, в котором AI только дает им названия"""
+    blocks = []
+    for number, topic in enumerate(topics, start=1):
+        examples = "\n".join(
+            f"  - {text[:max_chars - 3] + '...' if len(text) > max_chars else text}"
+            for text in topic['examples']
+        )
+        blocks.append(
+            f"Кластер {number}: ключевые слова: {', '.join(topic['keywords'])}; "
+            f"активность: {topic['activity']}; участники: {', '.join(topic['participants'])}\n"
+            f"Характерные сообщения:\n{examples}"
+        )
+    return "\n\n".join(blocks)
@@ -0,0 +1,283 @@
+import asyncio
+import hashlib
+import logging
+import re
+import time
+from collections import Counter
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from config import config
+from token_budget import WORD_RE, tokenize
+from topics import STOP_WORDS
+
+logger = logging.getLogger(__name__)
+
+EMOJI_RE = re.compile("[\U0001F300-\U0001FAFF☀-➿\U0001F1E6-\U0001F1FF]")
+LINK_RE = re.compile(r"https?://|www\.")
+
+# Счетчики профиля: одно сообщение - одна строка матрицы признаков
+SCALARS = [
+    "messages", "words", "chars", "emoji", "with_emoji", "questions",
+    "exclamations", "ellipsis", "caps", "links", "replies", "media",
+]
+LENGTH_EDGES = np.array([2, 6, 11, 21, 51])  # границы длины сообщения в словах
+LENGTH_LABELS = ["1", "2-5", "6-10", "11-20", "21-50", "51+"]
+WEEKDAYS = ["пн", "вт", "ср", "чт", "пт", "сб", "вс"]
+
+LENGTH_OFFSET = len(SCALARS)
+HOUR_OFFSET = LENGTH_OFFSET + len(LENGTH_LABELS)
+WEEKDAY_OFFSET = HOUR_OFFSET + 24
+DIMENSIONS = WEEKDAY_OFFSET + 7
+_INDEX = {name: i for i, name in enumerate(SCALARS)}
+
+
+def _batch_features(messages: List[Dict]) -> np.ndarray:
+    """Матрица признаков пачки сообщений (строка на сообщение)"""
+    texts = [msg.get('text') or '' for msg in messages]
+    rows = np.arange(len(messages))
+    matrix = np.zeros((len(messages), DIMENSIONS))
+
+    words = np.array([len(WORD_RE.findall(text)) for text in texts])
+    emoji = np.array([len(EMOJI_RE.findall(text)) for text in texts])
+    matrix[:, _INDEX["messages"]] = 1
+    matrix[:, _INDEX["words"]] = words
+    matrix[:, _INDEX["chars"]] = [len(text) for text in texts]
+    matrix[:, _INDEX["emoji"]] = emoji
+    matrix[:, _INDEX["with_emoji"]] = emoji > 0
+    matrix[:, _INDEX["questions"]] = ['?' in text for text in texts]
+    matrix[:, _INDEX["exclamations"]] = ['!' in text for text in texts]
+    matrix[:, _INDEX["ellipsis"]] = ['...' in text or '…' in text for text in texts]
+    matrix[:, _INDEX["caps"]] = [len(text) >= 5 and text.isupper() for text in texts]
+    matrix[:, _INDEX["links"]] = [LINK_RE.search(text) is not None for text in texts]
+    matrix[:, _INDEX["replies"]] = [msg.get('reply_to') is not None for msg in messages]
+    matrix[:, _INDEX["media"]] = [(msg.get('type') or 'text') != 'text' for msg in messages]
+    matrix[rows, LENGTH_OFFSET + np.digitize(words, LENGTH_EDGES)] = 1
+
+    timestamps = np.array(
+        [str(msg.get('timestamp') or '1970-01-01 00:00:00')[:19].replace(' ', 'T') for msg in messages],
+        dtype='datetime64[s]'
+    )
+    days = timestamps.astype('datetime64[D]')
+    hours = (timestamps.astype('datetime64[h]') - days).astype(int)
+    weekdays = (days.astype(np.int64) + 3) % 7  # 1970-01-01 - четверг
+    matrix[rows, HOUR_OFFSET + hours] = 1
+    matrix[rows, WEEKDAY_OFFSET + weekdays] = 1
+    return matrix
+
+
+def _message_words(text: str) -> List[str]:
+    return [word for word in tokenize(text) if len(word) >= 4 and not word.isdigit() and word not in STOP_WORDS]
+
+
+def _percent(part: float, total: float) -> str:
+    return f"{100 * part / total:.0f}%" if total else "0%"
+
+
+class UserProfile:
+    """Накопленные счетчики стиля участника и сохраненное AI-описание"""
+
+    def __init__(self, user_name: str, counters: Optional[List[float]] = None,
+                 terms: Optional[Dict[str, int]] = None, narrative: Optional[str] = None,
+                 narrative_message_count: int = 0, narrative_key: Optional[str] = None, **_):
+        self.user_name = user_name
+        self.counters = np.zeros(DIMENSIONS)
+        if counters:
+            self.counters[:len(counters)] = counters
+        self.terms = Counter(terms or {})
+        self.narrative = narrative
+        self.narrative_message_count = narrative_message_count
+        self.narrative_key = narrative_key
+
+    @property
+    def message_count(self) -> int:
+        return int(self.counters[_INDEX["messages"]])
+
+    def value(self, name: str) -> float:
+        return float(self.counters[_INDEX[name]])
+
+    def add(self, counters: np.ndarray, words: Counter):
+        self.counters += counters
+        self.terms.update(words)
+        if len(self.terms) > config.PROFILE_TERMS_KEEP:
+            self.terms = Counter(dict(self.terms.most_common(config.PROFILE_TERMS_KEEP)))
+
+    def to_record(self) -> Dict:
+        return {'counters': self.counters.tolist(), 'terms': dict(self.terms)}
+
+    def format_stats(self) -> str:
+        """Статистика стиля, посчитанная без AI"""
+        total = self.message_count
+        if not total:
+            return "Нет сообщений"
+        lengths = self.counters[LENGTH_OFFSET:HOUR_OFFSET]
+        hours = self.counters[HOUR_OFFSET:WEEKDAY_OFFSET]
+        weekdays = self.counters[WEEKDAY_OFFSET:]
+        # Самое активное трехчасовое окно
+        window = np.convolve(np.concatenate([hours, hours[:2]]), np.ones(3), mode='valid')
+        start = int(np.argmax(window))
+        lines = [
+            f"• Сообщений: {total}, в среднем {self.value('words') / total:.1f} слов",
+            "• Длина (слов): " + ", ".join(
+                f"{label} - {_percent(count, total)}" for label, count in zip(LENGTH_LABELS, lengths) if count
+            ),
+            f"• Эмодзи: в {_percent(self.value('with_emoji'), total)} сообщений; "
+            f"вопросы: {_percent(self.value('questions'), total)}; "
+            f"восклицания: {_percent(self.value('exclamations'), total)}",
+            f"• Активнее всего: {start:02d}:00-{(start + 3) % 24:02d}:00, "
+            f"чаще всего по дням: {WEEKDAYS[int(np.argmax(weekdays))]}",
+        ]
+        if self.value('replies'):
+            lines.append(f"• Ответы на сообщения: {_percent(self.value('replies'), total)}")
+        if self.value('media'):
+            lines.append(f"• Медиа (голосовые, фото): {_percent(self.value('media'), total)}")
+        if self.value('links'):
+            lines.append(f"• Ссылки: {_percent(self.value('links'), total)}")
+        if self.terms:
+            top = [word for word, _ in self.terms.most_common(config.PROFILE_TERMS_SHOWN)]
+            lines.append(f"• Частые слова: {', '.join(top)}")
+        return "\n".join(lines)
+
+
+class ProfileStore:
+    """Профили стиля участников чатов для мгновенного /opinion
+
+    Счетчики (длина сообщений, эмодзи и пунктуация, часы и дни активности,
+    ответы, частые слова) обновляются пачками новых сообщений: признаки
+    пачки считаются одной матрицей NumPy и суммируются по участникам.
+    Пачки обрабатываются в пуле потоков (не в event loop) - в фоне по
+    планировщику и перед /opinion, не больше одного обновления чата за раз,
+    поэтому каждое сообщение учитывается ровно один раз. Пока профили чата
+    не догнали историю (первый запуск), /opinion работает без профилей.
+
+    AI-описание хранится в профиле и пересчитывается, только когда у
+    участника накопилось PROFILE_NARRATIVE_REFRESH_MESSAGES новых сообщений
+    или изменилась личность бота.
+    """
+
+    def __init__(self):
+        self.db = None
+        self._pending: Dict[int, int] = {}
+        self._updates: Dict[int, asyncio.Future] = {}
+        self.narrative_hits = 0
+        self.narrative_builds = 0
+
+    def attach(self, db):
+        self.db = db
+
+    def note_message(self, chat_id: int):
+        """Учет нового сообщения чата (вызывается при сохранении)"""
+        self._pending[chat_id] = self._pending.get(chat_id, 0) + 1
+
+    def refresh_due(self):
+        """Фоновый учет накопившихся сообщений во всех чатах"""
+        for chat_id in list(self._pending):
+            self.start_update(chat_id)
+
+    def start_update(self, chat_id: int) -> asyncio.Future:
+        """Обновление профилей чата в пуле потоков (уже идущее - не дублируется)"""
+        future = self._updates.get(chat_id)
+        if future is None or future.done():
+            future = asyncio.get_running_loop().run_in_executor(None, self.update_chat, chat_id)
+            self._updates[chat_id] = future
+        return future
+
+    async def update_chat_async(self, chat_id: int) -> int:
+        """Дождаться учета новых сообщений чата, не блокируя event loop"""
+        return await asyncio.shield(self.start_update(chat_id))
+
+    def is_ready(self, chat_id: int) -> bool:
+        """Профили чата почти догнали историю: осталось не больше пачки сообщений
+
+        Иначе (например, первый /opinion после включения профилей) запускается
+        фоновый пересчет, а ответить нужно без профилей.
+        """
+        if not self.db or not config.PROFILES_ENABLED:
+            return False
+        if self.db.get_profile_progress(chat_id) and self._pending.get(chat_id, 0) <= config.PROFILE_BATCH_SIZE:
+            return True
+        self.start_update(chat_id)
+        return False
+
+    def update_chat(self, chat_id: int) -> int:
+        """Учет в профилях всех еще не обработанных сообщений чата"""
+        if not self.db or not config.PROFILES_ENABLED:
+            return 0
+        self._pending.pop(chat_id, None)
+        processed = 0
+        started = time.perf_counter()
+        try:
+            last_id = self.db.get_profile_progress(chat_id)
+            while True:
+                messages = self.db.get_messages_after(chat_id, last_id, config.PROFILE_BATCH_SIZE)
+                if not messages:
+                    break
+                self._apply_batch(chat_id, messages)
+                last_id = messages[-1]['id']
+                processed += len(messages)
+                if len(messages) < config.PROFILE_BATCH_SIZE:
+                    break
+        except Exception as e:
+            logger.error(f"Error updating user profiles for chat {chat_id}: {e}")
+        if processed:
+            logger.info(f"👤 Профили чата {chat_id}: учтено {processed} сообщений "
+                        f"за {(time.perf_counter() - started) * 1000:.0f}мс")
+        return processed
+
+    def _apply_batch(self, chat_id: int, messages: List[Dict]):
+        matrix = _batch_features(messages)
+        names, inverse = np.unique([msg.get('user') or '' for msg in messages], return_inverse=True)
+        totals = np.zeros((len(names), DIMENSIONS))
+        np.add.at(totals, inverse, matrix)
+
+        words: Dict[str, Counter] = {}
+        for msg in messages:
+            words.setdefault(msg.get('user') or '', Counter()).update(_message_words(msg.get('text') or ''))
+
+        stored = self.db.get_user_profiles(chat_id, [str(name) for name in names if name])
+        profiles = {}
+        for index, name in enumerate(names):
+            name = str(name)
+            if not name:
+                continue
+            profile = UserProfile(name, **stored.get(name, {}))
+            profile.add(totals[index], words.get(name, Counter()))
+            profiles[name] = profile.to_record()
+        if not self.db.save_user_profiles(chat_id, profiles, messages[-1]['id']):
+            raise RuntimeError("profiles were not saved")
+
+    def get_profile(self, chat_id: int, user_name: str) -> Optional[UserProfile]:
+        stored = self.db.get_user_profiles(chat_id, [user_name]) if self.db else {}
+        if user_name not in stored:
+            return None
+        return UserProfile(user_name, **stored[user_name])
+
+    @staticmethod
+    def narrative_key(personality: str) -> str:
+        return hashlib.sha1((personality or "").encode("utf-8")).hexdigest()[:16]
+
+    def fresh_narrative(self, profile: UserProfile, personality: str) -> Optional[str]:
+        """Сохраненное AI-описание, если оно еще актуально"""
+        if (profile.narrative and profile.narrative_key == self.narrative_key(personality)
+                and profile.message_count - profile.narrative_message_count < config.PROFILE_NARRATIVE_REFRESH_MESSAGES):
+            self.narrative_hits += 1
+            return profile.narrative
+        return None
+
+    def save_narrative(self, chat_id: int, profile: UserProfile, narrative: str, personality: str):
+        self.narrative_builds += 1
+        profile.narrative = narrative
+        profile.narrative_message_count = profile.message_count
+        self.db.save_profile_narrative(chat_id, profile.user_name, narrative, profile.message_count,
+                                       self.narrative_key(personality))
+
+    def format_stats(self) -> str:
+        return (
+            f"👤 **Профили /opinion:** описаний из профиля {self.narrative_hits}, "
+            f"пересчитано {self.narrative_builds}"
+        )
+
+
+# Общие профили: обработчики сообщений сообщают о новых сообщениях
+profile_store = ProfileStore()